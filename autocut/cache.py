@@ -0,0 +1,219 @@
+import collections
+import hashlib
+import json
+import logging
+import os
+import pickle
+import shutil
+import sqlite3
+import threading
+import time
+from typing import List
+
+import numpy as np
+
+DEFAULT_TRANSCRIBE_CACHE = os.path.join(
+    os.path.expanduser("~"), ".cache", "autocut", "transcribe.db"
+)
+DEFAULT_RENDER_CACHE = os.path.join(
+    os.path.expanduser("~"), ".cache", "autocut", "render"
+)
+
+
+# Cache transcription results by the hash of the audio they come from, so
+# unchanged audio is not transcribed again, e.g. a renamed or forced file.
+class TranscribeCache:
+    def __init__(self, filename: str, max_bytes: int = 512 * 2**20):
+        self.filename = filename
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        if os.path.dirname(filename):
+            os.makedirs(os.path.dirname(filename), exist_ok=True)
+        self._db = sqlite3.connect(filename, check_same_thread=False)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS results ("
+            "key TEXT PRIMARY KEY, value BLOB, size INTEGER, last_access REAL)"
+        )
+        self._db.execute(
+            "CREATE INDEX IF NOT EXISTS results_last_access ON results (last_access)"
+        )
+        self._db.commit()
+
+    @staticmethod
+    def key(audio: np.ndarray, settings: dict) -> str:
+        # Hash the PCM samples together with everything affecting the result
+        h = hashlib.sha256(np.ascontiguousarray(audio, np.float32).tobytes())
+        h.update(json.dumps(settings, sort_keys=True).encode())
+        return h.hexdigest()
+
+    def get(self, key: str):
+        with self._lock:
+            row = self._db.execute(
+                "SELECT value FROM results WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._db.execute(
+                "UPDATE results SET last_access = ? WHERE key = ?", (time.time(), key)
+            )
+            self._db.commit()
+        return pickle.loads(row[0])
+
+    def put(self, key: str, value):
+        data = pickle.dumps(value)
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?)",
+                (key, data, len(data), time.time()),
+            )
+            self._evict()
+            self._db.commit()
+
+    def _evict(self):
+        # Remove the least recently used results until within max_bytes
+        total = self._db.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM results"
+        ).fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        removed = []
+        for key, size in self._db.execute(
+            "SELECT key, size FROM results ORDER BY last_access"
+        ).fetchall():
+            if total <= self.max_bytes:
+                break
+            removed.append((key,))
+            total -= size
+        self._db.executemany("DELETE FROM results WHERE key = ?", removed)
+
+    def stats(self) -> str:
+        with self._lock:
+            count, size = self._db.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM results"
+            ).fetchone()
+        return (
+            f"{self.hits} hits, {self.misses} misses, "
+            f"{count} results of {size / 2**20:.1f} MB cached"
+        )
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+# Cache the encoded segments of a source media, so cutting it again only
+# encodes the segments not encoded before. Every segment is a file in folder,
+# and the least recently used ones are removed beyond max_bytes. The files
+# returned by get and put are pinned until released, so a worker evicting
+# doesn't remove the segments another one is still concatenating.
+class RenderCache:
+    # Shared by every instance, the workers of the daemon use their own ones
+    _lock = threading.Lock()
+    _pinned = collections.Counter()
+
+    def __init__(self, folder: str, max_bytes: int = 2048 * 2**20):
+        self.folder = os.path.abspath(folder)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(folder, exist_ok=True)
+
+    @staticmethod
+    def fingerprint(filename: str, sample_bytes: int = 4 * 2**20) -> str:
+        # Hash the size, head and tail of the file instead of reading it all,
+        # a recording is only edited by rewriting it
+        h = hashlib.sha256()
+        size = os.path.getsize(filename)
+        h.update(str(size).encode())
+        with open(filename, "rb") as f:
+            h.update(f.read(sample_bytes))
+            if size > sample_bytes:
+                f.seek(max(sample_bytes, size - sample_bytes))
+                h.update(f.read(sample_bytes))
+        return h.hexdigest()
+
+    @staticmethod
+    def key(source: str, start: float, end: float, settings: dict) -> str:
+        # source is the fingerprint of the media, settings has everything
+        # affecting the encoded segment, e.g. the encoder
+        h = hashlib.sha256(f"{source}:{start:.6f}:{end:.6f}".encode())
+        h.update(json.dumps(settings, sort_keys=True).encode())
+        return h.hexdigest()
+
+    def _filename(self, key: str, ext: str) -> str:
+        return os.path.join(self.folder, key + ext)
+
+    def get(self, key: str, ext: str = ".mp4"):
+        # Return the cached filename pinned, or None
+        fn = self._filename(key, ext)
+        with self._lock:
+            try:
+                # Mark as recently used
+                os.utime(fn)
+            except FileNotFoundError:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._pinned[fn] += 1
+        return fn
+
+    def put(self, key: str, filename: str, ext: str = ".mp4") -> str:
+        # Move filename into the cache, return its new filename pinned
+        fn = self._filename(key, ext)
+        with self._lock:
+            self._pinned[fn] += 1
+        shutil.move(filename, fn)
+        return fn
+
+    def release(self, filenames: List[str]):
+        # Unpin the filenames returned by get and put
+        with self._lock:
+            for fn in filenames:
+                self._pinned[fn] -= 1
+                if self._pinned[fn] <= 0:
+                    del self._pinned[fn]
+
+    def get_json(self, key: str):
+        fn = self.get(key, ".json")
+        if fn is None:
+            return None
+        try:
+            with open(fn, encoding="utf-8") as f:
+                return json.load(f)
+        finally:
+            self.release([fn])
+
+    def put_json(self, key: str, value):
+        fn = self._filename(key, ".json")
+        with open(fn + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(value, f)
+        os.replace(fn + ".tmp", fn)
+
+    def evict(self):
+        # Remove the least recently used files until within max_bytes, the
+        # pinned ones are kept
+        with self._lock:
+            files = []
+            with os.scandir(self.folder) as it:
+                for entry in it:
+                    if entry.is_file():
+                        stat = entry.stat()
+                        files.append((stat.st_mtime, stat.st_size, entry.path))
+            total = sum(f[1] for f in files)
+            for _, size, fn in sorted(files):
+                if total <= self.max_bytes:
+                    break
+                if fn in self._pinned:
+                    continue
+                try:
+                    os.remove(fn)
+                except FileNotFoundError:
+                    pass
+                total -= size
+
+    def stats(self) -> str:
+        return f"{self.hits} hits, {self.misses} misses of the encoded segments"
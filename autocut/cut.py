@@ -1,45 +1,70 @@
+import copy
 import logging
 import os
 import re
 
-import srt
+import numpy as np
 from moviepy import editor
 
-from . import utils
+from . import render, utils
+from .cache import RenderCache
+from .encoder import Encoder
+from .subtitle import Subtitles
+from .type import CutEngine, ExportProfile
 
 
 # Merge videos
 class Merger:
     def __init__(self, args):
         self.args = args
+        # {video md: ((mtime_ns, size), its task line)}, so the markdown of
+        # an unchanged video is not parsed again
+        self._summaries = {}
+
+    def _summary(self, video_fn):
+        md_fn = utils.change_ext(video_fn, "md")
+        state = utils.file_state(md_fn)
+        cached = self._summaries.get(md_fn)
+        if cached is not None and cached[0] == state:
+            return cached[1]
+
+        base = lambda fn: os.path.basename(fn)
+        video_md = utils.MD(md_fn, self.args.encoding)
+        # select a few words to scribe the video
+        desc = ""
+        if len(video_md.tasks()) > 1:
+            for _, t in video_md.tasks()[1:]:
+                m = re.findall(r"\] (.*)", t)
+                if m and "no speech" not in m[0].lower():
+                    desc += m[0] + " "
+                if len(desc) > 50:
+                    break
+        line = f'[{base(video_fn)}]({base(md_fn)}) {"[Edited]" if video_md.done_editing() else ""} {desc}'.strip()
+        self._summaries[md_fn] = (state, line)
+        return line
 
     def write_md(self, videos):
         md = utils.MD(self.args.inputs[0], self.args.encoding)
-        num_tasks = len(md.tasks())
-        # Not overwrite if already marked as down or no new videos
-        if md.done_editing() or num_tasks == len(videos) + 1:
+        # Not overwrite if already marked as down
+        if md.done_editing():
+            return
+        lines = [self._summary(f) for f in videos]
+        tasks = md.tasks()[1:]
+        # Nothing changed
+        if [t for _, t in tasks] == lines:
             return
 
+        # Keep the videos already selected
+        marks = {}
+        for m, t in tasks:
+            name = re.match(r"\[(.*?)\]", t)
+            if name:
+                marks[name.groups()[0]] = m
         md.clear()
         md.add_done_editing(False)
         md.add("\nSelect the files that will be used to generate `autocut_final.mp4`\n")
-        base = lambda fn: os.path.basename(fn)
-        for f in videos:
-            md_fn = utils.change_ext(f, "md")
-            video_md = utils.MD(md_fn, self.args.encoding)
-            # select a few words to scribe the video
-            desc = ""
-            if len(video_md.tasks()) > 1:
-                for _, t in video_md.tasks()[1:]:
-                    m = re.findall(r"\] (.*)", t)
-                    if m and "no speech" not in m[0].lower():
-                        desc += m[0] + " "
-                    if len(desc) > 50:
-                        break
-            md.add_task(
-                False,
-                f'[{base(f)}]({base(md_fn)}) {"[Edited]" if video_md.done_editing() else ""} {desc}',
-            )
+        for f, line in zip(videos, lines):
+            md.add_task(marks.get(os.path.basename(f), False), line)
         md.write()
 
     def run(self):
@@ -48,25 +73,27 @@ class Merger:
         if not md.done_editing():
             return
 
-        videos = []
+        video_fns = []
         for m, t in md.tasks():
             if not m:
                 continue
-            m = re.findall(r"\[(.*)\]", t)
+            m = re.findall(r"\[(.*?)\]", t)
             if not m:
                 continue
-            fn = os.path.join(os.path.dirname(md_fn), m[0])
-            logging.info(f"Loading {fn}")
-            videos.append(editor.VideoFileClip(fn))
+            video_fns.append(os.path.join(os.path.dirname(md_fn), m[0]))
 
-        dur = sum([v.duration for v in videos])
-        logging.info(f"Merging into a video with {dur / 60:.1f} min length")
+        if not video_fns:
+            logging.warning(f"No video is selected in {md_fn}")
+            return
 
-        merged = editor.concatenate_videoclips(videos)
         fn = os.path.splitext(md_fn)[0] + "_merged.mp4"
-        merged.write_videofile(
-            fn, audio_codec="aac", bitrate=self.args.bitrate
-        )  # logger=None,
+        if os.path.exists(fn) and os.path.getmtime(fn) >= max(
+            os.path.getmtime(f) for f in [md_fn] + video_fns
+        ):
+            logging.info(f"{fn} is up to date, skipping")
+            return
+
+        render.merge_videos(video_fns, fn, Encoder.from_args(self.args))
         logging.info(f"Saved merged video to {fn}")
 
 
@@ -87,11 +114,14 @@ class Cutter:
         is_video_file = utils.is_video(fns["media"].lower())
         outext = "mp4" if is_video_file else "mp3"
         output_fn = utils.change_ext(utils.add_cut(fns["media"]), outext)
-        if utils.check_exists(output_fn, self.args.force):
+        preview = getattr(self.args, "preview", False) and is_video_file
+        if preview:
+            # Overwritten every time, the edit is checked again and again
+            output_fn = os.path.splitext(fns["media"])[0] + "_preview.mp4"
+        elif utils.check_exists(output_fn, self.args.force):
             return
 
-        with open(fns["srt"], encoding=self.args.encoding) as f:
-            subs = list(srt.parse(f.read()))
+        subs = Subtitles.load(fns["srt"], self.args.encoding)
 
         if fns["md"]:
             md = utils.MD(fns["md"], self.args.encoding)
@@ -104,26 +134,66 @@ class Cutter:
                 m = re.match(r"\[(\d+)", sent.strip())
                 if m:
                     index.append(int(m.groups()[0]))
-            subs = [s for s in subs if s.index in index]
+            subs = subs.select(np.isin(subs.indices, index))
             logging.info(f'Cut {fns["media"]} based on {fns["srt"]} and {fns["md"]}')
         else:
             logging.info(f'Cut {fns["media"]} based on {fns["srt"]}')
 
-        segments = []
-        # Avoid disordered subtitles
-        subs.sort(key=lambda x: x.start)
-        for x in subs:
-            if len(segments) == 0:
-                segments.append(
-                    {"start": x.start.total_seconds(), "end": x.end.total_seconds()}
+        # Sorted to avoid disordered subtitles, and the close ones joined
+        segments = [
+            {"start": start, "end": end}
+            for start, end in (subs.segments(gap=500) / 1000).tolist()
+        ]
+
+        if preview:
+            args = copy.copy(self.args)
+            args.export_profile = ExportProfile.FAST_PREVIEW.value
+            render.preview_video(
+                fns["media"],
+                segments,
+                output_fn,
+                self.args.preview_height,
+                Encoder.from_args(args),
+            )
+            logging.info(f"Saved preview to {output_fn}")
+            return
+
+        if self.args.cut_engine == CutEngine.FFMPEG.value:
+            if is_video_file:
+                cache = (
+                    RenderCache(
+                        self.args.render_cache, self.args.render_cache_size * 2**20
+                    )
+                    if self.args.render_cache and self.args.render_cache_size > 0
+                    else None
+                )
+                render.encode_video(
+                    fns["media"],
+                    segments,
+                    output_fn,
+                    Encoder.from_args(self.args),
+                    cache,
+                    self.args.encode_jobs,
                 )
             else:
-                if x.start.total_seconds() - segments[-1]["end"] < 0.5:
-                    segments[-1]["end"] = x.end.total_seconds()
+                render.cut_audio(fns["media"], segments, output_fn, self.args.bitrate)
+            logging.info(f"Saved media to {output_fn}")
+            return
+
+        if self.args.cut_engine == CutEngine.FFMPEG_COPY.value:
+            if render.can_stream_copy(fns["media"]):
+                if is_video_file:
+                    _, num_jobs = utils.cpu_parallelism(0, self.args.encode_jobs)
+                    render.cut_video(fns["media"], segments, output_fn, num_jobs)
                 else:
-                    segments.append(
-                        {"start": x.start.total_seconds(), "end": x.end.total_seconds()}
+                    render.cut_audio(
+                        fns["media"], segments, output_fn, self.args.bitrate
                     )
+                logging.info(f"Saved media to {output_fn}")
+                return
+            logging.warning(
+                f'Cannot stream copy {fns["media"]}, fall back to the moviepy engine'
+            )
 
         if is_video_file:
             media = editor.VideoFileClip(fns["media"])
@@ -148,9 +218,10 @@ class Cutter:
             final_clip = final_clip.without_audio().set_audio(aud)
             final_clip = final_clip.fx(editor.afx.audio_normalize)
 
-            # an alternative to birate is use crf, e.g. ffmpeg_params=['-crf', '18']
+            encoder = Encoder.from_args(self.args)
+            logging.info(f"Encode by {encoder}")
             final_clip.write_videofile(
-                output_fn, audio_codec="aac", bitrate=self.args.bitrate
+                output_fn, audio_codec="aac", **encoder.moviepy_kwargs()
             )
         else:
             final_clip: editor.AudioClip = editor.concatenate_audioclips(clips)
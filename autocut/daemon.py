@@ -1,58 +1,357 @@
 import copy
-import glob
 import logging
 import os
+import queue
 import time
+from concurrent.futures import ThreadPoolExecutor
 
-from . import cut, transcribe, utils
+from . import cut, jobs, registry, transcribe, utils, watcher
+from .type import WhisperMode
+
+
+def _transcribe(args):
+    tic = time.time()
+    transcribe.Transcribe(args).run()
+    return time.time() - tic
+
+
+def _transcribe_live(args, state, final):
+    tic = time.time()
+    transcribe.Transcribe(args).run_live(args.inputs[0], state, final)
+    return time.time() - tic
+
+
+def _cut(args):
+    tic = time.time()
+    cut.Cutter(args).run()
+    return time.time() - tic
+
+
+def _merge(merger, media_files):
+    merger.write_md(media_files)
+    merger.run()
 
 
 class Daemon:
     def __init__(self, args):
         self.args = args
-        self.sleep = 1
+        # Retry a failed file after this many seconds, doubled every attempt
+        self.retry_interval = 10
+        # Wake up at least this often even if nothing changed
+        self.idle_interval = 600
+        self.jobs = None
+        # {path: (mtime_ns, size)} of the files as they were last handled
+        self.files = {}
+        # Transcription is bound by the model, so one worker per device. Cut
+        # and merge are bound by ffmpeg, so several of them run meanwhile.
+        self.transcribe_pool = None
+        self.cut_pool = None
+        # {media: the kind of its running work}
+        self.running = {}
+        # (kind, media, future) of the finished work
+        self.finished = queue.Queue()
+        self.merge_requested = False
+        # Kept between merges, it caches the summaries of the videos
+        self.merger = None
+        self.watcher = None
+        # Media still being written, they are transcribed after unchanged for
+        # stable_seconds
+        self.unstable = set()
+        # {media: state} of the live transcriptions of the unstable media
+        self.live = {}
+        # {media: the time of its last live transcription}
+        self.live_at = {}
 
     def run(self):
         assert len(self.args.inputs) == 1, "Must provide a single folder"
-        while True:
-            self._iter()
-            time.sleep(self.sleep)
-            self.sleep = min(60, self.sleep + 1)
-
-    def _iter(self):
         folder = self.args.inputs[0]
-        files = sorted(list(glob.glob(os.path.join(folder, "*"))))
-        media_files = [f for f in files if utils.is_video(f) or utils.is_audio(f)]
+        # Load models once, every new file only pays the inference
+        registry.warm_up_from_args(self.args)
+        self.jobs = jobs.JobStore(
+            self.args.job_store or ":memory:", self.retry_interval
+        )
+        self.transcribe_pool = ThreadPoolExecutor(
+            max(1, self.args.transcribe_workers), "autocut-transcribe"
+        )
+        self.cut_pool = ThreadPoolExecutor(
+            self.args.cut_workers or max(1, (os.cpu_count() or 1) // 4),
+            "autocut-cut",
+        )
         args = copy.deepcopy(self.args)
+        args.inputs = [os.path.join(folder, "autocut.md")]
+        self.merger = cut.Merger(args)
+        self.watcher = watcher.watch(folder)
+        try:
+            # Handle the files already in the folder first, the finished ones
+            # are skipped by their jobs
+            changed = set(watcher.scan(folder))
+            while True:
+                self._iter(changed)
+                changed = self.watcher.wait(self._timeout())
+        finally:
+            self.watcher.close()
+            self.transcribe_pool.shutdown(wait=True, cancel_futures=True)
+            self.cut_pool.shutdown(wait=True, cancel_futures=True)
+            self.jobs.close()
+
+    def _submit(self, pool, kind, media, fn, *args):
+        self.running[media] = kind
+        future = pool.submit(fn, *args)
+
+        def done(future):
+            self.finished.put((kind, media, future))
+            self.watcher.wake()
+
+        future.add_done_callback(done)
+
+    def _collect(self):
+        # Record the finished work, return the media finished successfully
+        succeeded = set()
+        while not self.finished.empty():
+            kind, f, future = self.finished.get()
+            del self.running[f]
+            error = future.exception()
+            if kind == "merge":
+                if error is not None:
+                    logging.error(f"Failed to merge: {error!r}")
+                # Not to handle the changes made by ourselves again
+                self._update(f)
+                continue
+            if kind == "live":
+                if error is not None:
+                    # e.g. the container can't be decoded before it is closed
+                    logging.info(f"Failed to transcribe {f} live: {error!r}")
+                self._update(utils.change_ext(f, "srt"))
+                self._update(utils.change_ext(f, "md"))
+                continue
+            if error is not None:
+                if kind == "transcribe":
+                    if isinstance(error, RuntimeError):
+                        logging.warn(
+                            "Failed, may be due to the video is still on recording"
+                        )
+                    else:
+                        logging.error(f"Failed to transcribe {f}: {error!r}")
+                    self.jobs.failed(f, repr(error))
+                else:
+                    logging.error(f"Failed to cut {f}: {error!r}")
+                    self.jobs.error(f, repr(error))
+                continue
+            if kind == "transcribe":
+                self.jobs.transcribed(f, future.result())
+                self._update(utils.change_ext(f, "srt"))
+                self._update(utils.change_ext(f, "md"))
+            else:
+                self.jobs.cut(f, future.result())
+            succeeded.add(f)
+        return succeeded
+
+    def _iter(self, changed):
+        folder = self.args.inputs[0]
+        finished = self._collect()
+        # Only look at the changed files, and the media they belong to
+        changed = {fn for fn in changed if _is_tracked(fn) and self._update(fn)}
+        retry = {
+            os.path.join(folder, os.path.basename(f)) for f in self.jobs.due(folder)
+        }
+        handled = bool(finished) or bool(changed)
+        if not handled and not retry and not self.unstable and not self.merge_requested:
+            return
+        media_files = sorted(
+            f for f in self.files if utils.is_video(f) or utils.is_audio(f)
+        )
+        # The finished media may have the next stage to do
+        touched = {os.path.splitext(f)[0] for f in finished | self.unstable}
+        for fn in changed:
+            # A sidecar lock file of the media being written
+            if fn.endswith(".lock"):
+                fn = fn[: -len(".lock")]
+            base = os.path.splitext(fn)[0]
+            touched.add(base)
+            # The outputs of cut belong to the original media as well
+            if base.endswith("_cut"):
+                touched.add(base[:-4])
+            if fn not in self.files and (utils.is_video(fn) or utils.is_audio(fn)):
+                self.jobs.remove(fn)
+                self.unstable.discard(fn)
+                self.live.pop(fn, None)
+
         for f in media_files:
+            if f not in retry and os.path.splitext(f)[0] not in touched:
+                continue
+            if f in self.running:
+                # Checked again once the running work is finished
+                continue
+            job = self.jobs.add(f, *self.files[f])
+            if job["stage"] == jobs.FAILED:
+                if f not in retry:
+                    # Wait for the backoff
+                    continue
+                # Otherwise it stays due and wakes the loop at once until the
+                # retry is finished
+                self.jobs.retrying(f)
             srt_fn = utils.change_ext(f, "srt")
             md_fn = utils.change_ext(f, "md")
             is_video_file = utils.is_video(f)
-            if srt_fn not in files or md_fn not in files:
+            if (
+                job["stage"] == jobs.NEW
+                and f not in self.live
+                and self._transcribed_before(f)
+            ):
+                # e.g. transcribed before the daemon restarted
+                self.jobs.transcribed(f, None)
+                job = self.jobs.get(f)
+            if (
+                job["stage"] in (jobs.NEW, jobs.FAILED)
+                or srt_fn not in self.files
+                or md_fn not in self.files
+            ):
+                args = copy.deepcopy(self.args)
                 args.inputs = [f]
-                try:
-                    transcribe.Transcribe(args).run()
-                    self.sleep = 1
-                    break
-                except RuntimeError as e:
-                    logging.warn(
-                        "Failed, may be due to the video is still on recording"
-                    )
-                    pass
-            if md_fn in files:
-                if utils.add_cut(md_fn) in files:
-                    continue
-                md = utils.MD(md_fn, self.args.encoding)
-                ext = "mp4" if is_video_file else "mp3"
-                if not md.done_editing() or os.path.exists(
-                    utils.change_ext(utils.add_cut(f), ext)
-                ):
+                # The md may be left by a live or an earlier transcription of
+                # a changed file, it is decided above
+                args.force = True
+                if self._unstable_for(f) > 0:
+                    # Still being written, only transcribe the recorded part
+                    self.unstable.add(f)
+                    state = self.live.setdefault(f, {})
+                    if (
+                        self._can_live()
+                        and time.time() - self.live_at.get(f, 0)
+                        >= self.args.live_interval
+                        # Nothing new recorded, e.g. paused or locked
+                        and state.get("size") != self.files[f][1]
+                    ):
+                        self.live_at[f] = time.time()
+                        state["size"] = self.files[f][1]
+                        self._submit(
+                            self.transcribe_pool,
+                            "live",
+                            f,
+                            _transcribe_live,
+                            args,
+                            state,
+                            False,
+                        )
                     continue
-                args.inputs = [f, md_fn, srt_fn]
-                cut.Cutter(args).run()
-                self.sleep = 1
+                self.unstable.discard(f)
+                self.live_at.pop(f, None)
+                if f in self.live:
+                    # Only the rest after the live transcription
+                    self._submit(
+                        self.transcribe_pool,
+                        "transcribe",
+                        f,
+                        _transcribe_live,
+                        args,
+                        self.live.pop(f),
+                        True,
+                    )
+                else:
+                    self._submit(
+                        self.transcribe_pool, "transcribe", f, _transcribe, args
+                    )
+                continue
+            if job["stage"] == jobs.CUT:
+                continue
+            ext = "mp4" if is_video_file else "mp3"
+            if utils.add_cut(md_fn) in self.files or os.path.exists(
+                utils.change_ext(utils.add_cut(f), ext)
+            ):
+                self.jobs.cut(f, None)
+                continue
+            md = utils.MD(md_fn, self.args.encoding)
+            if not md.done_editing():
+                continue
+            args = copy.deepcopy(self.args)
+            args.inputs = [f, md_fn, srt_fn]
+            self._submit(self.cut_pool, "cut", f, _cut, args)
 
-        args.inputs = [os.path.join(folder, "autocut.md")]
-        merger = cut.Merger(args)
-        merger.write_md(media_files)
-        merger.run()
+        counts = self.jobs.counts(folder)
+        logging.info(
+            "Jobs: "
+            + ", ".join(
+                f"{counts.get(stage, 0)} {stage}"
+                for stage in (jobs.NEW, jobs.FAILED, jobs.TRANSCRIBED, jobs.CUT)
+            )
+            + f", {len(self.running)} running"
+        )
+        self.merge_requested = self.merge_requested or handled
+        merger_md = self.merger.args.inputs[0]
+        if self.merge_requested and merger_md not in self.running:
+            # Only one merge at a time, a later request runs after it
+            self.merge_requested = False
+            self._submit(
+                self.cut_pool, "merge", merger_md, _merge, self.merger, media_files
+            )
+
+    def _transcribed_before(self, f):
+        # Whether the srt and md of f are written after f was last changed. A
+        # live transcription is written while recording, so it is older than
+        # the finished recording.
+        states = [self.files.get(utils.change_ext(f, ext)) for ext in ("srt", "md")]
+        return all(
+            state is not None and state[0] >= self.files[f][0] for state in states
+        )
+
+    def _can_live(self):
+        return self.args.live_interval > 0 and self.args.whisper_mode in (
+            WhisperMode.WHISPER.value,
+            WhisperMode.FASTER.value,
+        )
+
+    def _unstable_for(self, f):
+        # Seconds until f can be seen as completely written. It is not while
+        # it has a sidecar lock file, or changed in the last stable_seconds.
+        if os.path.exists(f + ".lock"):
+            return self.args.stable_seconds
+        self._update(f)
+        if f not in self.files:
+            return 0
+        return self.args.stable_seconds - (time.time() - self.files[f][0] / 1e9)
+
+    def _timeout(self):
+        # Seconds to wait for the changes before the next iteration
+        timeouts = [
+            t
+            for t in (self.jobs.next_retry(self.args.inputs[0]), self._next_check())
+            if t is not None
+        ]
+        return min([self.idle_interval] + timeouts)
+
+    def _next_check(self):
+        # Seconds until an unstable media may be stable or transcribed live
+        times = []
+        for f in self.unstable:
+            times.append(self._unstable_for(f))
+            if self._can_live():
+                times.append(
+                    self.live_at.get(f, 0) + self.args.live_interval - time.time()
+                )
+        return max(0.1, min(times)) if times else None
+
+    def _update(self, fn):
+        # Record the current state of fn, return if it changed since recorded
+        try:
+            stat = os.stat(fn)
+            state = (stat.st_mtime_ns, stat.st_size)
+        except FileNotFoundError:
+            state = None
+        if state == self.files.get(fn):
+            return False
+        if state is None:
+            del self.files[fn]
+        else:
+            self.files[fn] = state
+        return True
+
+
+def _is_tracked(fn):
+    # The files the daemon reads or writes, and the lock files of media
+    if fn.endswith(".lock"):
+        fn = fn[: -len(".lock")]
+    return (
+        utils.is_video(fn)
+        or utils.is_audio(fn)
+        or os.path.splitext(fn)[1] in (".srt", ".md")
+    )
@@ -0,0 +1,158 @@
+import functools
+import logging
+import os
+import subprocess
+from typing import Dict, List, Optional
+
+from .type import ExportProfile, HWAccel
+
+VAAPI_DEVICE = "/dev/dri/renderD128"
+
+# The software encoder, preset and CRF of every profile. The default profile
+# encodes at --bitrate instead of a CRF.
+PROFILES = {
+    ExportProfile.DEFAULT.value: {"codec": "libx264", "preset": "medium", "crf": None},
+    ExportProfile.FAST_PREVIEW.value: {
+        "codec": "libx264",
+        "preset": "ultrafast",
+        "crf": 28,
+    },
+    ExportProfile.WEB.value: {"codec": "libx264", "preset": "veryfast", "crf": 23},
+    ExportProfile.ARCHIVE.value: {"codec": "libx265", "preset": "slow", "crf": 20},
+}
+
+# The hardware encoders replacing the software ones
+HW_ENCODERS = {
+    HWAccel.VAAPI.value: {"libx264": "h264_vaapi", "libx265": "hevc_vaapi"},
+    HWAccel.QSV.value: {"libx264": "h264_qsv", "libx265": "hevc_qsv"},
+}
+
+
+@functools.lru_cache()
+def hw_available(hwaccel: str, codec: str) -> bool:
+    # Whether the hardware encoder works here, by encoding a few frames. ffmpeg
+    # may be built with an encoder whose device is missing.
+    if hwaccel == HWAccel.VAAPI.value and not os.path.exists(VAAPI_DEVICE):
+        return False
+    encoder = Encoder(codec=HW_ENCODERS[hwaccel][codec], hwaccel=hwaccel, crf=28)
+    cmd = (
+        ["ffmpeg", "-nostdin", "-hide_banner", "-loglevel", "error"]
+        + encoder.global_args()
+        + ["-f", "lavfi", "-i", "color=s=256x256:d=0.2"]
+        + (["-vf", ",".join(encoder.filters())] if encoder.filters() else [])
+        + encoder.output_args()
+        + ["-f", "null", "-"]
+    )
+    try:
+        return subprocess.run(cmd, capture_output=True, timeout=30).returncode == 0
+    except (OSError, subprocess.TimeoutExpired):
+        return False
+
+
+# The video encoder settings of the re-encoded outputs, usable by both moviepy
+# and ffmpeg
+class Encoder:
+    def __init__(
+        self,
+        codec: str = "libx264",
+        preset: str = "medium",
+        crf: Optional[int] = None,
+        bitrate: Optional[str] = None,
+        threads: int = 0,
+        hwaccel: str = HWAccel.NONE.value,
+    ):
+        self.codec = codec
+        self.preset = preset
+        self.crf = crf
+        self.bitrate = bitrate
+        self.threads = threads
+        self.hwaccel = hwaccel
+
+    @classmethod
+    def from_args(cls, args) -> "Encoder":
+        profile = getattr(args, "export_profile", ExportProfile.DEFAULT.value)
+        hwaccel = getattr(args, "hwaccel", HWAccel.NONE.value)
+        settings = PROFILES[profile]
+        codec = settings["codec"]
+        if hwaccel == HWAccel.AUTO.value:
+            hwaccel = next(
+                (h for h in HW_ENCODERS if hw_available(h, codec)), HWAccel.NONE.value
+            )
+        elif hwaccel != HWAccel.NONE.value and not hw_available(hwaccel, codec):
+            logging.warning(
+                f"{HW_ENCODERS[hwaccel][codec]} is not available, use {codec} instead"
+            )
+            hwaccel = HWAccel.NONE.value
+        if hwaccel != HWAccel.NONE.value:
+            codec = HW_ENCODERS[hwaccel][codec]
+        return cls(
+            codec=codec,
+            preset=settings["preset"],
+            crf=settings["crf"],
+            # The bitrate only applies without a CRF
+            bitrate=args.bitrate if settings["crf"] is None else None,
+            threads=getattr(args, "encoder_threads", 0),
+            hwaccel=hwaccel,
+        )
+
+    def global_args(self) -> List[str]:
+        if self.hwaccel == HWAccel.VAAPI.value:
+            return ["-vaapi_device", VAAPI_DEVICE]
+        return []
+
+    def filters(self) -> List[str]:
+        # The filters converting decoded frames into what the encoder takes
+        if self.hwaccel == HWAccel.VAAPI.value:
+            return ["format=nv12", "hwupload"]
+        if self.hwaccel == HWAccel.QSV.value:
+            return ["format=nv12"]
+        return ["format=yuv420p"]
+
+    def options(self) -> Dict[str, str]:
+        # The ffmpeg output options of the video stream, except the codec
+        opts = {}
+        if self.hwaccel == HWAccel.NONE.value:
+            opts["preset"] = self.preset
+            if self.crf is not None:
+                opts["crf"] = self.crf
+        elif self.crf is not None:
+            # The constant quality option of the hardware encoders
+            key = "qp" if self.hwaccel == HWAccel.VAAPI.value else "global_quality"
+            opts[key] = self.crf
+        if self.bitrate is not None:
+            opts["b:v"] = self.bitrate
+        if self.threads:
+            opts["threads"] = self.threads
+        return opts
+
+    def output_args(self) -> List[str]:
+        args = ["-c:v", self.codec]
+        for k, v in self.options().items():
+            args += [f"-{k}", str(v)]
+        return args
+
+    def moviepy_kwargs(self) -> dict:
+        # The arguments of write_videofile of moviepy. It pipes rgb24 frames
+        # into ffmpeg, so the filters are set by -vf.
+        opts = self.options()
+        params = self.global_args() + ["-vf", ",".join(self.filters())]
+        for k, v in opts.items():
+            if k not in ("preset", "b:v", "threads"):
+                params += [f"-{k}", str(v)]
+        return {
+            "codec": self.codec,
+            "preset": self.preset,
+            "bitrate": self.bitrate,
+            "threads": self.threads or None,
+            "ffmpeg_params": params,
+        }
+
+    def settings(self) -> dict:
+        # Everything affecting the encoded frames, the threads only change the
+        # speed
+        opts = {k: v for k, v in self.options().items() if k != "threads"}
+        return {"codec": self.codec, "filters": self.filters(), **opts}
+
+    def __str__(self):
+        opts = " ".join(f"{k}={v}" for k, v in self.options().items())
+        return f"{self.codec} {opts}".strip()
@@ -0,0 +1,161 @@
+import os
+import sqlite3
+import threading
+import time
+from typing import Dict, List, Optional
+
+DEFAULT_JOB_STORE = os.path.join(
+    os.path.expanduser("~"), ".cache", "autocut", "jobs.db"
+)
+
+# The stages of a media file in the daemon
+NEW = "new"  # to be transcribed
+FAILED = "failed"  # failed to transcribe, will retry later
+TRANSCRIBED = "transcribed"  # waiting for the markdown to be edited
+CUT = "cut"  # done
+
+COLUMNS = [
+    "file",
+    "folder",
+    "mtime_ns",
+    "size",
+    "stage",
+    "attempts",
+    "last_error",
+    "next_attempt",
+    "transcribe_seconds",
+    "cut_seconds",
+    "updated",
+]
+
+
+# Persist the stage of every media file handled by the daemon, so it resumes
+# after restarts without redoing finished work, and retries failures with
+# backoff
+class JobStore:
+    def __init__(
+        self, filename: str, retry_interval: float = 10, max_retry_interval: float = 600
+    ):
+        self.filename = filename
+        self.retry_interval = retry_interval
+        self.max_retry_interval = max_retry_interval
+        self._lock = threading.Lock()
+        if os.path.dirname(filename):
+            os.makedirs(os.path.dirname(filename), exist_ok=True)
+        self._db = sqlite3.connect(filename, check_same_thread=False)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            "file TEXT PRIMARY KEY, folder TEXT, mtime_ns INTEGER, size INTEGER, "
+            "stage TEXT, attempts INTEGER DEFAULT 0, last_error TEXT, next_attempt REAL, "
+            "transcribe_seconds REAL, cut_seconds REAL, updated REAL)"
+        )
+        self._db.execute(
+            "CREATE INDEX IF NOT EXISTS jobs_stage ON jobs (folder, stage)"
+        )
+        self._db.commit()
+
+    def get(self, fn: str) -> Optional[Dict]:
+        with self._lock:
+            row = self._db.execute(
+                f"SELECT {', '.join(COLUMNS)} FROM jobs WHERE file = ?",
+                (os.path.abspath(fn),),
+            ).fetchone()
+        return dict(zip(COLUMNS, row)) if row else None
+
+    def add(self, fn: str, mtime_ns: int, size: int) -> Dict:
+        # Return the job of fn, restart it from NEW if fn is new or changed.
+        # A failed job keeps waiting for its retry, e.g. a growing recording.
+        job = self.get(fn)
+        if job and job["mtime_ns"] == mtime_ns and job["size"] == size:
+            return job
+        if job and job["stage"] == FAILED:
+            self._set(fn, mtime_ns=mtime_ns, size=size)
+            return self.get(fn)
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO jobs (file, folder, mtime_ns, size, stage, "
+                "attempts, updated) VALUES (?, ?, ?, ?, ?, 0, ?)",
+                (
+                    os.path.abspath(fn),
+                    os.path.dirname(os.path.abspath(fn)),
+                    mtime_ns,
+                    size,
+                    NEW,
+                    time.time(),
+                ),
+            )
+            self._db.commit()
+        return self.get(fn)
+
+    def remove(self, fn: str):
+        with self._lock:
+            self._db.execute("DELETE FROM jobs WHERE file = ?", (os.path.abspath(fn),))
+            self._db.commit()
+
+    def _set(self, fn: str, **values):
+        values["updated"] = time.time()
+        with self._lock:
+            self._db.execute(
+                f"UPDATE jobs SET {', '.join(k + ' = ?' for k in values)} "
+                "WHERE file = ?",
+                (*values.values(), os.path.abspath(fn)),
+            )
+            self._db.commit()
+
+    def transcribed(self, fn: str, seconds: float):
+        self._set(fn, stage=TRANSCRIBED, transcribe_seconds=seconds, last_error=None)
+
+    def cut(self, fn: str, seconds: float):
+        self._set(fn, stage=CUT, cut_seconds=seconds)
+
+    def error(self, fn: str, error: str):
+        # Record an error without changing the stage, e.g. failed to cut
+        self._set(fn, last_error=error)
+
+    def failed(self, fn: str, error: str):
+        # Retry with exponential backoff
+        attempts = (self.get(fn) or {}).get("attempts") or 0
+        delay = min(self.retry_interval * 2**attempts, self.max_retry_interval)
+        self._set(
+            fn,
+            stage=FAILED,
+            attempts=attempts + 1,
+            last_error=error,
+            next_attempt=time.time() + delay,
+        )
+
+    def retrying(self, fn: str):
+        # A failed file being retried, not due again until it fails again
+        self._set(fn, next_attempt=None)
+
+    def due(self, folder: str) -> List[str]:
+        # The failed files in folder to retry now
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT file FROM jobs WHERE folder = ? AND stage = ? "
+                "AND next_attempt <= ?",
+                (os.path.abspath(folder), FAILED, time.time()),
+            ).fetchall()
+        return [r[0] for r in rows]
+
+    def next_retry(self, folder: str) -> Optional[float]:
+        # Seconds until the next failed file in folder can be retried
+        with self._lock:
+            (t,) = self._db.execute(
+                "SELECT MIN(next_attempt) FROM jobs WHERE folder = ? AND stage = ?",
+                (os.path.abspath(folder), FAILED),
+            ).fetchone()
+        return None if t is None else max(0, t - time.time())
+
+    def counts(self, folder: str) -> Dict[str, int]:
+        # Number of files in folder in each stage
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT stage, COUNT(*) FROM jobs WHERE folder = ? GROUP BY stage",
+                (os.path.abspath(folder),),
+            ).fetchall()
+        return dict(rows)
+
+    def close(self):
+        with self._lock:
+            self._db.close()
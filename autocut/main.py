@@ -3,7 +3,9 @@ import logging
 import os
 
 from . import utils
-from .type import WhisperMode, WhisperModel
+from .cache import DEFAULT_RENDER_CACHE, DEFAULT_TRANSCRIBE_CACHE
+from .jobs import DEFAULT_JOB_STORE
+from .type import CutEngine, ExportProfile, HWAccel, WhisperMode, WhisperModel
 
 
 def main():
@@ -36,6 +38,42 @@ def main():
         help="Monitor a folder to transcribe and cut",
         action=argparse.BooleanOptionalAction,
     )
+    parser.add_argument(
+        "--job-store",
+        type=str,
+        default=DEFAULT_JOB_STORE,
+        help="The SQLite file keeping the progress of the files in the monitored "
+        "folder, so the daemon resumes after restarts",
+    )
+    parser.add_argument(
+        "--transcribe-workers",
+        type=int,
+        default=1,
+        help="Number of files the daemon transcribes at the same time. They share "
+        "the model, a whisper model transcribes one file at a time while the others "
+        "decode and detect speeches",
+    )
+    parser.add_argument(
+        "--cut-workers",
+        type=int,
+        default=0,
+        help="Number of files the daemon cuts or merges at the same time, 0 to "
+        "use a quarter of the CPU cores",
+    )
+    parser.add_argument(
+        "--stable-seconds",
+        type=float,
+        default=10,
+        help="The daemon transcribes a file after it is unchanged for this many "
+        "seconds, and has no sidecar .lock file, e.g. video.mp4.lock",
+    )
+    parser.add_argument(
+        "--live-interval",
+        type=float,
+        default=60,
+        help="Transcribe the recorded part of a growing file every this many "
+        "seconds in the daemon, 0 to wait until it is completely written",
+    )
     parser.add_argument(
         "-s",
         help="Convert .srt to a compact format for easier editing",
@@ -126,9 +164,9 @@ def main():
         "--openai-rpm",
         type=int,
         default=3,
-        choices=[3, 50],
         help="Openai Whisper API REQUESTS PER MINUTE(FREE USERS: 3RPM; PAID USERS: 50RPM). "
-        "More info: https://platform.openai.com/docs/guides/rate-limits/overview",
+        "The requests are sent concurrently within it, and retried with backoff when "
+        "rate limited. More info: https://platform.openai.com/docs/guides/rate-limits/overview",
     )
     parser.add_argument(
         "--whisper-model",
@@ -137,12 +175,147 @@ def main():
         choices=WhisperModel.get_values(),
         help="The whisper model used to transcribe.",
     )
+    parser.add_argument(
+        "--compute-type",
+        type=str,
+        default="default",
+        help="The quantization type of faster-whisper models, such as int8, float16 "
+        "or int8_float16.",
+    )
+    parser.add_argument(
+        "--cpu-threads",
+        type=int,
+        default=0,
+        help="Number of threads per worker when transcribing on CPU, 0 to choose "
+        "automatically.",
+    )
+    parser.add_argument(
+        "--num-workers",
+        type=int,
+        default=0,
+        help="Number of parallel workers when transcribing on CPU. whisper starts "
+        "a process with its own model per worker, 0 to transcribe in this process. "
+        "faster-whisper uses them as threads to transcribe segments concurrently, "
+        "0 to fill the cores with --cpu-threads threads per worker.",
+    )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=1,
+        help="Number of speech clips decoded in a batch by faster-whisper, "
+        "1 to transcribe segments one by one.",
+    )
+    parser.add_argument(
+        "--pack-segments",
+        help="Pack neighbouring speech segments into 30 sec windows before transcribing",
+        action=argparse.BooleanOptionalAction,
+        default=True,
+    )
+    parser.add_argument(
+        "--stream-vad",
+        help="Detect speeches while decoding the audio, and transcribe the "
+        "detected ones meanwhile",
+        action=argparse.BooleanOptionalAction,
+        default=True,
+    )
+    parser.add_argument(
+        "--prefetch",
+        type=int,
+        default=1,
+        help="Number of inputs decoded ahead while the model transcribes the "
+        "current one",
+    )
+    parser.add_argument(
+        "--transcribe-cache",
+        type=str,
+        default=DEFAULT_TRANSCRIBE_CACHE,
+        help="The SQLite file caching transcription results by the audio hash and "
+        "model settings, so unchanged audio is not transcribed again.",
+    )
+    parser.add_argument(
+        "--transcribe-cache-size",
+        type=int,
+        default=512,
+        help="The max size of the transcribe cache in MB, 0 to disable the cache.",
+    )
     parser.add_argument(
         "--bitrate",
         type=str,
         default="10m",
         help="The bitrate to export the cutted video, such as 10m, 1m, or 500k",
     )
+    parser.add_argument(
+        "--preview",
+        help="Render the cut into a low resolution *_preview.mp4 by fast encoding "
+        "to check the edit, and overwrite it every time",
+        action=argparse.BooleanOptionalAction,
+    )
+    parser.add_argument(
+        "--preview-height",
+        type=int,
+        default=360,
+        help="The height of the preview video",
+    )
+    parser.add_argument(
+        "--export-profile",
+        type=str,
+        default=ExportProfile.DEFAULT.value,
+        choices=ExportProfile.get_values(),
+        help="The encoder settings of the re-encoded videos: default: libx264 at "
+        "--bitrate; fast-preview: libx264 ultrafast, CRF 28; web: libx264 veryfast, "
+        "CRF 23; archive: libx265 slow, CRF 20.",
+    )
+    parser.add_argument(
+        "--encoder-threads",
+        type=int,
+        default=0,
+        help="The number of threads of the video encoder, 0 to let ffmpeg decide.",
+    )
+    parser.add_argument(
+        "--hwaccel",
+        type=str,
+        default=HWAccel.NONE.value,
+        choices=HWAccel.get_values(),
+        help="Encode by VAAPI or QSV instead of the profile's software encoder, "
+        "auto to use whichever works here. Fall back to software if unavailable.",
+    )
+    parser.add_argument(
+        "--cut-engine",
+        type=str,
+        default=CutEngine.MOVIEPY.value,
+        choices=CutEngine.get_values(),
+        help="The engine to export the cutted media: moviepy: decode and re-encode "
+        "every frame; ffmpeg-copy: stream copy and only re-encode the partial GOPs "
+        "at the segment boundaries, which is much faster but skips audio normalization; "
+        "ffmpeg: re-encode every segment by ffmpeg with --export-profile and cache "
+        "them, so cutting again only encodes the changed segments.",
+    )
+    parser.add_argument(
+        "--encode-jobs",
+        type=int,
+        default=0,
+        help="The number of segments the ffmpeg and ffmpeg-copy cut engines encode "
+        "at the same time, 0 to split the cores among them.",
+    )
+    parser.add_argument(
+        "--render-cache",
+        type=str,
+        default=DEFAULT_RENDER_CACHE,
+        help="The folder caching the segments encoded by the ffmpeg cut engine.",
+    )
+    parser.add_argument(
+        "--render-cache-size",
+        type=int,
+        default=2048,
+        help="The max size of the render cache in MB, 0 to disable the cache.",
+    )
+    parser.add_argument(
+        "--audio-cache-dir",
+        type=str,
+        default=None,
+        help="Decode audio into this folder and memory map it, so the peak memory "
+        "doesn't grow with the input duration.",
+    )
     parser.add_argument(
         "--vad", help="If or not use VAD", choices=["1", "0", "auto"], default="auto"
     )
@@ -0,0 +1,176 @@
+import asyncio
+import logging
+import os
+import random
+import threading
+import time
+from typing import Callable, List, Optional, Tuple
+
+DEFAULT_BASE_URL = "https://api.openai.com/v1"
+
+
+def api_key() -> Optional[str]:
+    # The key from OPENAI_API_KEY, or the file at OPENAI_API_KEY_PATH
+    key = os.environ.get("OPENAI_API_KEY")
+    if key is None and os.environ.get("OPENAI_API_KEY_PATH"):
+        with open(os.environ["OPENAI_API_KEY_PATH"]) as f:
+            key = f.read().strip()
+    return key
+
+
+# Allow rate requests per period on average, with bursts up to capacity. A
+# request takes a token, or reserves the next one to come, so it is shared by
+# the event loops of every call and the threads running them.
+class TokenBucket:
+    def __init__(self, rate: float, period: float = 60, capacity: float = 1):
+        self.rate = rate
+        self.interval = period / rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self) -> float:
+        # Take a token, return the seconds to wait until it is available
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(
+                self.capacity, self.tokens + (now - self.updated) / self.interval
+            )
+            self.updated = now
+            self.tokens -= 1
+            return max(0.0, -self.tokens * self.interval)
+
+    async def acquire(self):
+        delay = self.reserve()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+class APIError(Exception):
+    pass
+
+
+# Send the transcription requests concurrently over a pool of kept-alive
+# connections, within the requests per minute, and retry the rate limited and
+# server errors with jittered exponential backoff
+class OpenAIClient:
+    def __init__(
+        self,
+        key: str,
+        rpm: int,
+        base_url: str = None,
+        model: str = "whisper-1",
+        max_connections: int = 8,
+        max_retries: int = 5,
+        backoff: float = 1,
+        max_backoff: float = 60,
+        timeout: float = 300,
+    ):
+        self.key = key
+        self.rpm = rpm
+        self.base_url = (
+            base_url
+            or os.environ.get("OPENAI_BASE_URL")
+            or os.environ.get("OPENAI_API_BASE")
+            or DEFAULT_BASE_URL
+        ).rstrip("/")
+        self.model = model
+        self.max_connections = max_connections
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.timeout = timeout
+        # Kept for the whole process, so the requests of all the inputs are
+        # within the rpm
+        self.bucket = TokenBucket(rpm)
+        self._bucket_lock = threading.Lock()
+
+    def transcribe_all(
+        self,
+        files: List[Tuple[str, bytes]],
+        prompt: str,
+        lang: str,
+        callback: Callable[[], None] = None,
+    ) -> List[str]:
+        # Transcribe [(filename, data)] into srt texts in the same order,
+        # callback is called once a file is done
+        return asyncio.run(self._transcribe_all(files, prompt, lang, callback))
+
+    async def _transcribe_all(self, files, prompt, lang, callback):
+        import httpx
+
+        with self._bucket_lock:
+            if self.bucket.rate != self.rpm:
+                self.bucket = TokenBucket(self.rpm)
+            bucket = self.bucket
+        # More connections than requests per minute don't help
+        connections = max(1, min(self.max_connections, self.rpm))
+        limits = httpx.Limits(
+            max_connections=connections, max_keepalive_connections=connections
+        )
+        semaphore = asyncio.Semaphore(connections)
+        async with httpx.AsyncClient(
+            base_url=self.base_url,
+            headers={"Authorization": f"Bearer {self.key}"},
+            limits=limits,
+            timeout=self.timeout,
+        ) as client:
+
+            async def transcribe(filename, data):
+                async with semaphore:
+                    text = await self._transcribe(
+                        client, bucket, filename, data, prompt, lang
+                    )
+                if callback is not None:
+                    callback()
+                return text
+
+            return await asyncio.gather(
+                *[transcribe(filename, data) for filename, data in files]
+            )
+
+    async def _transcribe(self, client, bucket, filename, data, prompt, lang):
+        import httpx
+
+        form = {"model": self.model, "response_format": "srt"}
+        if prompt:
+            form["prompt"] = prompt
+        if lang:
+            form["language"] = lang
+        for attempt in range(self.max_retries + 1):
+            await bucket.acquire()
+            try:
+                r = await client.post(
+                    "/audio/transcriptions",
+                    data=form,
+                    files={"file": (filename, data)},
+                )
+            except httpx.TransportError as e:
+                error = repr(e)
+                retry_after = None
+            else:
+                if r.status_code == 200:
+                    return r.text
+                error = f"{r.status_code} {r.text[:200]}"
+                if r.status_code != 429 and r.status_code < 500:
+                    raise APIError(f"Failed to transcribe {filename}: {error}")
+                retry_after = r.headers.get("retry-after")
+            if attempt == self.max_retries:
+                break
+            # Full jitter, so the concurrent requests don't retry together
+            delay = random.uniform(0, min(self.max_backoff, self.backoff * 2**attempt))
+            if retry_after is not None:
+                try:
+                    delay = max(delay, float(retry_after))
+                except ValueError:
+                    pass
+            logging.info(
+                f"Retry {filename} in {delay:.1f} sec after {error}, "
+                f"attempt {attempt + 1}"
+            )
+            await asyncio.sleep(delay)
+        raise APIError(
+            f"Failed to transcribe {filename} after {self.max_retries + 1} attempts: "
+            f"{error}"
+        )
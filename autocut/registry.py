@@ -0,0 +1,183 @@
+import collections
+import contextlib
+import logging
+import threading
+import time
+import weakref
+from typing import Callable, Hashable, Tuple, Union
+
+from . import whisper_model
+from .type import WhisperMode
+
+
+# Load models once per process and share them between Transcribe instances,
+# e.g. the files of a daemon folder or the GUI threads.
+class ModelRegistry:
+    def __init__(self, capacity: int = 2):
+        self.capacity = capacity
+        self._models = collections.OrderedDict()
+        self._lock = threading.RLock()
+
+    def get(self, key: Hashable, factory: Callable):
+        # Return the model of key, call factory to load it if not loaded yet
+        with self._lock:
+            if key in self._models:
+                self._models.move_to_end(key)
+                return self._models[key]
+            tic = time.time()
+            model = factory()
+            logging.info(f"Loaded model {key} in {time.time() - tic:.1f} sec")
+            self._models[key] = model
+            while len(self._models) > max(self.capacity, 1):
+                old_key, old_model = self._models.popitem(last=False)
+                logging.info(f"Evicted model {old_key}")
+                if hasattr(old_model, "close"):
+                    old_model.close()
+                _release_device_memory()
+            return model
+
+    def keys(self):
+        with self._lock:
+            return list(self._models.keys())
+
+    def clear(self):
+        with self._lock:
+            for model in self._models.values():
+                if hasattr(model, "close"):
+                    model.close()
+            self._models.clear()
+            _release_device_memory()
+
+
+def _release_device_memory():
+    try:
+        import torch
+    except ImportError:
+        return
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
+
+
+registry = ModelRegistry()
+# {model: the lock to use it}
+_model_locks = weakref.WeakKeyDictionary()
+_model_locks_lock = threading.Lock()
+
+
+def model_lock(model):
+    # The lock to hold while using a shared model from several threads, e.g.
+    # the workers of the daemon. Whisper installs kv-cache hooks on the model
+    # and silero VAD keeps states between chunks, so they are used one at a
+    # time. The models marked thread_safe are not locked.
+    if getattr(model, "thread_safe", False):
+        return contextlib.nullcontext()
+    with _model_locks_lock:
+        return _model_locks.setdefault(model, threading.Lock())
+
+
+# The VAD model is tiny, keep it out of the whisper models' LRU
+_vad_registry = ModelRegistry(capacity=1)
+
+
+def whisper_model_key(
+    mode: str,
+    model_name: str,
+    device: Union[str, None] = None,
+    compute_type: str = "default",
+    cpu_threads: int = 0,
+    num_workers: int = 0,
+) -> Tuple:
+    if mode == WhisperMode.OPENAI.value:
+        return (mode, "whisper-1", None, None)
+    return (mode, model_name, device, compute_type, cpu_threads, num_workers)
+
+
+def get_whisper_model(
+    mode: str,
+    model_name: str,
+    device: Union[str, None] = None,
+    compute_type: str = "default",
+    sample_rate: int = 16000,
+    openai_rpm: int = 3,
+    cpu_threads: int = 0,
+    num_workers: int = 0,
+    batch_size: int = 1,
+) -> whisper_model.AbstractWhisperModel:
+    def load():
+        if mode == WhisperMode.WHISPER.value:
+            model = whisper_model.WhisperModel(sample_rate)
+            model.load(model_name, device, cpu_threads, num_workers)
+        elif mode == WhisperMode.OPENAI.value:
+            model = whisper_model.OpenAIModel(openai_rpm, sample_rate)
+            model.load()
+        elif mode == WhisperMode.FASTER.value:
+            model = whisper_model.FasterWhisperModel(sample_rate)
+            model.load(model_name, device, compute_type, cpu_threads, num_workers)
+        else:
+            raise ValueError(f"Unknown whisper mode {mode}")
+        return model
+
+    model = registry.get(
+        whisper_model_key(
+            mode, model_name, device, compute_type, cpu_threads, num_workers
+        ),
+        load,
+    )
+    # Settings that don't need to reload the model
+    if mode == WhisperMode.OPENAI.value:
+        model.rpm = openai_rpm
+    elif mode == WhisperMode.FASTER.value:
+        model.batch_size = batch_size
+    return model
+
+
+def get_vad_model():
+    # Return the silero VAD model and its detect speech function
+    def load():
+        import torch
+
+        # torch load limit https://github.com/pytorch/vision/issues/4156
+        torch.hub._validate_not_a_forked_repo = lambda a, b, c: True
+        vad_model, funcs = torch.hub.load(
+            repo_or_dir="snakers4/silero-vad", model="silero_vad", trust_repo=True
+        )
+        return vad_model, funcs[0]
+
+    return _vad_registry.get("silero_vad", load)
+
+
+def warm_up(
+    mode: str,
+    model_name: str,
+    device: Union[str, None] = None,
+    compute_type: str = "default",
+    vad: bool = True,
+    openai_rpm: int = 3,
+    cpu_threads: int = 0,
+    num_workers: int = 0,
+):
+    # Load the models ahead, so the first transcription only pays inference
+    get_whisper_model(
+        mode,
+        model_name,
+        device,
+        compute_type,
+        openai_rpm=openai_rpm,
+        cpu_threads=cpu_threads,
+        num_workers=num_workers,
+    )
+    if vad:
+        get_vad_model()
+
+
+def warm_up_from_args(args):
+    warm_up(
+        args.whisper_mode,
+        args.whisper_model,
+        args.device,
+        args.compute_type,
+        vad=args.vad != "0",
+        openai_rpm=args.openai_rpm,
+        cpu_threads=args.cpu_threads,
+        num_workers=args.num_workers,
+    )
@@ -0,0 +1,451 @@
+import bisect
+import copy
+import functools
+import logging
+import os
+import re
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List, Optional, Tuple
+
+import ffmpeg
+
+from . import utils
+from .cache import RenderCache
+from .encoder import Encoder
+from .type import SPEECH_ARRAY_INDEX
+
+FFMPEG_CMD = ["ffmpeg", "-nostdin"]
+
+# Encoders used to re-encode the partial GOPs at segment boundaries, so the
+# results can be concatenated with stream-copied packets of the same codec
+VIDEO_ENCODERS = {"h264": "libx264", "hevc": "libx265"}
+AUDIO_ENCODERS = {"aac": "aac", "mp3": "libmp3lame", "opus": "libopus"}
+
+
+def probe(filename: str, **kwargs) -> dict:
+    try:
+        return ffmpeg.probe(filename, **kwargs)
+    except ffmpeg.Error as e:
+        raise RuntimeError(f"Failed to probe {filename}: {e.stderr.decode()}") from e
+
+
+def get_stream(info: dict, codec_type: str):
+    # The first stream of a codec type, e.g. video or audio
+    for s in info["streams"]:
+        if s["codec_type"] == codec_type:
+            return s
+    return None
+
+
+def frame_duration(video_stream: dict) -> float:
+    num, den = video_stream.get("avg_frame_rate", "0/0").split("/")
+    if float(num) <= 0 or float(den) <= 0:
+        num, den = video_stream.get("r_frame_rate", "25/1").split("/")
+    return float(den) / float(num)
+
+
+def keyframes(filename: str) -> List[float]:
+    # Read the presentation time of keyframes from the packet flags, which
+    # doesn't need to decode any frame
+    info = probe(filename, select_streams="v:0", show_entries="packet=pts_time,flags")
+    return sorted(
+        float(p["pts_time"])
+        for p in info.get("packets", [])
+        if "K" in p.get("flags", "") and p.get("pts_time", "N/A") != "N/A"
+    )
+
+
+def can_stream_copy(filename: str) -> bool:
+    # Whether the media can be cut by ffmpeg with stream copy into our outputs
+    info = probe(filename)
+    video = get_stream(info, "video")
+    audio = get_stream(info, "audio")
+    if video is None:
+        return audio is not None
+    return video["codec_name"] in VIDEO_ENCODERS and (
+        audio is None or audio["codec_name"] in AUDIO_ENCODERS
+    )
+
+
+def plan_pieces(
+    segments: List[SPEECH_ARRAY_INDEX], kfs: List[float], min_edge: float
+) -> List[Tuple[str, float, float]]:
+    # Split each segment into an "encode" piece from its start to the first
+    # keyframe, a "copy" piece of the whole GOPs until the last keyframe, and
+    # an "encode" piece from there to its end. A stream copy can't stop inside
+    # a GOP, the reordered frames would pass the end. Edges shorter than
+    # min_edge are dropped.
+    pieces = []
+    for s in segments:
+        start, end = s["start"], s["end"]
+        i = bisect.bisect_left(kfs, start)
+        j = bisect.bisect_right(kfs, end) - 1
+        if i > j or kfs[i] >= end:
+            # No keyframe inside, the whole segment needs to be encoded
+            pieces.append(("encode", start, end))
+            continue
+        if kfs[i] - start >= min_edge:
+            pieces.append(("encode", start, kfs[i]))
+        if kfs[j] > kfs[i]:
+            pieces.append(("copy", kfs[i], kfs[j]))
+        if end - kfs[j] >= min_edge:
+            pieces.append(("encode", kfs[j], end))
+    return pieces
+
+
+def run_all(jobs: List[Callable[[], None]], num_jobs: int):
+    # Run the jobs concurrently, every job waits for its own ffmpeg process,
+    # so threads are enough to keep the cores busy
+    if num_jobs <= 1 or len(jobs) <= 1:
+        for job in jobs:
+            job()
+        return
+    with ThreadPoolExecutor(min(num_jobs, len(jobs))) as pool:
+        for future in [pool.submit(job) for job in jobs]:
+            future.result()
+
+
+def run(stream):
+    try:
+        stream.run(
+            cmd=FFMPEG_CMD,
+            capture_stdout=True,
+            capture_stderr=True,
+            overwrite_output=True,
+        )
+    except ffmpeg.Error as e:
+        raise RuntimeError(f"ffmpeg failed: {e.stderr.decode()}") from e
+
+
+def concat(filenames: List[str], output_fn: str, **kwargs):
+    # Concatenate files with the same codec parameters by the concat demuxer
+    list_fn = output_fn + ".ffconcat"
+    with open(list_fn, "w", encoding="utf-8") as f:
+        f.write("ffconcat version 1.0\n")
+        for fn in filenames:
+            fn = os.path.abspath(fn).replace("'", "'\\''")
+            f.write(f"file '{fn}'\n")
+    try:
+        run(
+            ffmpeg.input(list_fn, f="concat", safe=0).output(
+                output_fn, c="copy", **kwargs
+            )
+        )
+    finally:
+        os.remove(list_fn)
+
+
+def _cut_piece(media_fn, kind, start, num_frames, frame, output_fn, video, audio):
+    # Exactly num_frames frames from start. A "copy" piece starts at a keyframe
+    # and is whole GOPs, whose frames are the first ones in decoding order as
+    # well. The audio is always encoded, the copied packets would start before
+    # the keyframe, which the concat demuxer doesn't discard.
+    kwargs = {"frames:v": num_frames}
+    if kind == "copy":
+        kwargs["vcodec"] = "copy"
+    else:
+        kwargs.update(
+            vcodec=VIDEO_ENCODERS[video["codec_name"]],
+            pix_fmt=video["pix_fmt"],
+            crf=18,
+        )
+    if audio is not None:
+        kwargs.update(
+            acodec=AUDIO_ENCODERS[audio["codec_name"]],
+            ar=audio["sample_rate"],
+            ac=audio["channels"],
+        )
+    run(
+        ffmpeg.input(media_fn, ss=start, t=num_frames * frame).output(
+            output_fn, **kwargs
+        )
+    )
+
+
+def cut_video(
+    media_fn: str,
+    segments: List[SPEECH_ARRAY_INDEX],
+    output_fn: str,
+    num_jobs: int = 1,
+):
+    info = probe(media_fn)
+    video = get_stream(info, "video")
+    audio = get_stream(info, "audio")
+    kfs = keyframes(media_fn)
+    frame = frame_duration(video)
+    pieces = plan_pieces(segments, kfs, frame)
+    num_encoded = sum(1 for p in pieces if p[0] == "encode")
+    logging.info(
+        f"Cut {len(segments)} segments into {len(pieces)} pieces, "
+        f"{num_encoded} of them are re-encoded at the boundaries"
+    )
+
+    output_dir = os.path.dirname(os.path.abspath(output_fn))
+    with tempfile.TemporaryDirectory(prefix="autocut_", dir=output_dir) as tmp:
+        piece_fns = []
+        jobs = []
+        for i, (kind, start, end) in enumerate(pieces):
+            fn = os.path.join(tmp, f"{i:05d}.mp4")
+            # Whole frames, so every piece ends where the next one starts. The
+            # keyframe times of ffprobe are rounded to microseconds, which seek
+            # to the same keyframe.
+            num_frames = max(1, round((end - start) / frame))
+            jobs.append(
+                functools.partial(
+                    _cut_piece,
+                    media_fn,
+                    kind,
+                    start,
+                    num_frames,
+                    frame,
+                    fn,
+                    video,
+                    audio,
+                )
+            )
+            piece_fns.append(fn)
+        run_all(jobs, num_jobs)
+        concat(piece_fns, output_fn, movflags="+faststart")
+
+
+def max_volume(media_fn: str) -> float:
+    # The peak volume of the first audio stream in dB
+    try:
+        _, err = (
+            ffmpeg.input(media_fn)
+            .audio.filter("volumedetect")
+            .output("-", f="null")
+            .run(cmd=FFMPEG_CMD, capture_stdout=True, capture_stderr=True)
+        )
+    except ffmpeg.Error as e:
+        raise RuntimeError(f"ffmpeg failed: {e.stderr.decode()}") from e
+    m = re.search(r"max_volume: (-?[\d.]+) dB", err.decode(errors="replace"))
+    return float(m.group(1)) if m else 0.0
+
+
+def _encode_segment(media_fn, start, end, output_fn, encoder, gain):
+    media = ffmpeg.input(media_fn, ss=start, t=end - start)
+    video = media.video
+    for f in encoder.filters():
+        video = video.filter(*f.split("=", 1))
+    streams = [video]
+    if gain is not None:
+        streams.append(
+            media.audio.filter("volume", f"{gain}dB").filter(
+                "aformat", sample_rates=44100, channel_layouts="stereo"
+            )
+        )
+    run(
+        ffmpeg.output(
+            *streams,
+            output_fn,
+            vcodec=encoder.codec,
+            acodec="aac",
+            **encoder.options(),
+        ).global_args(*encoder.global_args())
+    )
+
+
+def encode_video(
+    media_fn: str,
+    segments: List[SPEECH_ARRAY_INDEX],
+    output_fn: str,
+    encoder: Encoder,
+    cache: Optional[RenderCache] = None,
+    num_jobs: int = 0,
+):
+    # Re-encode every segment separately and concatenate them by stream copy.
+    # With a cache, only the segments not encoded before are encoded. The
+    # segments are encoded by num_jobs ffmpeg processes at the same time, 0 to
+    # split the cores among them.
+    threads, num_jobs = utils.cpu_parallelism(encoder.threads, num_jobs)
+    encoder = copy.copy(encoder)
+    encoder.threads = threads
+    source = RenderCache.fingerprint(media_fn) if cache else None
+    has_audio = get_stream(probe(media_fn), "audio") is not None
+    gain = None
+    if has_audio:
+        # Normalize by the peak of the whole source, so the gain doesn't change
+        # with the segments selected
+        volume = cache.get_json(source) if cache else None
+        if volume is None:
+            volume = {"max_volume": max_volume(media_fn)}
+            if cache:
+                cache.put_json(source, volume)
+        gain = -volume["max_volume"]
+    settings = {"encoder": encoder.settings(), "gain": gain}
+
+    output_dir = os.path.dirname(os.path.abspath(output_fn))
+    with tempfile.TemporaryDirectory(prefix="autocut_", dir=output_dir) as tmp:
+        piece_fns = []
+        jobs = []
+
+        def encode(i, s, key):
+            fn = os.path.join(tmp, f"{i:05d}.mp4")
+            _encode_segment(media_fn, s["start"], s["end"], fn, encoder, gain)
+            piece_fns[i] = cache.put(key, fn) if cache else fn
+
+        for i, s in enumerate(segments):
+            fn = key = None
+            if cache:
+                key = RenderCache.key(source, s["start"], s["end"], settings)
+                fn = cache.get(key)
+            if fn is None:
+                jobs.append(functools.partial(encode, i, s, key))
+            piece_fns.append(fn)
+        logging.info(
+            f"Encode {len(jobs)} of {len(segments)} segments by {num_jobs} jobs of "
+            f"{encoder}"
+        )
+        try:
+            run_all(jobs, num_jobs)
+            concat(piece_fns, output_fn, movflags="+faststart")
+        finally:
+            if cache:
+                # Unpin after the concat, any worker may evict them from now
+                cache.release([fn for fn in piece_fns if fn is not None])
+    if cache:
+        logging.info(f"Render cache: {cache.stats()}")
+        cache.evict()
+
+
+def preview_video(
+    media_fn: str,
+    segments: List[SPEECH_ARRAY_INDEX],
+    output_fn: str,
+    height: int,
+    encoder: Encoder,
+):
+    # Render the segments at a low resolution for checking the edit. The concat
+    # demuxer seeks to every segment, so only the kept frames are decoded.
+    has_audio = get_stream(probe(media_fn), "audio") is not None
+    list_fn = output_fn + ".ffconcat"
+    media_fn = os.path.abspath(media_fn).replace("'", "'\\''")
+    with open(list_fn, "w", encoding="utf-8") as f:
+        f.write("ffconcat version 1.0\n")
+        for s in segments:
+            f.write(f"file '{media_fn}'\ninpoint {s['start']}\noutpoint {s['end']}\n")
+    media = ffmpeg.input(list_fn, f="concat", safe=0)
+    video = media.video.filter("scale", -2, height)
+    for f in encoder.filters():
+        video = video.filter(*f.split("=", 1))
+    streams = [video, media.audio] if has_audio else [video]
+    try:
+        run(
+            ffmpeg.output(
+                *streams,
+                output_fn,
+                vcodec=encoder.codec,
+                acodec="aac",
+                movflags="+faststart",
+                **encoder.options(),
+            ).global_args(*encoder.global_args())
+        )
+    finally:
+        os.remove(list_fn)
+
+
+def cut_audio(
+    media_fn: str, segments: List[SPEECH_ARRAY_INDEX], output_fn: str, bitrate: str
+):
+    audio = get_stream(probe(media_fn), "audio")
+    if audio["codec_name"] == "mp3" and output_fn.lower().endswith(".mp3"):
+        # Every mp3 frame can be decoded independently, copy them directly
+        output_dir = os.path.dirname(os.path.abspath(output_fn))
+        with tempfile.TemporaryDirectory(prefix="autocut_", dir=output_dir) as tmp:
+            piece_fns = []
+            for i, s in enumerate(segments):
+                fn = os.path.join(tmp, f"{i:05d}.mp3")
+                run(
+                    ffmpeg.input(
+                        media_fn, ss=s["start"], t=s["end"] - s["start"]
+                    ).output(fn, c="copy", avoid_negative_ts="make_zero")
+                )
+                piece_fns.append(fn)
+            concat(piece_fns, output_fn)
+        return
+
+    # Decoding audio is cheap, trim and encode by a single ffmpeg invocation
+    media = ffmpeg.input(media_fn)
+    clips = [
+        media.audio.filter("atrim", start=s["start"], end=s["end"]).filter(
+            "asetpts", "PTS-STARTPTS"
+        )
+        for s in segments
+    ]
+    run(
+        ffmpeg.concat(*clips, v=0, a=1).output(
+            output_fn, acodec="libmp3lame", ar=44100, audio_bitrate=bitrate
+        )
+    )
+
+
+def concat_params(info: dict) -> tuple:
+    # The codec parameters that must match to concatenate by stream copy
+    video = get_stream(info, "video")
+    audio = get_stream(info, "audio")
+    video_keys = ["codec_name", "profile", "width", "height", "pix_fmt"]
+    audio_keys = ["codec_name", "profile", "sample_rate", "channels"]
+    return (
+        (
+            None
+            if video is None
+            else tuple(video.get(k) for k in video_keys) + (frame_duration(video),)
+        ),
+        None if audio is None else tuple(audio.get(k) for k in audio_keys),
+    )
+
+
+def merge_videos(filenames: List[str], output_fn: str, encoder: Encoder):
+    infos = [probe(fn) for fn in filenames]
+    params = [concat_params(info) for info in infos]
+    dur = sum(float(info["format"]["duration"]) for info in infos)
+    logging.info(f"Merging into a video with {dur / 60:.1f} min length")
+    if params[0][0] is not None and all(p == params[0] for p in params):
+        # e.g. all cut by us from the same camera
+        logging.info(f"Merge {len(filenames)} videos by stream copy")
+        concat(filenames, output_fn, movflags="+faststart")
+        return
+
+    # Re-encode by a single ffmpeg invocation, every video is scaled and padded
+    # to the size and frame rate of the first one
+    logging.info(f"Merge {len(filenames)} videos with different codecs by re-encoding")
+    first = get_stream(infos[0], "video")
+    width, height = first["width"], first["height"]
+    fps = 1 / frame_duration(first)
+    streams = []
+    for fn, info in zip(filenames, infos):
+        media = ffmpeg.input(fn)
+        streams.append(
+            media.video.filter(
+                "scale", width, height, force_original_aspect_ratio="decrease"
+            )
+            .filter("pad", width, height, "(ow-iw)/2", "(oh-ih)/2")
+            .filter("setsar", 1)
+            .filter("fps", fps)
+        )
+        for f in encoder.filters():
+            streams[-1] = streams[-1].filter(*f.split("=", 1))
+        if get_stream(info, "audio") is not None:
+            a = media.audio
+        else:
+            # Silence for the videos without audio, concat needs every stream
+            a = ffmpeg.input(
+                "anullsrc", f="lavfi", t=float(info["format"]["duration"])
+            ).audio
+        streams.append(
+            a.filter("aformat", sample_rates=44100, channel_layouts="stereo")
+        )
+    logging.info(f"Encode by {encoder}")
+    run(
+        ffmpeg.concat(*streams, v=1, a=1)
+        .output(
+            output_fn,
+            vcodec=encoder.codec,
+            acodec="aac",
+            movflags="+faststart",
+            **encoder.options(),
+        )
+        .global_args(*encoder.global_args())
+    )
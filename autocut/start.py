@@ -11,14 +11,16 @@ from PyQt5.QtWidgets import (QApplication, QMainWindow, QPushButton, QVBoxLayout
 from PyQt5.QtCore import Qt, QUrl, QTime, QTimer, pyqtSignal, QObject, QEvent
 from PyQt5.QtMultimedia import QMediaPlayer, QMediaContent
 from PyQt5.QtMultimediaWidgets import QVideoWidget
-from PyQt5.QtGui import QTextCursor
+from PyQt5.QtGui import QTextCursor, QDesktopServices
 from PyQt5.QtWidgets import (QDialog, QVBoxLayout, QPushButton, QListWidget, QListWidgetItem)
 from PyQt5.QtGui import QPalette
 from datetime import datetime
-from autocut import transcribe, cut
+from autocut import transcribe, cut, registry
 from autocut.transcribe import Transcribe
 from autocut.type import LANG
 from autocut.cut import Cutter
+from autocut.cache import DEFAULT_RENDER_CACHE, DEFAULT_TRANSCRIBE_CACHE
+from autocut.subtitle import Subtitles, format_timestamp
 from PyQt5.QtCore import QThread, pyqtSignal
 
 class ClickableSlider(QSlider):
@@ -97,6 +99,10 @@ class VideoPlayer(QMainWindow):
         self.animation_dots = 0
         self.animation_max_dots = 3  # 最大点数
 
+        # 后台预加载模型，生成字幕时不再等待模型加载
+        warm_up_args = TranscribeArgs(inputs=[], lang='zh')
+        threading.Thread(target=registry.warm_up_from_args, args=(warm_up_args,), daemon=True).start()
+
     def start_animation(self, message):
         """启动动画效果"""
         self.animation_message = message
@@ -712,8 +718,13 @@ class SubtitleGenerator(QDialog):
         self.saveVideoButton = QPushButton("合成短视频并保存")
         self.saveVideoButton.setStyleSheet("background-color: #FFC300; color: white;font-size: 16px; padding: 5px")
 
-        self.saveVideoButton.clicked.connect(self.save_video)
+        self.previewVideoButton = QPushButton("快速预览")
+        self.previewVideoButton.setStyleSheet("background-color: #3498DB; color: white;font-size: 16px; padding: 5px")
+
+        self.saveVideoButton.clicked.connect(lambda: self.save_video())
+        self.previewVideoButton.clicked.connect(self.preview_video)
         buttonLayout.addWidget(self.cutVideoButton)
+        buttonLayout.addWidget(self.previewVideoButton)
         buttonLayout.addWidget(self.saveVideoButton)
 
         self.cutVideoButton.clicked.connect(self.cut_video)
@@ -856,20 +867,14 @@ class SubtitleGenerator(QDialog):
             self.subtitles_list.scrollToItem(self.subtitles_list.item(current_index),
                                              QAbstractItemView.PositionAtCenter)
     def load_subtitles(self, srt_file):
-        with open(srt_file, 'r', encoding='utf-8') as file:
-            subtitles = file.read().split('\n\n')
-            for subtitle in subtitles:
-                parts = subtitle.split('\n')
-                if len(parts) >= 3:
-                    number = parts[0]
-                    time_range = parts[1]
-                    text = '\n'.join(parts[2:])
-                    item = CustomListWidgetItem(f"{number}. {time_range}\n{text}")
-                    item.setFlags(item.flags() | Qt.ItemIsUserCheckable)  # 添加复选框
-                    item.setCheckState(Qt.Unchecked)  # 默认状态为未选中
-                    self.subtitles_list.addItem(item)
-                    start_time, end_time = self.parse_time_range(time_range)
-                    item.setData(Qt.UserRole, (start_time, end_time))
+        for sub in Subtitles.load(srt_file, 'utf-8'):
+            time_range = f"{format_timestamp(sub.start)} --> {format_timestamp(sub.end)}"
+            item = CustomListWidgetItem(f"{sub.index}. {time_range}\n{sub.content}")
+            item.setFlags(item.flags() | Qt.ItemIsUserCheckable)  # 添加复选框
+            item.setCheckState(Qt.Unchecked)  # 默认状态为未选中
+            self.subtitles_list.addItem(item)
+            # 字幕的时间已经是毫秒
+            item.setData(Qt.UserRole, (sub.start, sub.end))
 
     def get_selected_subtitles(self):
         selected_subtitles = []
@@ -1065,7 +1070,11 @@ class SubtitleGenerator(QDialog):
         #         item.setCheckState(Qt.Unchecked)
         #         print("unchecked")
 
-    def save_video(self):
+    def preview_video(self):
+        # 低分辨率快速渲染预览，不覆盖最终的剪辑文件
+        self.save_video(preview=True)
+
+    def save_video(self, preview=False):
         # 添加保存视频的逻辑
         print("save_video called")
         selected_subtitles = self.get_selected_subtitles()
@@ -1081,7 +1090,7 @@ class SubtitleGenerator(QDialog):
         cut_video_file_path = f"{base_name}_cut{ext}"
 
         # 检查剪辑后的文件是否存在，如果存在则删除
-        if os.path.exists(cut_video_file_path):
+        if not preview and os.path.exists(cut_video_file_path):
             try:
                 os.remove(cut_video_file_path)
             except OSError as e:
@@ -1115,11 +1124,13 @@ class SubtitleGenerator(QDialog):
             video_file_path = os.path.join(self.video_directory, self.video_filename)
 
             # 创建 Cutter 参数对象
-            cutter_args = CutterArgs(inputs=[video_file_path, temp_srt_file])
+            cutter_args = CutterArgs(inputs=[video_file_path, temp_srt_file], preview=preview)
             print("文件目录：" + video_file_path + " " + temp_srt_file)
+            self.preview_file_path = f"{base_name}_preview.mp4" if preview else None
 
             # 禁用保存视频按钮
             self.saveVideoButton.setEnabled(False)
+            self.previewVideoButton.setEnabled(False)
 
             # 创建并启动视频合成线程
             self.video_merge_thread = VideoMergeThread(cutter_args)
@@ -1133,6 +1144,10 @@ class SubtitleGenerator(QDialog):
         # 视频合成完成后的操作
         self.update_log("视频合成完毕。")
         self.saveVideoButton.setEnabled(True)  # 启用保存视频按钮
+        self.previewVideoButton.setEnabled(True)
+        # 用系统播放器打开预览
+        if self.preview_file_path and os.path.exists(self.preview_file_path):
+            QDesktopServices.openUrl(QUrl.fromLocalFile(self.preview_file_path))
 
     def merge_video_with_subtitles(self, srt_file):
         # 获取视频文件的完整路径
@@ -1329,14 +1344,28 @@ class CuttingRequestThread(QThread):
             return None
 
 class CutterArgs:
-    def __init__(self, inputs, encoding='utf-8', force=False, bitrate='2000k'):
+    def __init__(self, inputs, encoding='utf-8', force=False, bitrate='2000k', cut_engine='moviepy',
+                 export_profile='default', encoder_threads=0, hwaccel='none', preview=False,
+                 preview_height=360, render_cache=DEFAULT_RENDER_CACHE, render_cache_size=2048,
+                 encode_jobs=0):
         self.inputs = inputs
         self.encoding = encoding
         self.force = force
         self.bitrate = bitrate
+        self.cut_engine = cut_engine
+        self.export_profile = export_profile
+        self.encoder_threads = encoder_threads
+        self.hwaccel = hwaccel
+        self.preview = preview
+        self.preview_height = preview_height
+        self.render_cache = render_cache
+        self.render_cache_size = render_cache_size
+        self.encode_jobs = encode_jobs
 
 class TranscribeArgs:
-    def __init__(self, inputs, lang, encoding='utf-8', force=False, whisper_mode='whisper', whisper_model='base', device='cpu', vad='0', prompt=''):
+    def __init__(self, inputs, lang, encoding='utf-8', force=False, whisper_mode='whisper', whisper_model='base', device='cpu', vad='0', prompt='', audio_cache_dir=None, compute_type='default', openai_rpm=3, cpu_threads=0, num_workers=0, batch_size=1, pack_segments=True, stream_vad=True, prefetch=1,
+                 transcribe_cache=DEFAULT_TRANSCRIBE_CACHE,
+                 transcribe_cache_size=512):
         self.inputs = inputs
         self.lang = lang
         self.encoding = encoding
@@ -1346,6 +1375,17 @@ class TranscribeArgs:
         self.device = device
         self.vad = vad
         self.prompt = prompt  # 添加 prompt 属性
+        self.audio_cache_dir = audio_cache_dir
+        self.compute_type = compute_type
+        self.openai_rpm = openai_rpm
+        self.cpu_threads = cpu_threads
+        self.num_workers = num_workers
+        self.batch_size = batch_size
+        self.pack_segments = pack_segments
+        self.stream_vad = stream_vad
+        self.prefetch = prefetch
+        self.transcribe_cache = transcribe_cache
+        self.transcribe_cache_size = transcribe_cache_size
 
 class LogThread(QObject, threading.Thread):
     log_signal = pyqtSignal(str)
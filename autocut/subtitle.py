@@ -0,0 +1,234 @@
+import datetime
+import re
+from typing import Iterable, List
+
+import numpy as np
+import srt
+
+_TS = r"(\d+:\d+:\d+[,.]\d+)"
+# A well-formed cue as written by srt and whisper, the content is the lines
+# until a blank line or the next cue. The whole cue is captured to check all
+# the text is parsed, a content with blank lines is left to srt.
+_HEADER = rf"\d+[ \t]*\n{_TS[1:-1]}"
+_LINE = rf"(?!{_HEADER})[^\n]+"
+_CUE_RE = re.compile(
+    rf"(\s*(\d+)[ \t]*\n{_TS} *--> *{_TS}[^\n]*(?:\n|\Z)((?:{_LINE}(?:\n{_LINE})*)?)"
+    rf"(?:\n|\Z)(?:\n|\Z|(?={_HEADER}))(?={_HEADER}|\Z))"
+)
+_TS_RE = re.compile(r"(\d+):(\d+):(\d+)[,.](\d+)")
+_MULTI_NEWLINE_RE = re.compile(r"\n\n+")
+# The digits of HH:MM:SS,mmm and their milliseconds
+_DIGITS = [0, 1, 3, 4, 6, 7, 9, 10, 11]
+_WEIGHTS = np.array([36000000, 3600000, 600000, 60000, 10000, 1000, 100, 10, 1])
+
+
+def parse_timestamp(timestamp: str) -> int:
+    # Milliseconds of 01:23:04,000
+    m = _TS_RE.fullmatch(timestamp.strip())
+    if m is None:
+        return srt.srt_timestamp_to_timedelta(timestamp) // datetime.timedelta(
+            milliseconds=1
+        )
+    h, m, s, ms = map(int, m.groups())
+    return ((h * 60 + m) * 60 + s) * 1000 + ms
+
+
+def format_timestamp(ms: int) -> str:
+    # 01:23:04,000 of milliseconds
+    s, ms = divmod(int(ms), 1000)
+    m, s = divmod(s, 60)
+    h, m = divmod(m, 60)
+    return f"{h:02d}:{m:02d}:{s:02d},{ms:03d}"
+
+
+def _parse_timestamps(timestamps: List[str]) -> np.ndarray:
+    # Usually all are HH:MM:SS,mmm, then converted by the bytes at once
+    joined = "".join(timestamps)
+    if len(joined) == 12 * len(timestamps) and joined.isascii():
+        rows = np.frombuffer(joined.encode(), np.uint8).reshape(-1, 12)
+        if (
+            (rows[:, 2] == ord(":")).all()
+            and (rows[:, 5] == ord(":")).all()
+            and np.isin(rows[:, 8], [ord(","), ord(".")]).all()
+        ):
+            return (rows[:, _DIGITS].astype(np.int64) - ord("0")) @ _WEIGHTS
+    return np.array([parse_timestamp(t) for t in timestamps], np.int64)
+
+
+def _timestamp_rows(ms: np.ndarray) -> np.ndarray:
+    # N x 12 bytes of HH:MM:SS,mmm, the hours must be less than 100
+    s, ms = np.divmod(ms, 1000)
+    m, s = np.divmod(s, 60)
+    h, m = np.divmod(m, 60)
+    rows = np.empty((len(ms), 12), np.uint8)
+    rows[:, _DIGITS] = ord("0") + np.stack(
+        [
+            h // 10,
+            h % 10,
+            m // 10,
+            m % 10,
+            s // 10,
+            s % 10,
+            ms // 100,
+            ms // 10 % 10,
+            ms % 10,
+        ],
+        axis=1,
+    )
+    rows[:, [2, 5]] = ord(":")
+    rows[:, 8] = ord(",")
+    return rows
+
+
+def _format_times(starts: np.ndarray, ends: np.ndarray) -> List[str]:
+    # The "start --> end" lines
+    if len(ends) == 0 or starts.min() < 0 or ends.max() >= 100 * 3600000:
+        return [
+            f"{format_timestamp(start)} --> {format_timestamp(end)}"
+            for start, end in zip(starts.tolist(), ends.tolist())
+        ]
+    arrow = np.frombuffer(b" --> ", np.uint8)
+    rows = np.concatenate(
+        [
+            _timestamp_rows(starts),
+            np.broadcast_to(arrow, (len(starts), len(arrow))),
+            _timestamp_rows(ends),
+        ],
+        axis=1,
+    )
+    text = rows.tobytes().decode()
+    width = rows.shape[1]
+    return [text[i : i + width] for i in range(0, len(text), width)]
+
+
+def _legal_content(content: str) -> str:
+    # Without blank lines, the same as srt does
+    if content and content[0] != "\n" and "\n\n" not in content:
+        return content
+    return _MULTI_NEWLINE_RE.sub("\n", content.strip("\n"))
+
+
+class Cue:
+    # A subtitle, the times are in milliseconds
+    __slots__ = ("index", "start", "end", "content")
+
+    def __init__(self, index: int, start: int, end: int, content: str):
+        self.index = index
+        self.start = start
+        self.end = end
+        self.content = content
+
+    def __repr__(self):
+        return f"Cue({self.index}, {self.start}, {self.end}, {self.content!r})"
+
+
+# Subtitles stored as parallel arrays, the indices and the times in
+# milliseconds are int64 arrays and the contents a list. It parses and writes
+# srt files much faster than srt, which builds a timedelta based object of
+# every subtitle, and the times are vectorized.
+class Subtitles:
+    __slots__ = ("indices", "starts", "ends", "contents")
+
+    def __init__(self, indices=(), starts=(), ends=(), contents=()):
+        self.indices = np.asarray(indices, np.int64)
+        self.starts = np.asarray(starts, np.int64)
+        self.ends = np.asarray(ends, np.int64)
+        self.contents = list(contents)
+
+    @classmethod
+    def parse(cls, text: str) -> "Subtitles":
+        if "\r" in text:
+            text = text.replace("\r\n", "\n")
+        if not text.strip():
+            return cls()
+        text = text.rstrip() + "\n"
+        cues = _CUE_RE.findall(text)
+        if sum(map(len, next(zip(*cues), ()))) != len(text) or text.count("-->") != len(
+            cues
+        ):
+            # Not well-formed, e.g. no indices or odd separators, which srt
+            # works around. An arrow in a content is left to srt as well.
+            return cls.from_srt(srt.parse(text))
+        _, indices, starts, ends, contents = zip(*cues)
+        return cls(
+            np.array(indices, np.int64),
+            _parse_timestamps(starts),
+            _parse_timestamps(ends),
+            contents,
+        )
+
+    @classmethod
+    def load(cls, filename: str, encoding: str) -> "Subtitles":
+        with open(filename, encoding=encoding) as f:
+            return cls.parse(f.read())
+
+    @classmethod
+    def from_srt(cls, subs: Iterable[srt.Subtitle]) -> "Subtitles":
+        subs = list(subs)
+        return cls(
+            [s.index or 0 for s in subs],
+            [s.start // datetime.timedelta(milliseconds=1) for s in subs],
+            [s.end // datetime.timedelta(milliseconds=1) for s in subs],
+            [s.content for s in subs],
+        )
+
+    def compose(self) -> str:
+        # The same as srt.compose, sorted by time, reindexed from 1, and the
+        # empty or invalid subtitles are skipped
+        order = np.lexsort((self.indices, self.ends, self.starts))
+        valid = (self.starts[order] >= 0) & (self.starts[order] < self.ends[order])
+        order = order[valid]
+        contents = [_legal_content(self.contents[i]) for i in order.tolist()]
+        keep = [i for i, c in enumerate(contents) if c.strip()]
+        order = order[keep]
+        times = _format_times(self.starts[order], self.ends[order])
+        return "".join(
+            f"{i}\n{time}\n{contents[k]}\n\n"
+            for i, (k, time) in enumerate(zip(keep, times), 1)
+        )
+
+    def save(self, filename: str, encoding: str):
+        with open(filename, "wb") as f:
+            f.write(self.compose().encode(encoding, "replace"))
+
+    def select(self, mask) -> "Subtitles":
+        # The subtitles of a boolean mask or an index array
+        mask = np.asarray(mask)
+        idx = np.flatnonzero(mask) if mask.dtype == bool else mask.astype(np.int64)
+        return Subtitles(
+            self.indices[idx],
+            self.starts[idx],
+            self.ends[idx],
+            [self.contents[i] for i in idx.tolist()],
+        )
+
+    def segments(self, gap: int = 500) -> np.ndarray:
+        # N x 2 [start, end] milliseconds of the subtitles sorted by start,
+        # the ones starting less than gap after the previous end are joined
+        order = np.argsort(self.starts, kind="stable")
+        starts, ends = self.starts[order], self.ends[order]
+        if len(starts) == 0:
+            return np.zeros((0, 2), np.int64)
+        new = np.concatenate([[True], starts[1:] - ends[:-1] >= gap])
+        last = np.concatenate([new[1:], [True]])
+        return np.stack([starts[new], ends[last]], axis=1)
+
+    def __len__(self):
+        return len(self.contents)
+
+    def __iter__(self):
+        for args in zip(
+            self.indices.tolist(),
+            self.starts.tolist(),
+            self.ends.tolist(),
+            self.contents,
+        ):
+            yield Cue(*args)
+
+    def __getitem__(self, i) -> Cue:
+        return Cue(
+            int(self.indices[i]),
+            int(self.starts[i]),
+            int(self.ends[i]),
+            self.contents[i],
+        )
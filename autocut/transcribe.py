@@ -1,13 +1,16 @@
 import logging
 import os
+import queue
+import threading
 import time
 from typing import List, Any
 
 import numpy as np
-import srt
-import torch
 
-from . import utils, whisper_model
+from . import registry, utils
+from .vad import StreamingVAD
+from .cache import TranscribeCache
+from .subtitle import Subtitles
 from .type import WhisperMode, SPEECH_ARRAY_INDEX
 
 
@@ -18,73 +21,266 @@ class Transcribe:
         self.whisper_model = None
         self.vad_model = None
         self.detect_speech = None
+        self.vad_block_seconds = 600
+        # The block length of streaming VAD, the first speeches are
+        # transcribed after decoding such a block
+        self.stream_block_seconds = 60
+        # The window length of whisper
+        self.pack_seconds = 30
+        self.cache = (
+            TranscribeCache(
+                self.args.transcribe_cache, self.args.transcribe_cache_size * 2**20
+            )
+            if self.args.transcribe_cache and self.args.transcribe_cache_size > 0
+            else None
+        )
 
         tic = time.time()
-        if self.whisper_model is None:
-            if self.args.whisper_mode == WhisperMode.WHISPER.value:
-                self.whisper_model = whisper_model.WhisperModel(self.sampling_rate)
-                self.whisper_model.load(self.args.whisper_model, self.args.device)
-            elif self.args.whisper_mode == WhisperMode.OPENAI.value:
-                self.whisper_model = whisper_model.OpenAIModel(
-                    self.args.openai_rpm, self.sampling_rate
-                )
-                self.whisper_model.load()
-            elif self.args.whisper_mode == WhisperMode.FASTER.value:
-                self.whisper_model = whisper_model.FasterWhisperModel(
-                    self.sampling_rate
-                )
-                self.whisper_model.load(self.args.whisper_model, self.args.device)
+        self.whisper_model = registry.get_whisper_model(
+            self.args.whisper_mode,
+            self.args.whisper_model,
+            self.args.device,
+            self.args.compute_type,
+            self.sampling_rate,
+            self.args.openai_rpm,
+            self.args.cpu_threads,
+            self.args.num_workers,
+            self.args.batch_size,
+        )
         logging.info(f"Done Init model in {time.time() - tic:.1f} sec")
 
     def run(self):
-        for input in self.args.inputs:
-            logging.info(f"Transcribing {input}")
-            name, _ = os.path.splitext(input)
-            if utils.check_exists(name + ".md", self.args.force):
-                continue
+        # A pipeline of three stages connected by bounded queues: a thread
+        # decodes the audio and detects speeches of the inputs one by one,
+        # the model transcribes them here, and another thread saves the
+        # results. So the model doesn't wait for decoding between inputs.
+        prefetch = max(1, self.args.prefetch)
+        # (input, the ready queue of its speeches), None when all decoded
+        # or an exception
+        decoded = queue.Queue(maxsize=prefetch)
+        # (input, transcribe results), None when all transcribed
+        transcribed = queue.Queue(maxsize=prefetch)
+        stop = threading.Event()
+        errors = []
+        decoder = threading.Thread(
+            target=self._decode_inputs, args=(decoded, stop), daemon=True
+        )
+        writer = threading.Thread(
+            target=self._save_results, args=(transcribed, errors), daemon=True
+        )
+        decoder.start()
+        writer.start()
+        try:
+            while True:
+                item = decoded.get()
+                if item is None:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                input, ready = item
+                transcribed.put((input, self._transcribe_ready(input, ready)))
+        finally:
+            stop.set()
+            transcribed.put(None)
+            writer.join()
+        if errors:
+            raise errors[0]
 
-            audio = utils.load_audio(input, sr=self.sampling_rate)
-            speech_array_indices = self._detect_voice_activity(audio)
-            transcribe_results = self._transcribe(input, audio, speech_array_indices)
+    def run_live(self, input: str, state: dict, final: bool = False):
+        """Transcribe the new audio of input, which is still being recorded
 
-            output = name + ".srt"
-            self._save_srt(output, transcribe_results)
-            logging.info(f"Transcribed {input} to {output}")
-            self._save_md(name + ".md", output, input)
-            logging.info(f'Saved texts to {name + ".md"} to mark sentences')
+        state keeps the transcribed offset in samples and the results so far
+        between calls. The speeches at the end may still continue, they are
+        left to the next call unless final. The SRT and MD are rewritten with
+        all the results so far.
+        """
+        assert self.args.whisper_mode in (
+            WhisperMode.WHISPER.value,
+            WhisperMode.FASTER.value,
+        ), "Live transcription needs the whisper or faster mode"
+        offset = state.setdefault("offset", 0)
+        results = state.setdefault("results", [])
+        vad = self._streaming_vad()
+        audio = np.zeros(0, np.float32)
+        speeches = []
+        for audio, block in utils.stream_audio(
+            input,
+            self.sampling_rate,
+            self.stream_block_seconds * self.sampling_rate,
+            start=offset / self.sampling_rate,
+        ):
+            speeches += vad.feed(block)
+        if final:
+            # The whole audio is only used if nothing was transcribed before
+            speeches += vad.flush(fallback=not results)
+        if speeches:
+            for r in self._transcribe(input, audio, speeches):
+                r["origin_timestamp"] = utils.shift_segment(
+                    r["origin_timestamp"], offset
+                )
+                results.append(r)
+            state["offset"] = offset + int(speeches[-1]["end"])
+        logging.info(
+            f"Transcribed {input} live until "
+            f"{state['offset'] / self.sampling_rate:.1f} sec"
+        )
+        if not speeches and not final:
+            return
 
-    def _detect_voice_activity(self, audio) -> List[SPEECH_ARRAY_INDEX]:
-        """Detect segments that have voice activities"""
-        if self.args.vad == "0":
-            return [{"start": 0, "end": len(audio)}]
+        name, _ = os.path.splitext(input)
+        old_subs = self._save_srt(name + ".srt", results)
+        self._save_md(name + ".md", name + ".srt", input, old_subs)
+
+    def _can_stream(self) -> bool:
+        # The openai mode sends all the requests of an input together
+        return (
+            self.args.stream_vad
+            and self.args.vad != "0"
+            and self.args.whisper_mode
+            in (WhisperMode.WHISPER.value, WhisperMode.FASTER.value)
+        )
+
+    def _decode_inputs(self, decoded: queue.Queue, stop: threading.Event):
+        try:
+            for input in self.args.inputs:
+                name, _ = os.path.splitext(input)
+                if utils.check_exists(name + ".md", self.args.force):
+                    continue
+                # (audio decoded so far, detected speeches, is the last), or
+                # an exception raised by decoding
+                ready = queue.Queue()
+                # Block while the model is behind by prefetch inputs
+                if not _put_until(decoded, (input, ready), stop):
+                    return
+                logging.info(f"Transcribing {input}")
+                self._decode(input, ready, stop)
+        except Exception as e:
+            _put_until(decoded, e, stop)
+            return
+        _put_until(decoded, None, stop)
 
+    def _decode(self, input: str, ready: queue.Queue, stop: threading.Event):
         tic = time.time()
-        if self.vad_model is None or self.detect_speech is None:
-            # torch load limit https://github.com/pytorch/vision/issues/4156
-            torch.hub._validate_not_a_forked_repo = lambda a, b, c: True
-            self.vad_model, funcs = torch.hub.load(
-                repo_or_dir="snakers4/silero-vad", model="silero_vad", trust_repo=True
+        try:
+            if not self._can_stream():
+                audio = utils.load_audio(
+                    input, sr=self.sampling_rate, cache_dir=self.args.audio_cache_dir
+                )
+                ready.put((audio, self._detect_voice_activity(audio), True))
+                return
+
+            # Detect speeches while decoding, so the model can start on the
+            # first ones before the whole audio is decoded
+            vad = self._streaming_vad()
+            audio = np.zeros(0, np.float32)
+            for audio, block in utils.stream_audio(
+                input,
+                self.sampling_rate,
+                self.stream_block_seconds * self.sampling_rate,
+                self.args.audio_cache_dir,
+            ):
+                if stop.is_set():
+                    return
+                speeches = vad.feed(block)
+                if speeches:
+                    ready.put((audio, speeches, False))
+            ready.put((audio, vad.flush(), True))
+            logging.info(
+                f"Done voice activity detection in {time.time() - tic:.1f} sec"
             )
+        except Exception as e:
+            ready.put(e)
 
-            self.detect_speech = funcs[0]
+    def _transcribe_ready(self, input: str, ready: queue.Queue) -> List[Any]:
+        """Transcribe the speeches of input as they are detected
 
-        speeches = self.detect_speech(
-            audio, self.vad_model, sampling_rate=self.sampling_rate
-        )
+        The speeches are packed into the same windows however they are split
+        between the items, so the results don't depend on the timing of
+        decoding. The last window may still take the next speeches, so it
+        waits for them.
+        """
+        res = []
+        pending = []
+        done = False
+        while not done:
+            item = ready.get()
+            if isinstance(item, Exception):
+                raise item
+            audio, speeches, done = item
+            pending += speeches
+            if not pending:
+                continue
+            n = len(pending)
+            if not done and self._packs():
+                windows = utils.pack_segments(
+                    pending, self.pack_seconds * self.sampling_rate
+                )
+                n = sum(len(w["pieces"]) for w in windows[:-1])
+            if n > 0:
+                res += self._transcribe(input, audio, pending[:n])
+                pending = pending[n:]
+        return res
 
-        # Remove too short segments
-        speeches = utils.remove_short_segments(speeches, 1.0 * self.sampling_rate)
+    def _save_results(self, transcribed: queue.Queue, errors: List[Exception]):
+        while True:
+            item = transcribed.get()
+            if item is None:
+                return
+            if errors:
+                # Drain the queue, so the model is not blocked
+                continue
+            input, transcribe_results = item
+            name, _ = os.path.splitext(input)
+            try:
+                output = name + ".srt"
+                old_subs = self._save_srt(output, transcribe_results)
+                logging.info(f"Transcribed {input} to {output}")
+                self._save_md(name + ".md", output, input, old_subs)
+                logging.info(f'Saved texts to {name + ".md"} to mark sentences')
+            except Exception as e:
+                errors.append(e)
 
-        # Expand to avoid to tight cut. You can tune the pad length
-        speeches = utils.expand_segments(
-            speeches, 0.2 * self.sampling_rate, 0.0 * self.sampling_rate, audio.shape[0]
+    def _streaming_vad(self) -> StreamingVAD:
+        if self.vad_model is None or self.detect_speech is None:
+            self.vad_model, self.detect_speech = registry.get_vad_model()
+        return StreamingVAD(
+            self._detect_speech,
+            self.sampling_rate,
         )
 
-        # Merge very closed segments
-        speeches = utils.merge_adjacent_segments(speeches, 0.5 * self.sampling_rate)
+    def _detect_speech(self, block):
+        with registry.model_lock(self.vad_model):
+            return self.detect_speech(
+                block, self.vad_model, sampling_rate=self.sampling_rate
+            )
+
+    def _model_transcribe(self, *args):
+        with registry.model_lock(self.whisper_model):
+            return self.whisper_model.transcribe(*args)
+
+    def _detect_voice_activity(self, audio) -> List[SPEECH_ARRAY_INDEX]:
+        """Detect segments that have voice activities"""
+        if self.args.vad == "0":
+            return [{"start": 0, "end": len(audio)}]
+
+        tic = time.time()
+        vad = self._streaming_vad()
+        # Run VAD block by block, so only a block is converted to a tensor at a
+        # time, e.g. when audio is memory mapped
+        speeches = []
+        block_size = self.vad_block_seconds * self.sampling_rate
+        for offset in range(0, len(audio), block_size):
+            speeches += vad.feed(audio[offset : offset + block_size])
+        speeches += vad.flush()
 
         logging.info(f"Done voice activity detection in {time.time() - tic:.1f} sec")
-        return speeches if len(speeches) > 1 else [{"start": 0, "end": len(audio)}]
+        return speeches
+
+    def _packs(self) -> bool:
+        return self.args.pack_segments and self.args.whisper_mode in (
+            WhisperMode.WHISPER.value,
+            WhisperMode.FASTER.value,
+        )
 
     def _transcribe(
         self,
@@ -93,13 +289,19 @@ class Transcribe:
         speech_array_indices: List[SPEECH_ARRAY_INDEX],
     ) -> List[Any]:
         tic = time.time()
-        res = (
-            self.whisper_model.transcribe(
-                audio, speech_array_indices, self.args.lang, self.args.prompt
+        if self._packs():
+            num_segments = len(speech_array_indices)
+            speech_array_indices = utils.pack_segments(
+                speech_array_indices, self.pack_seconds * self.sampling_rate
             )
+            logging.info(
+                f"Packed {num_segments} segments into {len(speech_array_indices)} windows"
+            )
+        res = (
+            self._transcribe_cached(audio, speech_array_indices)
             if self.args.whisper_mode == WhisperMode.WHISPER.value
             or self.args.whisper_mode == WhisperMode.FASTER.value
-            else self.whisper_model.transcribe(
+            else self._model_transcribe(
                 input, audio, speech_array_indices, self.args.lang, self.args.prompt
             )
         )
@@ -107,27 +309,83 @@ class Transcribe:
         logging.info(f"Done transcription in {time.time() - tic:.1f} sec")
         return res
 
+    def _transcribe_cached(
+        self, audio: np.ndarray, speech_array_indices: List[SPEECH_ARRAY_INDEX]
+    ) -> List[Any]:
+        # Only transcribe the segments whose audio and settings are not cached
+        if self.cache is None:
+            return self._model_transcribe(
+                audio, speech_array_indices, self.args.lang, self.args.prompt
+            )
+
+        # Everything changing the results besides the audio, e.g. batched
+        # decoding or another device decodes differently
+        settings = {
+            "mode": self.args.whisper_mode,
+            "model": self.args.whisper_model,
+            "device": self.whisper_model.device,
+            "compute_type": self.args.compute_type,
+            "batch_size": self.args.batch_size,
+            "lang": self.args.lang,
+            "prompt": self.args.prompt,
+            "pack_segments": self.args.pack_segments,
+            "pack_seconds": self.pack_seconds,
+        }
+        # The pieces of a packed window are mapped back by their lengths
+        keys = [
+            self.cache.key(
+                utils.segment_audio(audio, seg),
+                dict(
+                    settings,
+                    pieces=[int(e - s) for s, e in utils.segment_pieces(seg)],
+                ),
+            )
+            for seg in speech_array_indices
+        ]
+        res = [self.cache.get(k) for k in keys]
+        missing = [i for i, r in enumerate(res) if r is None]
+        if missing:
+            new_res = self._model_transcribe(
+                audio,
+                [speech_array_indices[i] for i in missing],
+                self.args.lang,
+                self.args.prompt,
+            )
+            for i, r in zip(missing, new_res):
+                res[i] = r
+                self.cache.put(keys[i], r)
+        # The same audio may come from another position or file
+        for r, seg in zip(res, speech_array_indices):
+            r["origin_timestamp"] = seg
+        logging.info(f"Transcribe cache: {self.cache.stats()}")
+        return res
+
     def _save_srt(self, output, transcribe_results):
-        subs = self.whisper_model.gen_srt(transcribe_results)
+        # Return the subtitles saved before, whose marks are carried over
+        old_subs = None
+        subs = Subtitles.from_srt(self.whisper_model.gen_srt(transcribe_results))
+        data = subs.compose().encode(self.args.encoding, "replace")
+        if os.path.exists(output):
+            with open(output, "rb") as f:
+                old_data = f.read()
+            if old_data == data:
+                return None
+            old_subs = Subtitles.parse(old_data.decode(self.args.encoding, "replace"))
         with open(output, "wb") as f:
-            f.write(srt.compose(subs).encode(self.args.encoding, "replace"))
-
-    def _save_md(self, md_fn, srt_fn, video_fn):
-        with open(srt_fn, encoding=self.args.encoding) as f:
-            subs = srt.parse(f.read())
-
-        md = utils.MD(md_fn, self.args.encoding)
-        md.clear()
-        md.add_done_editing(False)
-        md.add_video(os.path.basename(video_fn))
-        md.add(
-            f"\nTexts generated from [{os.path.basename(srt_fn)}]({os.path.basename(srt_fn)})."
-            "Mark the sentences to keep for autocut.\n"
-            "The format is [subtitle_index,duration_in_second] subtitle context.\n\n"
-        )
+            f.write(data)
+        return old_subs
+
+    def _save_md(self, md_fn, srt_fn, video_fn, old_subs=None):
+        subs = Subtitles.load(srt_fn, self.args.encoding)
+        utils.save_md(md_fn, srt_fn, subs, self.args.encoding, video_fn, old_subs)
+
 
-        for s in subs:
-            sec = s.start.seconds
-            pre = f"[{s.index},{sec // 60:02d}:{sec % 60:02d}]"
-            md.add_task(False, f"{pre:11} {s.content.strip()}")
-        md.write()
+def _put_until(q: queue.Queue, item, stop: threading.Event) -> bool:
+    # Put item into the bounded queue q, unless stop is set meanwhile
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=0.5)
+            return True
+        except queue.Full:
+            pass
+    return False
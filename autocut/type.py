@@ -85,3 +85,36 @@ class WhisperMode(Enum):
     @staticmethod
     def get_values():
         return [i.value for i in WhisperMode]
+
+
+class CutEngine(Enum):
+    MOVIEPY = "moviepy"
+    FFMPEG_COPY = "ffmpeg-copy"
+    FFMPEG = "ffmpeg"
+
+    @staticmethod
+    def get_values():
+        return [i.value for i in CutEngine]
+
+
+class ExportProfile(Enum):
+    # Keep the encoder of moviepy and encode at --bitrate
+    DEFAULT = "default"
+    FAST_PREVIEW = "fast-preview"
+    WEB = "web"
+    ARCHIVE = "archive"
+
+    @staticmethod
+    def get_values():
+        return [i.value for i in ExportProfile]
+
+
+class HWAccel(Enum):
+    NONE = "none"
+    AUTO = "auto"
+    VAAPI = "vaapi"
+    QSV = "qsv"
+
+    @staticmethod
+    def get_values():
+        return [i.value for i in HWAccel]
@@ -1,24 +1,187 @@
+import bisect
+import hashlib
 import logging
 import os
 import re
+import subprocess
+import tempfile
+from typing import Iterator, Tuple
 
 import ffmpeg
 import numpy as np
 import opencc
-import srt
 
-
-def load_audio(file: str, sr: int = 16000) -> np.ndarray:
+from .subtitle import Subtitles, format_timestamp, parse_timestamp
+
+
+def iter_audio(
+    file: str, sr: int = 16000, block_size: int = 30 * 16000, start: float = 0
+) -> Iterator[np.ndarray]:
+    # Yield the decoded audio in float32 blocks of block_size samples, so the
+    # whole PCM never needs to be in memory at once. Decoding begins from
+    # start seconds.
+    # The errors go to a temporary file instead of a pipe, ffmpeg would block
+    # on a full stderr pipe while only stdout is read
+    args = (
+        ffmpeg.input(file, threads=0, **({"ss": start} if start > 0 else {}))
+        .output("-", format="s16le", acodec="pcm_s16le", ac=1, ar=sr)
+        .compile(cmd=["ffmpeg", "-nostdin", "-loglevel", "error"])
+    )
+    with tempfile.TemporaryFile() as err_file:
+        process = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=err_file)
+        try:
+            while True:
+                buf = process.stdout.read(block_size * 2)
+                if not buf:
+                    break
+                block = np.frombuffer(buf, np.int16).astype(np.float32)
+                block /= 32768.0
+                yield block
+        except GeneratorExit:
+            # The consumer stopped early
+            process.kill()
+            raise
+        finally:
+            process.stdout.close()
+            returncode = process.wait()
+        if returncode != 0:
+            err_file.seek(0)
+            raise RuntimeError(f"Failed to load audio: {err_file.read().decode()}")
+
+
+def _audio_duration(file: str) -> float:
+    try:
+        return float(ffmpeg.probe(file)["format"]["duration"])
+    except (ffmpeg.Error, KeyError, ValueError, FileNotFoundError):
+        return 0
+
+
+def _audio_cache_filename(file: str, sr: int, cache_dir: str) -> str:
+    stat = os.stat(file)
+    key = hashlib.sha1(
+        f"{os.path.abspath(file)}:{stat.st_size}:{stat.st_mtime_ns}:{sr}".encode()
+    ).hexdigest()
+    return os.path.join(cache_dir, key + ".f32")
+
+
+def _load_audio_cache(file: str, sr: int, cache_dir: str) -> np.ndarray:
+    # Decode into a float32 file in the cache dir and memory map it, so the
+    # pages are only loaded when they are used
+    cache_fn = _audio_cache_filename(file, sr, cache_dir)
+    if not os.path.exists(cache_fn):
+        for _ in stream_audio(file, sr, cache_dir=cache_dir):
+            pass
+    if os.path.getsize(cache_fn) == 0:
+        return np.zeros(0, np.float32)
+    return np.memmap(cache_fn, dtype=np.float32, mode="c")
+
+
+def _stream_audio_to_cache(
+    file: str, sr: int, block_size: int, cache_fn: str
+) -> Iterator[Tuple[np.ndarray, np.ndarray]]:
+    # Write the blocks to the cache file and yield the memory mapped audio, so
+    # the memory doesn't grow with the length of the input. The partial file
+    # is removed if stopped early or failed. A block is yielded once the next
+    # one is decoded, the last one after the file is renamed, so the filename
+    # of the memmap still exists, e.g. reopened by the worker processes.
+    temp_fn = f"{cache_fn}.{os.getpid()}.tmp"
+    finished = False
+    length = last = 0
+    try:
+        with open(temp_fn, "wb") as f:
+            for block in iter_audio(file, sr, block_size):
+                if length > 0:
+                    audio = np.memmap(temp_fn, np.float32, mode="c", shape=(length,))
+                    yield audio, audio[length - last :]
+                f.write(block.tobytes())
+                f.flush()
+                length += len(block)
+                last = len(block)
+        os.replace(temp_fn, cache_fn)
+        finished = True
+    finally:
+        if not finished and os.path.exists(temp_fn):
+            os.remove(temp_fn)
+    if length > 0:
+        audio = np.memmap(cache_fn, np.float32, mode="c", shape=(length,))
+        yield audio, audio[length - last :]
+
+
+def stream_audio(
+    file: str,
+    sr: int = 16000,
+    block_size: int = 30 * 16000,
+    cache_dir: str = None,
+    start: float = 0,
+) -> Iterator[Tuple[np.ndarray, np.ndarray]]:
+    # Yield (the audio decoded so far, the new block) while decoding, so the
+    # consumer can work on the beginning before the whole file is decoded.
+    # The audio so far stays valid when more blocks are decoded. Only the
+    # whole audio is cached.
+    if start > 0:
+        cache_dir = None
+    if cache_dir:
+        cache_fn = _audio_cache_filename(file, sr, cache_dir)
+        if os.path.exists(cache_fn):
+            audio = _load_audio_cache(file, sr, cache_dir)
+            for i in range(0, len(audio), block_size):
+                yield audio[: i + block_size], audio[i : i + block_size]
+            return
+        os.makedirs(cache_dir, exist_ok=True)
+        yield from _stream_audio_to_cache(file, sr, block_size, cache_fn)
+        return
+
+    # Preallocate by the probed duration to avoid holding the int16 PCM and
+    # its float32 copy at the same time
+    audio = np.empty(int(max(_audio_duration(file) - start, 0) * sr) + sr, np.float32)
+    length = 0
+    for block in iter_audio(file, sr, block_size, start):
+        if length + len(block) > len(audio):
+            audio = np.resize(audio, max(2 * len(audio), length + len(block)))
+        audio[length : length + len(block)] = block
+        length += len(block)
+        yield audio[:length], audio[length - len(block) : length]
+
+
+def load_audio(file: str, sr: int = 16000, cache_dir: str = None) -> np.ndarray:
+    if cache_dir:
+        return _load_audio_cache(file, sr, cache_dir)
+    audio = np.zeros(0, np.float32)
+    for audio, _ in stream_audio(file, sr):
+        pass
+    return audio
+
+
+def encode_audio(audio: np.ndarray, sr: int = 16000, format: str = "flac") -> bytes:
+    # Encode float32 PCM into a compressed file in memory, e.g. for uploading
+    pcm = (np.clip(audio, -1, 1) * 32767).astype(np.int16).tobytes()
     try:
         out, _ = (
-            ffmpeg.input(file, threads=0)
-            .output("-", format="s16le", acodec="pcm_s16le", ac=1, ar=sr)
-            .run(cmd=["ffmpeg", "-nostdin"], capture_stdout=True, capture_stderr=True)
+            ffmpeg.input("pipe:", format="s16le", ac=1, ar=sr)
+            .output("pipe:", format=format)
+            .run(
+                cmd=["ffmpeg", "-nostdin", "-loglevel", "error"],
+                input=pcm,
+                capture_stdout=True,
+                capture_stderr=True,
+            )
         )
     except ffmpeg.Error as e:
-        raise RuntimeError(f"Failed to load audio: {e.stderr.decode()}") from e
+        raise RuntimeError(f"Failed to encode audio: {e.stderr.decode()}") from e
+    return out
+
 
-    return np.frombuffer(out, np.int16).flatten().astype(np.float32) / 32768.0
+def cpu_parallelism(cpu_threads: int = 0, num_workers: int = 0):
+    # Return (threads per worker, number of workers) filling the available
+    # cores, 0 means to choose automatically
+    cores = os.cpu_count() or 1
+    if cpu_threads <= 0 and num_workers <= 0:
+        cpu_threads = min(4, cores)
+    if cpu_threads <= 0:
+        cpu_threads = max(1, cores // num_workers)
+    if num_workers <= 0:
+        num_workers = max(1, cores // cpu_threads)
+    return cpu_threads, num_workers
 
 
 def is_video(filename):
@@ -109,6 +272,15 @@ class MD:
         return m.groups()[0].lower() == "x", m.groups()[1]
 
 
+def file_state(filename):
+    # (mtime_ns, size) of filename to tell if it changed, None if not exists
+    try:
+        stat = os.stat(filename)
+    except FileNotFoundError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+
 def check_exists(output, force):
     if os.path.exists(output):
         if force:
@@ -121,40 +293,167 @@ def check_exists(output, force):
     return False
 
 
+class Segments:
+    # [start, end) segments backed by a N x 2 array, e.g. VAD results in
+    # samples. The operations are vectorized and return new Segments.
+    __slots__ = ("array",)
+
+    def __init__(self, array=None, dtype=np.int64):
+        if array is None:
+            array = np.zeros((0, 2), dtype)
+        self.array = np.asarray(array, dtype).reshape(-1, 2)
+
+    @classmethod
+    def from_dicts(cls, segments):
+        array = np.array([(s["start"], s["end"]) for s in segments], np.float64)
+        # Keep float seconds as they are, but sample indices as integers
+        if np.array_equal(array, np.round(array)):
+            return cls(array, np.int64)
+        return cls(array, np.float64)
+
+    def to_dicts(self):
+        return [{"start": start, "end": end} for start, end in self.array.tolist()]
+
+    @property
+    def starts(self):
+        return self.array[:, 0]
+
+    @property
+    def ends(self):
+        return self.array[:, 1]
+
+    def __len__(self):
+        return len(self.array)
+
+    def __iter__(self):
+        return iter(self.to_dicts())
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return Segments(self.array[i], self.array.dtype)
+        start, end = self.array[i].tolist()
+        return {"start": start, "end": end}
+
+    def remove_short(self, threshold):
+        # Remove segments whose length <= threshold
+        return Segments(
+            self.array[self.ends - self.starts > threshold], self.array.dtype
+        )
+
+    def expand(self, expand_head, expand_tail, total_length):
+        # Pad head and tail for each segment, without overlapping the original
+        # neighbours
+        if len(self) == 0:
+            return Segments(None, self.array.dtype)
+        prev_ends = np.concatenate([[0], self.ends[:-1]])
+        next_starts = np.concatenate([self.starts[1:], [total_length]])
+        starts = np.maximum(self.starts - expand_head, prev_ends)
+        ends = np.minimum(self.ends + expand_tail, next_starts)
+        return Segments(np.stack([starts, ends], axis=1), self.array.dtype)
+
+    def merge_adjacent(self, threshold):
+        # Merge two adjacent segments if their distance < threshold
+        if len(self) == 0:
+            return Segments(None, self.array.dtype)
+        # A segment starts a new group unless it is close to the previous one
+        is_first = np.ones(len(self), bool)
+        is_first[1:] = self.starts[1:] >= self.ends[:-1] + threshold
+        firsts = np.flatnonzero(is_first)
+        lasts = np.concatenate([firsts[1:] - 1, [len(self) - 1]])
+        return Segments(
+            np.stack([self.starts[firsts], self.ends[lasts]], axis=1),
+            self.array.dtype,
+        )
+
+
 def expand_segments(segments, expand_head, expand_tail, total_length):
     # Pad head and tail for each time segment
-    results = []
-    for i in range(len(segments)):
-        t = segments[i]
-        start = max(t["start"] - expand_head, segments[i - 1]["end"] if i > 0 else 0)
-        end = min(
-            t["end"] + expand_tail,
-            segments[i + 1]["start"] if i < len(segments) - 1 else total_length,
-        )
-        results.append({"start": start, "end": end})
-    return results
+    return (
+        Segments.from_dicts(segments)
+        .expand(expand_head, expand_tail, total_length)
+        .to_dicts()
+    )
 
 
 def remove_short_segments(segments, threshold):
     # Remove segments whose length < threshold
-    return [s for s in segments if s["end"] - s["start"] > threshold]
+    return Segments.from_dicts(segments).remove_short(threshold).to_dicts()
 
 
 def merge_adjacent_segments(segments, threshold):
     # Merge two adjacent segments if their distance < threshold
-    results = []
+    return Segments.from_dicts(segments).merge_adjacent(threshold).to_dicts()
+
+
+def pack_segments(segments, max_length):
+    # Pack neighbouring segments into windows with at most max_length samples
+    # of speech, so the model transcribes more context per call. The pieces
+    # of a window are concatenated, dropping the silence between them.
+    if not isinstance(segments, Segments):
+        segments = Segments.from_dicts(segments)
+    array = segments.array.astype(np.int64)
+    lengths = np.cumsum(array[:, 1] - array[:, 0])
+    windows = []
     i = 0
-    while i < len(segments):
-        s = segments[i]
-        for j in range(i + 1, len(segments)):
-            if segments[j]["start"] < s["end"] + threshold:
-                s["end"] = segments[j]["end"]
-                i = j
-            else:
-                break
-        i += 1
-        results.append(s)
-    return results
+    while i < len(array):
+        packed = lengths[i - 1] if i > 0 else 0
+        # At least one segment even if it is longer than max_length
+        j = max(int(np.searchsorted(lengths, packed + max_length, "right")), i + 1)
+        windows.append(
+            {
+                "start": int(array[i, 0]),
+                "end": int(array[j - 1, 1]),
+                "pieces": [tuple(p) for p in array[i:j].tolist()],
+            }
+        )
+        i = j
+    return windows
+
+
+def split_at_silence(audio, segment, max_length, frame=1600):
+    # Split a segment longer than max_length samples into parts within
+    # max_length, each ends at the quietest frame of its second half, so
+    # words are not cut
+    start, end = int(segment["start"]), int(segment["end"])
+    parts = []
+    while end - start > max_length:
+        lo, hi = start + max_length // 2, start + max_length
+        n = (hi - lo) // frame
+        if n == 0:
+            cut = hi
+        else:
+            frames = np.asarray(audio[lo : lo + n * frame]).reshape(n, frame)
+            cut = lo + int(np.argmin(np.square(frames).mean(axis=1))) * frame
+            cut += frame // 2
+        parts.append({"start": start, "end": cut})
+        start = cut
+    parts.append({"start": start, "end": end})
+    return parts
+
+
+def segment_pieces(segment):
+    # The (start, end) pieces of a segment, a packed window may have several
+    pieces = segment.get("pieces")
+    if pieces is None:
+        return [(int(segment["start"]), int(segment["end"]))]
+    return pieces
+
+
+def segment_audio(audio, segment):
+    pieces = segment_pieces(segment)
+    if len(pieces) == 1:
+        return audio[pieces[0][0] : pieces[0][1]]
+    return np.concatenate([audio[start:end] for start, end in pieces])
+
+
+def shift_segment(segment, offset):
+    # Move a segment, and its pieces if packed, by offset samples
+    shifted = dict(
+        segment, start=segment["start"] + offset, end=segment["end"] + offset
+    )
+    if segment.get("pieces") is not None:
+        shifted["pieces"] = [(s + offset, e + offset) for s, e in segment["pieces"]]
+    return shifted
 
 
 def compact_rst(sub_fn, encoding):
@@ -169,50 +468,96 @@ def compact_rst(sub_fn, encoding):
         # to original rst
         with open(sub_fn, encoding=encoding) as f:
             lines = f.readlines()
-        subs = []
+        cues = []
         for l in lines:
             items = l.split(" ")
             if len(items) < 4:
                 continue
-            subs.append(
-                srt.Subtitle(
-                    index=0,
-                    start=srt.srt_timestamp_to_timedelta(items[0]),
-                    end=srt.srt_timestamp_to_timedelta(items[2]),
-                    content=" ".join(items[3:]).strip(),
-                )
-            )
-        with open(base[: -len(COMPACT)] + ext, "wb") as f:
-            f.write(srt.compose(subs).encode(encoding, "replace"))
+            cues.append((items[0], items[2], " ".join(items[3:]).strip()))
+        starts, ends, contents = zip(*cues) if cues else ((), (), ())
+        Subtitles(
+            np.zeros(len(cues), np.int64),
+            [parse_timestamp(t) for t in starts],
+            [parse_timestamp(t) for t in ends],
+            contents,
+        ).save(base[: -len(COMPACT)] + ext, encoding)
     else:
         # to a compact version
-        with open(sub_fn, encoding=encoding) as f:
-            subs = srt.parse(f.read())
+        subs = Subtitles.load(sub_fn, encoding)
         with open(base + COMPACT + ext, "wb") as f:
             for s in subs:
                 f.write(
-                    f"{srt.timedelta_to_srt_timestamp(s.start)} --> {srt.timedelta_to_srt_timestamp(s.end)} "
+                    f"{format_timestamp(s.start)} --> {format_timestamp(s.end)} "
                     f"{cc.convert(s.content.strip())}\n".encode(encoding, "replace")
                 )
 
 
-def trans_srt_to_md(encoding, force, srt_fn, video_fn=None):
-    base, ext = os.path.splitext(srt_fn)
-    if ext != ".srt":
-        logging.fatal("only .srt file is supported")
-    md_fn = base + ext.split(".")[0] + ".md"
-
-    check_exists(md_fn, force)
+def _old_tasks(md, old_subs=None):
+    # [(start, end, text, mark)] of the subtitles in an existing markdown in
+    # milliseconds, the end is known only from the srt it was generated from
+    subs = {}
+    if old_subs is not None:
+        subs = {index: k for k, index in enumerate(old_subs.indices.tolist())}
+    tasks = []
+    for mark, task in md.tasks():
+        m = re.match(r"\[(\d+),(\d+):(\d+)\] *(.*)", task)
+        if not m:
+            continue
+        index, minutes, seconds, text = m.groups()
+        k = subs.get(int(index))
+        if k is not None and old_subs.contents[k].strip() == text.strip():
+            start, end = int(old_subs.starts[k]), int(old_subs.ends[k])
+        else:
+            start, end = (int(minutes) * 60 + int(seconds)) * 1000, None
+        tasks.append((start, end, text.strip(), mark))
+    return sorted(tasks, key=lambda t: t[0])
 
-    with open(srt_fn, encoding=encoding) as f:
-        subs = srt.parse(f.read())
 
+def carry_marks(old_tasks, subs, tolerance=2000):
+    # Return the mark of every subtitle in subs, taken from the old task of the
+    # same text around the same time, or else the one mostly overlapping it
+    starts = [t[0] for t in old_tasks]
+    used = set()
+    marks = []
+    for s in subs:
+        text = s.content.strip()
+        lo = bisect.bisect_left(starts, s.start - tolerance)
+        hi = bisect.bisect_right(starts, s.end + tolerance)
+        found = None
+        best = 0.5
+        for k in range(lo, hi):
+            if k in used:
+                continue
+            old_start, old_end, old_text, _ = old_tasks[k]
+            if old_text == text and abs(old_start - s.start) <= tolerance:
+                found = k
+                break
+            if old_end is not None:
+                overlap = min(s.end, old_end) - max(s.start, old_start)
+                union = max(s.end, old_end) - min(s.start, old_start)
+                if union > 0 and overlap / union >= best:
+                    found, best = k, overlap / union
+        if found is not None:
+            used.add(found)
+        marks.append(old_tasks[found][3] if found is not None else False)
+    return marks
+
+
+def save_md(md_fn, srt_fn, subs, encoding, video_fn=None, old_subs=None):
+    # Write the markdown to mark the subtitles. The marks of an existing one
+    # are carried over to the same sentences, and it is not written again if
+    # nothing changed. Return if written.
     md = MD(md_fn, encoding)
+    old_text = "".join(md.lines)
+    old_tasks = _old_tasks(md, old_subs)
+    marks = carry_marks(old_tasks, subs)
+    # Still done if every sentence and its mark are the same
+    done = md.done_editing() and [(t[2], t[3]) for t in old_tasks] == [
+        (c.strip(), m) for c, m in zip(subs.contents, marks)
+    ]
     md.clear()
-    md.add_done_editing(False)
+    md.add_done_editing(done)
     if video_fn:
-        if not is_video(video_fn):
-            logging.fatal(f"{video_fn} may not be a video")
         md.add_video(os.path.basename(video_fn))
     md.add(
         f"\nTexts generated from [{os.path.basename(srt_fn)}]({os.path.basename(srt_fn)})."
@@ -220,8 +565,29 @@ def trans_srt_to_md(encoding, force, srt_fn, video_fn=None):
         "The format is [subtitle_index,duration_in_second] subtitle context.\n\n"
     )
 
-    for s in subs:
-        sec = s.start.seconds
+    for s, mark in zip(subs, marks):
+        sec = s.start // 1000
         pre = f"[{s.index},{sec // 60:02d}:{sec % 60:02d}]"
-        md.add_task(False, f"{pre:11} {s.content.strip()}")
+        md.add_task(mark, f"{pre:11} {s.content.strip()}")
+    if "\n".join(md.lines) == old_text:
+        return False
+    n = sum(marks)
+    if n:
+        logging.info(f"Carried {n} marks over to the new {md_fn}")
     md.write()
+    return True
+
+
+def trans_srt_to_md(encoding, force, srt_fn, video_fn=None):
+    base, ext = os.path.splitext(srt_fn)
+    if ext != ".srt":
+        logging.fatal("only .srt file is supported")
+    md_fn = base + ext.split(".")[0] + ".md"
+
+    check_exists(md_fn, force)
+
+    subs = Subtitles.load(srt_fn, encoding)
+
+    if video_fn and not is_video(video_fn):
+        logging.fatal(f"{video_fn} may not be a video")
+    save_md(md_fn, srt_fn, subs, encoding, video_fn)
@@ -0,0 +1,105 @@
+from typing import Callable, List
+
+import numpy as np
+
+from . import utils
+from .type import SPEECH_ARRAY_INDEX
+
+
+# Detect speeches block by block while the audio is being decoded. The
+# segments are post-processed the same as detecting the whole audio at once,
+# and emitted as soon as the following audio can no longer change them.
+class StreamingVAD:
+    def __init__(
+        self,
+        detect_speech: Callable[[np.ndarray], List[SPEECH_ARRAY_INDEX]],
+        sampling_rate: int = 16000,
+        min_speech: float = 1.0,
+        expand_head: float = 0.2,
+        expand_tail: float = 0.0,
+        merge_gap: float = 0.5,
+        join_tolerance: float = 0.1,
+    ):
+        # detect_speech returns the speeches of a block, in samples
+        self.detect_speech = detect_speech
+        self.min_speech = min_speech * sampling_rate
+        self.expand_head = expand_head * sampling_rate
+        self.expand_tail = expand_tail * sampling_rate
+        self.merge_gap = merge_gap * sampling_rate
+        self.join_tolerance = join_tolerance * sampling_rate
+        # Number of samples fed
+        self.length = 0
+        self.num_emitted = 0
+        # The last speech, it may continue in the next block
+        self._open = None
+        # Finished speeches that may still merge with the following ones
+        self._pending = []
+        # The last speech of the emitted segments, it bounds the expansion of
+        # the next one
+        self._context = None
+
+    def feed(self, block: np.ndarray) -> List[SPEECH_ARRAY_INDEX]:
+        # Detect speeches in the next block, and return the segments finished
+        offset = self.length
+        for s in self.detect_speech(block):
+            start, end = s["start"] + offset, s["end"] + offset
+            # A speech crossing the block boundary is split by VAD, join it back
+            if (
+                self._open is not None
+                and s["start"] <= self.join_tolerance
+                and self._open["end"] >= offset - self.join_tolerance
+            ):
+                self._open["end"] = end
+            else:
+                self._close()
+                self._open = {"start": start, "end": end}
+        self.length += len(block)
+        if (
+            self._open is not None
+            and self._open["end"] < self.length - self.join_tolerance
+        ):
+            self._close()
+        return self._emit(final=False)
+
+    def flush(self, fallback: bool = True) -> List[SPEECH_ARRAY_INDEX]:
+        # Return the remaining segments after the last block. If fallback,
+        # return the whole audio when too few speeches are detected.
+        self._close()
+        segments = self._emit(final=True)
+        if fallback and self.num_emitted <= 1:
+            # Too few speeches detected, use the whole audio
+            return [{"start": 0, "end": self.length}]
+        return segments
+
+    def _close(self):
+        # Remove too short speeches once they are finished
+        if (
+            self._open is not None
+            and self._open["end"] - self._open["start"] > self.min_speech
+        ):
+            self._pending.append(self._open)
+        self._open = None
+
+    def _emit(self, final: bool) -> List[SPEECH_ARRAY_INDEX]:
+        context = [self._context] if self._context is not None else []
+        if not self._pending:
+            return []
+        speeches = utils.Segments.from_dicts(context + self._pending)
+        expanded = speeches.expand(self.expand_head, self.expand_tail, self.length)
+        merged = expanded.merge_adjacent(self.merge_gap)
+        # The group of the context was emitted already
+        segments = merged[len(context) :]
+        if not final:
+            # The last group may still be expanded or merged by later speeches
+            segments = segments[:-1]
+            if len(segments) == 0:
+                return []
+            # Keep the speeches of the last group
+            last_start = merged.starts[-1]
+            keep = expanded.starts[len(context) :] >= last_start
+            self._context = self._pending[int(np.argmax(keep)) - 1]
+            self._pending = [s for s, k in zip(self._pending, keep) if k]
+        else:
+            self._pending = []
+        self.num_emitted += len(segments)
+        return segments.to_dicts()
@@ -0,0 +1,119 @@
+import logging
+import os
+import threading
+import time
+from typing import Dict, Set, Tuple
+
+
+def scan(folder: str) -> Dict[str, Tuple[int, int]]:
+    # Return {path: (mtime_ns, size)} of the files in folder
+    files = {}
+    with os.scandir(folder) as it:
+        for entry in it:
+            try:
+                if entry.is_file():
+                    stat = entry.stat()
+                    files[entry.path] = (stat.st_mtime_ns, stat.st_size)
+            except FileNotFoundError:
+                pass
+    return files
+
+
+# Report the files changed in a folder by re-scanning it periodically, which
+# only needs a stat of each file
+class PollingWatcher:
+    def __init__(self, folder: str, interval: float = 2):
+        self.folder = folder
+        self.interval = interval
+        self._files = scan(folder)
+        self._woken = threading.Event()
+
+    def wait(self, timeout: float) -> Set[str]:
+        # Return the paths created, modified, moved or removed since the last
+        # call, waiting at most timeout seconds for a change or wake()
+        deadline = time.time() + timeout
+        while True:
+            woken = self._woken.wait(max(0, min(self.interval, deadline - time.time())))
+            self._woken.clear()
+            files = scan(self.folder)
+            changed = {
+                fn
+                for fn in files.keys() | self._files.keys()
+                if files.get(fn) != self._files.get(fn)
+            }
+            self._files = files
+            if changed or woken or time.time() >= deadline:
+                return changed
+
+    def wake(self):
+        # Return from wait() now, e.g. some work is finished
+        self._woken.set()
+
+    def close(self):
+        pass
+
+
+# Report the files changed in a folder by inotify (or the native API of other
+# systems) through watchdog, so nothing is done until a file changes
+class EventWatcher:
+    def __init__(self, folder: str, debounce: float = 0.5):
+        from watchdog.events import FileSystemEventHandler
+        from watchdog.observers import Observer
+
+        self.folder = folder
+        self.debounce = debounce
+        self._changed = set()
+        self._woken = False
+        self._cond = threading.Condition()
+        watcher = self
+
+        class Handler(FileSystemEventHandler):
+            def on_any_event(self, event):
+                if event.is_directory or event.event_type in (
+                    "opened",
+                    "closed_no_write",
+                ):
+                    return
+                paths = [event.src_path, getattr(event, "dest_path", "")]
+                with watcher._cond:
+                    watcher._changed.update(os.fsdecode(p) for p in paths if p)
+                    watcher._cond.notify()
+
+        self._observer = Observer()
+        self._observer.schedule(Handler(), folder, recursive=False)
+        self._observer.start()
+
+    def wait(self, timeout: float) -> Set[str]:
+        with self._cond:
+            self._cond.wait_for(lambda: self._changed or self._woken, timeout)
+            if not self._changed:
+                self._woken = False
+                return set()
+            self._woken = False
+        # Collect the burst of events of a write, e.g. created, modified and
+        # closed
+        time.sleep(self.debounce)
+        with self._cond:
+            changed, self._changed = self._changed, set()
+        return changed
+
+    def wake(self):
+        with self._cond:
+            self._woken = True
+            self._cond.notify()
+
+    def close(self):
+        self._observer.stop()
+        self._observer.join()
+
+
+def watch(folder: str, poll_interval: float = 2):
+    # Watch the folder by events if watchdog is installed, otherwise by polling
+    try:
+        return EventWatcher(folder)
+    except ImportError:
+        logging.info(
+            "watchdog is not installed, polling the folder every "
+            f"{poll_interval} sec. Install it by pip install '.[daemon]'"
+        )
+        return PollingWatcher(folder, poll_interval)
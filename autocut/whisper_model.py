@@ -1,15 +1,22 @@
+import bisect
 import datetime
 import logging
+import multiprocessing
 import os
+import re
+import time
 from abc import ABC, abstractmethod
-from typing import Literal, Union, List, Any, TypedDict
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import shared_memory
+from types import SimpleNamespace
+from typing import Literal, Union, List, Any
 
 import numpy as np
 import opencc
 import srt
-from pydub import AudioSegment
 from tqdm import tqdm
 
+from . import openai_client, utils
 from .type import SPEECH_ARRAY_INDEX, LANG
 
 # whisper sometimes generate traditional chinese, explicitly convert
@@ -17,6 +24,10 @@ cc = opencc.OpenCC("t2s")
 
 
 class AbstractWhisperModel(ABC):
+    # Whether transcribe can be called by several threads at the same time,
+    # see registry.model_lock
+    thread_safe = False
+
     def __init__(self, mode, sample_rate=16000):
         self.mode = mode
         self.whisper_model = None
@@ -38,11 +49,68 @@ class AbstractWhisperModel(ABC):
     def gen_srt(self, transcribe_results: List[Any]) -> List[srt.Subtitle]:
         pass
 
+    def _origin_seconds(self, origin: SPEECH_ARRAY_INDEX, t: float) -> float:
+        # Map a time in the transcribed audio of origin, which may concatenate
+        # several pieces, back to the time in the source audio
+        pos = t * self.sample_rate
+        for start, end in utils.segment_pieces(origin):
+            if pos <= end - start:
+                return (start + pos) / self.sample_rate
+            pos -= end - start
+        return origin["end"] / self.sample_rate
+
+
+# States of a worker process in the CPU parallel transcription
+_worker = {}
+
+
+def _init_cpu_worker(model_name: str, cpu_threads: int):
+    # Load the model once per worker process
+    import torch
+    import whisper
+
+    torch.set_num_threads(cpu_threads)
+    _worker["model"] = whisper.load_model(model_name, "cpu")
+
+
+def _attach_audio(audio_ref):
+    # Map the audio shared by the parent process, without copying it
+    if _worker.get("audio_ref") != audio_ref:
+        _worker.pop("audio", None)
+        if "shm" in _worker:
+            _worker.pop("shm").close()
+        kind, name, length = audio_ref
+        if kind == "shm":
+            shm = shared_memory.SharedMemory(name=name)
+            _worker["shm"] = shm
+            audio = np.ndarray((length,), np.float32, buffer=shm.buf)
+        else:
+            audio = np.memmap(name, np.float32, mode="c", shape=(length,))
+        _worker["audio"], _worker["audio_ref"] = audio, audio_ref
+    return _worker["audio"]
+
+
+def _transcribe_in_worker(task):
+    i, audio_ref, seg, lang, prompt = task
+    audio = _attach_audio(audio_ref)
+    r = _worker["model"].transcribe(
+        utils.segment_audio(audio, seg),
+        task="transcribe",
+        language=lang,
+        initial_prompt=prompt,
+    )
+    r["origin_timestamp"] = seg
+    return i, r
+
 
 class WhisperModel(AbstractWhisperModel):
     def __init__(self, sample_rate=16000):
         super().__init__("whisper", sample_rate)
         self.device = None
+        self.model_name = None
+        self.cpu_threads = 0
+        self.num_workers = 0
+        self._pool = None
 
     def load(
         self,
@@ -50,23 +118,83 @@ class WhisperModel(AbstractWhisperModel):
             "tiny", "base", "small", "medium", "large", "large-v2"
         ] = "small",
         device: Union[Literal["cpu", "cuda"], None] = None,
+        cpu_threads: int = 0,
+        num_workers: int = 0,
     ):
-        self.device = device
-
+        import torch
         import whisper
 
-        self.whisper_model = whisper.load_model(model_name, device)
+        # The same device as whisper.load_model chooses
+        self.device = device or ("cuda" if torch.cuda.is_available() else "cpu")
+        self.model_name = model_name
+        # Every worker process loads its own model, so they are only used when
+        # asked for explicitly
+        self.cpu_threads, self.num_workers = (
+            utils.cpu_parallelism(cpu_threads, num_workers)
+            if num_workers > 1
+            else (cpu_threads, 1)
+        )
+        if self._use_workers():
+            # Not loaded in this process, all the segments go to the workers
+            return
+        self.whisper_model = whisper.load_model(model_name, self.device)
 
-    def _transcribe(self, audio, seg, lang, prompt):
+    def _use_workers(self):
+        return self.device == "cpu" and self.num_workers > 1
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool = None
+
+    def _transcribe(self, audio, seg, lang, prompt, verbose=None):
         r = self.whisper_model.transcribe(
-            audio[int(seg["start"]) : int(seg["end"])],
+            utils.segment_audio(audio, seg),
             task="transcribe",
             language=lang,
             initial_prompt=prompt,
+            verbose=verbose,
         )
         r["origin_timestamp"] = seg
         return r
 
+    def _parallel_transcribe(self, audio, speech_array_indices, lang, prompt):
+        if self._pool is None:
+            # Spawn instead of fork, torch is not fork safe
+            self._pool = multiprocessing.get_context("spawn").Pool(
+                processes=self.num_workers,
+                initializer=_init_cpu_worker,
+                initargs=(self.model_name, self.cpu_threads),
+            )
+
+        shm = None
+        if (
+            isinstance(audio, np.memmap)
+            and audio.filename
+            and os.path.exists(audio.filename)
+        ):
+            audio_ref = ("memmap", audio.filename, len(audio))
+        else:
+            shm = shared_memory.SharedMemory(create=True, size=max(audio.nbytes, 1))
+            np.ndarray(audio.shape, np.float32, buffer=shm.buf)[:] = audio
+            audio_ref = ("shm", shm.name, len(audio))
+        tasks = [
+            (i, audio_ref, seg, lang, prompt)
+            for i, seg in enumerate(speech_array_indices)
+        ]
+        res = [None] * len(tasks)
+        try:
+            for i, r in tqdm(
+                self._pool.imap_unordered(_transcribe_in_worker, tasks),
+                total=len(tasks),
+            ):
+                res[i] = r
+        finally:
+            if shm is not None:
+                shm.close()
+                shm.unlink()
+        return res
+
     def transcribe(
         self,
         audio: np.ndarray,
@@ -74,49 +202,17 @@ class WhisperModel(AbstractWhisperModel):
         lang: LANG,
         prompt: str,
     ):
-        res = []
-        if self.device == "cpu" and len(speech_array_indices) > 1:
-            from multiprocessing import Pool
-
-            pbar = tqdm(total=len(speech_array_indices))
-
-            pool = Pool(processes=4)
-            sub_res = []
-            # TODO, a better way is merging these segments into a single one, so whisper can get more context
-            for seg in speech_array_indices:
-                sub_res.append(
-                    pool.apply_async(
-                        self._transcribe,
-                        (
-                            self.whisper_model,
-                            audio,
-                            seg,
-                            lang,
-                            prompt,
-                        ),
-                        callback=lambda x: pbar.update(),
-                    )
-                )
-            pool.close()
-            pool.join()
-            pbar.close()
-            res = [i.get() for i in sub_res]
-        else:
-            for seg in (
-                speech_array_indices
-                if len(speech_array_indices) == 1
-                else tqdm(speech_array_indices)
-            ):
-                r = self.whisper_model.transcribe(
-                    audio[int(seg["start"]) : int(seg["end"])],
-                    task="transcribe",
-                    language=lang,
-                    initial_prompt=prompt,
-                    verbose=False if len(speech_array_indices) == 1 else None,
-                )
-                r["origin_timestamp"] = seg
-                res.append(r)
-        return res
+        if self._use_workers():
+            return self._parallel_transcribe(audio, speech_array_indices, lang, prompt)
+
+        if len(speech_array_indices) == 1:
+            return [
+                self._transcribe(audio, speech_array_indices[0], lang, prompt, False)
+            ]
+        return [
+            self._transcribe(audio, seg, lang, prompt)
+            for seg in tqdm(speech_array_indices)
+        ]
 
     def gen_srt(self, transcribe_results):
         subs = []
@@ -135,9 +231,9 @@ class WhisperModel(AbstractWhisperModel):
         for r in transcribe_results:
             origin = r["origin_timestamp"]
             for s in r["segments"]:
-                start = s["start"] + origin["start"] / self.sample_rate
+                start = self._origin_seconds(origin, s["start"])
                 end = min(
-                    s["end"] + origin["start"] / self.sample_rate,
+                    self._origin_seconds(origin, s["end"]),
                     origin["end"] / self.sample_rate,
                 )
                 if start > end:
@@ -155,26 +251,26 @@ class OpenAIModel(AbstractWhisperModel):
     max_single_audio_bytes = 25 * 2**20  # 25MB
     split_audio_bytes = 23 * 2**20  # 23MB, 2MB for safety(header, etc.)
     rpm = 3
+    # The requests are limited by the client shared by the threads
+    thread_safe = True
 
     def __init__(self, rpm: int, sample_rate=16000):
         super().__init__("openai_whisper-1", sample_rate)
         self.rpm = rpm
-        if (
-            os.environ.get("OPENAI_API_KEY") is None
-            and os.environ.get("OPENAI_API_KEY_PATH") is None
-        ):
+        if openai_client.api_key() is None:
             raise Exception("OPENAI_API_KEY is not set")
 
     def load(self, model_name: Literal["whisper-1"] = "whisper-1"):
         try:
-            import openai
+            import httpx
         except ImportError:
             raise Exception(
                 "Please use openai mode(pip install '.[openai]') or all mode(pip install '.[all]')"
             )
-        from functools import partial
 
-        self.whisper_model = partial(openai.Audio.transcribe, model=model_name)
+        self.whisper_model = openai_client.OpenAIClient(
+            openai_client.api_key(), self.rpm, model=model_name
+        )
 
     def transcribe(
         self,
@@ -184,111 +280,86 @@ class OpenAIModel(AbstractWhisperModel):
         lang: LANG,
         prompt: str,
     ) -> List[srt.Subtitle]:
+        # Upload the decoded audio as FLAC in memory, rather than decoding
+        # input again and writing WAV files beside it
+        chunks = []
+        for window in self._plan(audio, speech_array_indices):
+            chunks.extend(self._encode(audio, window))
+        if not chunks:
+            return []
+        return self._transcribe(chunks, lang, prompt)
+
+    def _transcribe(self, chunks, lang: LANG, prompt: str) -> List[srt.Subtitle]:
+        # The rpm may be changed after loaded, see registry
+        self.whisper_model.rpm = self.rpm
+        pbar = tqdm(total=len(chunks), disable=len(chunks) <= 1)
+        texts = self.whisper_model.transcribe_all(
+            [(f"{i:05d}.flac", data) for i, (_, data) in enumerate(chunks)],
+            prompt,
+            lang,
+            callback=pbar.update,
+        )
+        pbar.close()
+
         res = []
-        name, _ = os.path.splitext(input)
-        raw_audio = AudioSegment.from_file(input)
-        ms_bytes = len(raw_audio[:1].raw_data)
-        audios: List[
-            TypedDict(
-                "AudioInfo", {"input": str, "audio": AudioSegment, "start_ms": float}
-            )
-        ] = []
-
-        i = 0
-        for index in speech_array_indices:
-            start = int(index["start"]) / self.sample_rate * 1000
-            end = int(index["end"]) / self.sample_rate * 1000
-            audio_seg = raw_audio[start:end]
-            if len(audio_seg.raw_data) < self.split_audio_bytes:
-                temp_file = f"{name}_temp_{i}.wav"
-                audios.append(
-                    {"input": temp_file, "audio": audio_seg, "start_ms": start}
-                )
-            else:
-                logging.info(
-                    f"Long audio with a size({len(audio_seg.raw_data)} bytes) greater than 25M({25 * 2 ** 20} bytes) "
-                    "will be segmented"
-                    "due to Openai's API restrictions on files smaller than 25M"
-                )
-                split_num = len(audio_seg.raw_data) // self.split_audio_bytes + 1
-                for j in range(split_num):
-                    temp_file = f"{name}_{i}_temp_{j}.wav"
-                    split_audio = audio_seg[
-                        j
-                        * self.split_audio_bytes
-                        // ms_bytes : (j + 1)
-                        * self.split_audio_bytes
-                        // ms_bytes
-                    ]
-                    audios.append(
-                        {
-                            "input": temp_file,
-                            "audio": split_audio,
-                            "start_ms": start + j * self.split_audio_bytes // ms_bytes,
-                        }
-                    )
-            i += 1
-
-        if len(audios) > 1:
-            from multiprocessing import Pool
-
-            pbar = tqdm(total=len(audios))
-
-            pool = Pool(processes=min(8, self.rpm))
-            sub_res = []
-            for audio in audios:
-                sub_res.append(
-                    pool.apply_async(
-                        self._transcribe,
-                        (
-                            audio["input"],
-                            audio["audio"],
-                            prompt,
-                            lang,
-                            audio["start_ms"],
-                        ),
-                        callback=lambda x: pbar.update(),
+        for (window, _), text in zip(chunks, texts):
+            for sub in srt.parse(text):
+                # Map the time in the upload back to the source audio
+                for attr in ("start", "end"):
+                    t = getattr(sub, attr).total_seconds()
+                    setattr(
+                        sub,
+                        attr,
+                        datetime.timedelta(seconds=self._origin_seconds(window, t)),
                     )
-                )
-            pool.close()
-            pool.join()
-            pbar.close()
-            for subs in sub_res:
-                subtitles = subs.get()
-                res.extend(subtitles)
-        else:
-            res = self._transcribe(
-                audios[0]["input"],
-                audios[0]["audio"],
-                prompt,
-                lang,
-                audios[0]["start_ms"],
-            )
-
+                res.append(sub)
         return res
 
-    def _transcribe(
-        self, input: srt, audio: AudioSegment, prompt: str, lang: LANG, start_ms: float
-    ):
-        audio.export(input, "wav")
-        subtitles = self.whisper_model(
-            file=open(input, "rb"), prompt=prompt, language=lang, response_format="srt"
+    def _plan(
+        self, audio: np.ndarray, speech_array_indices: List[SPEECH_ARRAY_INDEX]
+    ) -> List[SPEECH_ARRAY_INDEX]:
+        # Pack the neighbouring speeches into uploads near the size limit, to
+        # send as few requests as possible. The size is estimated by the
+        # compression ratio of the first minute of speech.
+        if not speech_array_indices:
+            return []
+        sample = []
+        for seg in speech_array_indices:
+            sample.append(utils.segment_audio(audio, seg)[: 60 * self.sample_rate])
+            if sum(len(s) for s in sample) >= 60 * self.sample_rate:
+                break
+        sample = np.concatenate(sample)[: 60 * self.sample_rate]
+        bytes_per_sample = len(utils.encode_audio(sample, self.sample_rate)) / max(
+            len(sample), 1
         )
-        os.remove(input)
-        return list(
-            map(
-                lambda x: (
-                    setattr(
-                        x, "start", x.start + datetime.timedelta(milliseconds=start_ms)
-                    ),
-                    setattr(
-                        x, "end", x.end + datetime.timedelta(milliseconds=start_ms)
-                    ),
-                    x,
-                )[-1],
-                list(srt.parse(subtitles)),
-            )
+        # Leave a margin for the louder or noisier parts
+        max_samples = int(self.split_audio_bytes / bytes_per_sample * 0.9)
+        return self._pack(audio, speech_array_indices, max_samples)
+
+    def _pack(self, audio, segments, max_samples):
+        parts = []
+        for seg in segments:
+            parts.extend(utils.split_at_silence(audio, seg, max_samples))
+        return utils.pack_segments(parts, max_samples)
+
+    def _encode(self, audio: np.ndarray, window: SPEECH_ARRAY_INDEX):
+        # Return [(window, flac bytes)], a window still above the size limit
+        # is packed again into smaller ones
+        data = utils.encode_audio(utils.segment_audio(audio, window), self.sample_rate)
+        length = sum(e - s for s, e in utils.segment_pieces(window))
+        if len(data) <= self.split_audio_bytes or length <= self.sample_rate:
+            return [(window, data)]
+        max_samples = int(length * self.split_audio_bytes / len(data) * 0.9)
+        logging.info(
+            f"Audio of {len(data)} bytes is above the limit of {self.split_audio_bytes} "
+            f"bytes of the Openai API, split into {max_samples / self.sample_rate:.0f} "
+            "sec uploads"
         )
+        pieces = [{"start": s, "end": e} for s, e in utils.segment_pieces(window)]
+        res = []
+        for w in self._pack(audio, pieces, max_samples):
+            res.extend(self._encode(audio, w))
+        return res
 
     def gen_srt(self, transcribe_results: List[srt.Subtitle]):
         if len(transcribe_results) == 0:
@@ -311,9 +382,17 @@ class OpenAIModel(AbstractWhisperModel):
 
 
 class FasterWhisperModel(AbstractWhisperModel):
+    # The longest clip of the batched pipeline, in seconds
+    max_clip_seconds = 30
+    # ctranslate2 runs the calls of several threads on its workers
+    thread_safe = True
+
     def __init__(self, sample_rate=16000):
         super().__init__("faster-whisper", sample_rate)
         self.device = None
+        self.num_workers = 1
+        self.batch_size = 1
+        self._batched_pipeline = None
 
     def load(
         self,
@@ -321,6 +400,9 @@ class FasterWhisperModel(AbstractWhisperModel):
             "tiny", "base", "small", "medium", "large", "large-v2"
         ] = "small",
         device: Union[Literal["cpu", "cuda"], None] = None,
+        compute_type: str = "default",
+        cpu_threads: int = 0,
+        num_workers: int = 0,
     ):
         try:
             from faster_whisper import WhisperModel
@@ -330,10 +412,90 @@ class FasterWhisperModel(AbstractWhisperModel):
             )
 
         self.device = device if device else "cpu"
-        self.whisper_model = WhisperModel(model_name, self.device)
+        if self.device == "cpu":
+            cpu_threads, num_workers = utils.cpu_parallelism(cpu_threads, num_workers)
+        self.num_workers = max(num_workers, 1)
+        self.whisper_model = WhisperModel(
+            model_name,
+            self.device,
+            compute_type=compute_type,
+            cpu_threads=cpu_threads,
+            num_workers=self.num_workers,
+        )
+
+    def _transcribe(self, audio, seg, lang, prompt):
+        segments, info = self.whisper_model.transcribe(
+            utils.segment_audio(audio, seg),
+            task="transcribe",
+            language=lang,
+            initial_prompt=prompt,
+            vad_filter=False,
+        )
+        segments = list(segments)  # The transcription will actually run here.
+        return {"origin_timestamp": seg, "segments": segments, "info": info}
+
+    def _get_batched_pipeline(self):
+        if self._batched_pipeline is None:
+            import faster_whisper
+
+            # clip_timestamps in seconds are only converted to samples since 1.2
+            version = tuple(
+                map(int, re.findall(r"\d+", faster_whisper.__version__)[:2])
+            )
+            if version < (1, 2):
+                logging.warning(
+                    "Batched inference needs faster-whisper>=1.2, "
+                    "fall back to transcribe segments concurrently"
+                )
+                return None
+            from faster_whisper import BatchedInferencePipeline
+
+            self._batched_pipeline = BatchedInferencePipeline(model=self.whisper_model)
+        return self._batched_pipeline
+
+    def _batched_transcribe(self, pipeline, audio, speech_array_indices, lang, prompt):
+        # Split the pieces of segments into clips no longer than the model
+        # window and decode them in batches, then assign the results back to
+        # their segments
+        max_clip = self.max_clip_seconds * self.sample_rate
+        clips = []
+        # The segment index and the clip's offset in that segment's audio
+        owners = []
+        for i, seg in enumerate(speech_array_indices):
+            offset = 0
+            for piece_start, piece_end in utils.segment_pieces(seg):
+                for start in range(piece_start, piece_end, max_clip):
+                    end = min(start + max_clip, piece_end)
+                    clips.append(
+                        {
+                            "start": start / self.sample_rate,
+                            "end": end / self.sample_rate,
+                        }
+                    )
+                    owners.append((i, offset + start - piece_start))
+                offset += piece_end - piece_start
+        segments, info = pipeline.transcribe(
+            audio,
+            language=lang,
+            initial_prompt=prompt,
+            vad_filter=False,
+            clip_timestamps=clips,
+            batch_size=self.batch_size,
+        )
 
-    def _transcribe(self):
-        raise Exception("Not implemented")
+        res = [
+            {"origin_timestamp": seg, "segments": [], "info": info}
+            for seg in speech_array_indices
+        ]
+        clip_starts = [c["start"] for c in clips]
+        for s in segments:
+            j = max(bisect.bisect_right(clip_starts, s.start) - 1, 0)
+            i, offset = owners[j]
+            shift = offset / self.sample_rate - clip_starts[j]
+            res[i]["segments"].append(
+                SimpleNamespace(start=s.start + shift, end=s.end + shift, text=s.text)
+            )
+        return res
 
     def transcribe(
         self,
@@ -342,18 +504,34 @@ class FasterWhisperModel(AbstractWhisperModel):
         lang: LANG,
         prompt: str,
     ):
-        res = []
-        for seg in speech_array_indices:
-            segments, info = self.whisper_model.transcribe(
-                audio[int(seg["start"]) : int(seg["end"])],
-                task="transcribe",
-                language=lang,
-                initial_prompt=prompt,
-                vad_filter=False,
+        tic = time.time()
+        pipeline = self._get_batched_pipeline() if self.batch_size > 1 else None
+        if pipeline is not None:
+            res = self._batched_transcribe(
+                pipeline, audio, speech_array_indices, lang, prompt
             )
-            segments = list(segments)  # The transcription will actually run here.
-            r = {"origin_timestamp": seg, "segments": segments, "info": info}
-            res.append(r)
+        elif self.num_workers > 1 and len(speech_array_indices) > 1:
+            # faster-whisper runs transcribe calls from multiple threads in parallel
+            with ThreadPoolExecutor(self.num_workers) as pool:
+                res = list(
+                    tqdm(
+                        pool.map(
+                            lambda seg: self._transcribe(audio, seg, lang, prompt),
+                            speech_array_indices,
+                        ),
+                        total=len(speech_array_indices),
+                    )
+                )
+        else:
+            res = [
+                self._transcribe(audio, seg, lang, prompt)
+                for seg in speech_array_indices
+            ]
+        elapsed = max(time.time() - tic, 1e-6)
+        logging.info(
+            f"Transcribed {len(speech_array_indices)} segments in {elapsed:.1f} sec, "
+            f"{len(speech_array_indices) / elapsed:.1f} segments/sec"
+        )
         return res
 
     def gen_srt(self, transcribe_results):
@@ -374,9 +552,9 @@ class FasterWhisperModel(AbstractWhisperModel):
             origin = r["origin_timestamp"]
             for seg in r["segments"]:
                 s = dict(start=seg.start, end=seg.end, text=seg.text)
-                start = s["start"] + origin["start"] / self.sample_rate
+                start = self._origin_seconds(origin, s["start"])
                 end = min(
-                    s["end"] + origin["start"] / self.sample_rate,
+                    self._origin_seconds(origin, s["end"]),
                     origin["end"] / self.sample_rate,
                 )
                 if start > end:
@@ -6,7 +6,6 @@ requirements = [
     "openai-whisper",
     "opencc-python-reimplemented",
     "parameterized",
-    "pydub",
     "srt",
     "torchaudio",
     "tqdm",
@@ -17,9 +16,10 @@ setup(
     name="autocut",
     install_requires=requirements,
     extras_require={
-        "all": ["openai", "faster-whisper"],
-        "openai": ["openai"],
-        "faster": ["faster-whisper"],
+        "all": ["httpx", "faster-whisper>=1.2", "watchdog"],
+        "openai": ["httpx"],
+        "faster": ["faster-whisper>=1.2"],
+        "daemon": ["watchdog"],
     },
     packages=find_packages(),
     entry_points={
@@ -0,0 +1,67 @@
+# Compare autocut.subtitle with srt on parsing and writing a large srt file
+#
+#   PYTHONPATH=. python test/benchmark_srt.py [--cues 100000]
+
+import argparse
+import datetime
+import random
+import time
+
+import srt
+
+from autocut.subtitle import Subtitles
+
+
+def whisper_subs(n):
+    # Sentences one after another, as transcribed
+    subs = []
+    t = 0
+    for i in range(n):
+        start = t + random.randint(0, 1000)
+        t = start + random.randint(500, 5000)
+        subs.append(
+            srt.Subtitle(
+                i + 1,
+                datetime.timedelta(milliseconds=start),
+                datetime.timedelta(milliseconds=t),
+                "字幕" * random.randint(1, 20),
+            )
+        )
+    return subs
+
+
+def timeit(fn, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        tic = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - tic)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--cues", type=int, default=100000)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    subs = whisper_subs(args.cues)
+    text = srt.compose(subs)
+    parsed = list(srt.parse(text))
+    store = Subtitles.parse(text)
+    assert store.compose() == srt.compose(parsed)
+
+    results = [
+        ("parse", lambda: list(srt.parse(text)), lambda: Subtitles.parse(text)),
+        ("compose", lambda: srt.compose(parsed), store.compose),
+    ]
+    print(f"{len(store)} cues, {len(text) / 2**20:.1f} MB")
+    for name, srt_fn, store_fn in results:
+        a, b = timeit(srt_fn, args.repeat), timeit(store_fn, args.repeat)
+        print(
+            f"{name:8} srt {a * 1000:8.1f} ms  subtitle {b * 1000:8.1f} ms  {a / b:5.1f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -46,14 +46,38 @@ class TestArgs:
     def __init__(self):
         self.inputs = []
         self.bitrate = "10m"
+        self.cut_engine = "moviepy"
+        self.export_profile = "default"
+        self.encoder_threads = 0
+        self.hwaccel = "none"
+        self.preview = False
+        self.preview_height = 360
+        self.render_cache = None
+        self.encode_jobs = 0
+        self.render_cache_size = 0
         self.encoding = "utf-8"
         self.sampling_rate = 16000
         self.lang = "zh"
         self.prompt = ""
         self.whisper_model = "small"
         self.device = None
+        self.compute_type = "default"
+        self.cpu_threads = 0
+        self.num_workers = 0
+        self.batch_size = 1
+        self.pack_segments = True
+        self.stream_vad = True
+        self.prefetch = 1
+        self.transcribe_cache = None
+        self.transcribe_cache_size = 0
         self.vad = False
+        self.audio_cache_dir = None
         self.force = False
+        self.job_store = None
+        self.transcribe_workers = 1
+        self.cut_workers = 0
+        self.stable_seconds = 10
+        self.live_interval = 60
         self.whisper_mode = (
             "faster" if os.environ.get("WHISPER_MODE") == "faster" else "whisper"
         )
@@ -0,0 +1,113 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import numpy as np
+
+from autocut.cache import RenderCache, TranscribeCache
+
+
+class TestTranscribeCache(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.cache = TranscribeCache(os.path.join(self.folder, "transcribe.db"))
+        self.settings = {"mode": "whisper", "model": "small", "lang": "zh"}
+
+    def tearDown(self):
+        self.cache.close()
+        shutil.rmtree(self.folder)
+
+    def test_key(self):
+        audio = np.random.rand(16000).astype(np.float32)
+        key = TranscribeCache.key(audio, self.settings)
+        self.assertEqual(key, TranscribeCache.key(audio.copy(), dict(self.settings)))
+        self.assertNotEqual(
+            key, TranscribeCache.key(audio, dict(self.settings, lang="en"))
+        )
+        audio[0] += 1
+        self.assertNotEqual(key, TranscribeCache.key(audio, self.settings))
+
+    def test_get_put(self):
+        self.assertIsNone(self.cache.get("a"))
+        self.cache.put("a", {"segments": [{"text": "hello"}]})
+        self.assertEqual(self.cache.get("a"), {"segments": [{"text": "hello"}]})
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+        self.assertIn("1 hits, 1 misses, 1 results", self.cache.stats())
+
+    def test_evict(self):
+        self.cache.max_bytes = 3000
+        for key in "abcd":
+            self.cache.put(key, b"x" * 1000)
+        # The least recently used ones are evicted
+        self.assertIsNone(self.cache.get("a"))
+        self.assertIsNotNone(self.cache.get("d"))
+
+
+class TestRenderCache(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.cache = RenderCache(os.path.join(self.folder, "render"))
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def _write(self, name, size):
+        fn = os.path.join(self.folder, name)
+        with open(fn, "wb") as f:
+            f.write(os.urandom(size))
+        return fn
+
+    def test_fingerprint(self):
+        fn = self._write("a.mp4", 3000)
+        fp = RenderCache.fingerprint(fn, sample_bytes=1000)
+        self.assertEqual(fp, RenderCache.fingerprint(fn, sample_bytes=1000))
+        # Changed in the tail
+        with open(fn, "r+b") as f:
+            f.seek(2500)
+            f.write(b"x")
+        self.assertNotEqual(fp, RenderCache.fingerprint(fn, sample_bytes=1000))
+
+    def test_get_put(self):
+        key = RenderCache.key("source", 1.0, 2.5, {"codec": "libx264"})
+        self.assertNotEqual(
+            key, RenderCache.key("source", 1.0, 2.5, {"codec": "libx265"})
+        )
+        self.assertIsNone(self.cache.get(key))
+        fn = self.cache.put(key, self._write("segment.mp4", 100))
+        self.assertEqual(self.cache.get(key), fn)
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+        self.cache.put_json("source", {"max_volume": -3.5})
+        self.assertEqual(self.cache.get_json("source"), {"max_volume": -3.5})
+
+    def test_evict(self):
+        self.cache.max_bytes = 3000
+        for key in "abcd":
+            self.cache.release([self.cache.put(key, self._write(key, 1000))])
+            time.sleep(0.01)
+        self.cache.release([self.cache.get("a")])
+        self.cache.evict()
+        # The least recently used ones are evicted
+        self.assertIsNone(self.cache.get("b"))
+        self.assertIsNotNone(self.cache.get("a"))
+        self.assertIsNotNone(self.cache.get("d"))
+
+    def test_evict_pinned(self):
+        self.cache.max_bytes = 1000
+        a = self.cache.put("a", self._write("a", 1000))
+        self.cache.release([a])
+        time.sleep(0.01)
+        b = self.cache.put("b", self._write("b", 1000))
+        # Another worker evicts while b is used, only a is removed
+        other = RenderCache(os.path.join(self.folder, "render"), 0)
+        other.evict()
+        self.assertFalse(os.path.exists(a))
+        self.assertTrue(os.path.exists(b))
+        self.assertEqual(self.cache.get("b"), b)
+        self.cache.release([b])
+        other.evict()
+        self.assertTrue(os.path.exists(b))
+        self.cache.release([b])
+        other.evict()
+        self.assertFalse(os.path.exists(b))
@@ -1,10 +1,13 @@
 import logging
 import os
+import shutil
+import tempfile
 import unittest
 
 from parameterized import parameterized, param
 
-from autocut.cut import Cutter
+from autocut import render, utils
+from autocut.cut import Cutter, Merger
 from config import TestArgs, TEST_MEDIA_PATH, TEST_MEDIA_FILE_SIMPLE, TEST_CONTENT_PATH
 
 
@@ -61,3 +64,171 @@ class TestCut(unittest.TestCase):
         self.assertTrue(
             os.path.exists(namepart + "mp4") or os.path.exists(namepart + "mp3")
         )
+
+    @parameterized.expand([param("fast-preview"), param("archive")])
+    def test_export_profile_cut(self, profile):
+        args = TestArgs()
+        args.export_profile = profile
+        args.inputs = [
+            os.path.join(TEST_MEDIA_PATH, "test001.mp4"),
+            os.path.join(TEST_CONTENT_PATH, "test_srt.srt"),
+        ]
+        Cutter(args).run()
+        info = render.probe(os.path.join(TEST_MEDIA_PATH, "test001_cut.mp4"))
+        codec = "hevc" if profile == "archive" else "h264"
+        self.assertEqual(render.get_stream(info, "video")["codec_name"], codec)
+
+    @parameterized.expand([param(1), param(2)])
+    def test_ffmpeg_cut(self, encode_jobs):
+        args = TestArgs()
+        args.cut_engine = "ffmpeg"
+        args.encode_jobs = encode_jobs
+        args.force = True
+        args.render_cache = tempfile.mkdtemp()
+        args.render_cache_size = 100
+        args.inputs = [
+            os.path.join(TEST_MEDIA_PATH, "test001.mp4"),
+            os.path.join(TEST_CONTENT_PATH, "test_srt.srt"),
+        ]
+        output_fn = os.path.join(TEST_MEDIA_PATH, "test001_cut.mp4")
+        try:
+            Cutter(args).run()
+            duration = float(render.probe(output_fn)["format"]["duration"])
+            segments = [f for f in os.listdir(args.render_cache) if f.endswith("mp4")]
+            # Cut again by the cached segments, not encoded again
+            inodes = [
+                os.stat(os.path.join(args.render_cache, f)).st_ino for f in segments
+            ]
+            Cutter(args).run()
+            self.assertEqual(
+                inodes,
+                [os.stat(os.path.join(args.render_cache, f)).st_ino for f in segments],
+            )
+            self.assertAlmostEqual(
+                float(render.probe(output_fn)["format"]["duration"]), duration, 1
+            )
+        finally:
+            shutil.rmtree(args.render_cache)
+
+    def test_preview_cut(self):
+        args = TestArgs()
+        args.preview = True
+        args.inputs = [
+            os.path.join(TEST_MEDIA_PATH, "test001.mp4"),
+            os.path.join(TEST_CONTENT_PATH, "test_srt.srt"),
+        ]
+        preview_fn = os.path.join(TEST_MEDIA_PATH, "test001_preview.mp4")
+        try:
+            Cutter(args).run()
+            info = render.probe(preview_fn)
+            self.assertEqual(render.get_stream(info, "video")["height"], 360)
+            self.assertIsNotNone(render.get_stream(info, "audio"))
+        finally:
+            if os.path.exists(preview_fn):
+                os.remove(preview_fn)
+        self.assertFalse(
+            os.path.exists(os.path.join(TEST_MEDIA_PATH, "test001_cut.mp4"))
+        )
+
+    @parameterized.expand([param(file) for file in TEST_MEDIA_FILE_SIMPLE])
+    def test_ffmpeg_copy_cut(self, file_name):
+        args = TestArgs()
+        args.cut_engine = "ffmpeg-copy"
+        args.inputs = [
+            os.path.join(TEST_MEDIA_PATH, file_name),
+            os.path.join(TEST_CONTENT_PATH, "test_srt.srt"),
+        ]
+        cut = Cutter(args)
+        cut.run()
+        namepart = os.path.join(
+            TEST_MEDIA_PATH, os.path.splitext(file_name)[0] + "_cut."
+        )
+        self.assertTrue(
+            os.path.exists(namepart + "mp4") or os.path.exists(namepart + "mp3")
+        )
+
+    @parameterized.expand(
+        [
+            param([(0.3, 2.3), (4.7, 7.0)]),
+            # Starts and ends on keyframes, and no keyframe inside
+            param([(0.542208, 2.002), (3.1, 3.3)]),
+            param([(1.2, 6.5)]),
+        ]
+    )
+    def test_ffmpeg_copy_cut_duration(self, segments):
+        media_fn = os.path.join(TEST_MEDIA_PATH, "test001.mp4")
+        output_fn = os.path.join(TEST_MEDIA_PATH, "test001_cut.mp4")
+        render.cut_video(
+            media_fn, [{"start": s, "end": e} for s, e in segments], output_fn
+        )
+        info = render.probe(output_fn)
+        frame = render.frame_duration(render.get_stream(info, "video"))
+        self.assertAlmostEqual(
+            float(info["format"]["duration"]),
+            sum(e - s for s, e in segments),
+            delta=frame,
+        )
+
+
+class TestMerger(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.videos = []
+        for name in ["a", "b"]:
+            fn = os.path.join(self.folder, name + ".mp4")
+            md = utils.MD(utils.change_ext(fn, "md"), "utf-8")
+            md.add_done_editing(False)
+            md.add_task(True, f"[1,00:00] hello from {name}")
+            md.write()
+            self.videos.append(fn)
+        args = TestArgs()
+        args.inputs = [os.path.join(self.folder, "autocut.md")]
+        self.merger = Merger(args)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_write_md(self):
+        md_fn = self.merger.args.inputs[0]
+        self.merger.write_md(self.videos)
+        md = utils.MD(md_fn, "utf-8")
+        self.assertEqual(len(md.tasks()), 3)
+        self.assertIn("hello from b", md.tasks()[2][1])
+        # Select a video, it is kept when the list is rewritten
+        md.lines[-1] = md.lines[-1].replace("[ ]", "[x]")
+        md.write()
+        state = utils.file_state(md_fn)
+        self.merger.write_md(self.videos)
+        self.assertEqual(utils.file_state(md_fn), state)
+
+        md = utils.MD(self.videos[0][:-3] + "md", "utf-8")
+        md.add_task(False, "[2,00:01] more words")
+        md.write()
+        c = os.path.join(self.folder, "c.mp4")
+        shutil.copy(self.videos[0][:-3] + "md", c[:-3] + "md")
+        self.merger.write_md(self.videos + [c])
+        md = utils.MD(md_fn, "utf-8")
+        self.assertEqual([m for m, _ in md.tasks()], [False, False, True, False])
+        self.assertIn("more words", md.tasks()[1][1])
+
+    @parameterized.expand(
+        [param(["test001.mp4", "test006.MP4"]), param(["test001.mp4", "test004.flv"])]
+    )
+    def test_run(self, files):
+        md_fn = self.merger.args.inputs[0]
+        videos = []
+        for f in files:
+            videos.append(os.path.join(self.folder, f))
+            shutil.copy(os.path.join(TEST_MEDIA_PATH, f), videos[-1])
+        self.merger.write_md(videos)
+        md = utils.MD(md_fn, "utf-8")
+        md.lines = [l.replace("[ ]", "[x]") for l in md.lines]
+        md.write()
+        self.merger.run()
+        merged_fn = os.path.join(self.folder, "autocut_merged.mp4")
+        info = render.probe(merged_fn)
+        self.assertAlmostEqual(
+            float(info["format"]["duration"]),
+            sum(float(render.probe(f)["format"]["duration"]) for f in videos),
+            delta=0.5,
+        )
@@ -0,0 +1,133 @@
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+
+from autocut import daemon, jobs, transcribe, watcher
+from config import TestArgs
+
+
+class FakeTranscribe:
+    runs = []
+    # Fails if set, or waits for the event to be set
+    error = None
+    gate = None
+
+    def __init__(self, args):
+        self.args = args
+
+    def run(self):
+        fn = self.args.inputs[0]
+        FakeTranscribe.runs.append((fn, self.args.force))
+        if FakeTranscribe.gate is not None:
+            FakeTranscribe.gate.wait()
+        if FakeTranscribe.error is not None:
+            raise FakeTranscribe.error
+        for ext in ("srt", "md"):
+            with open(os.path.splitext(fn)[0] + "." + ext, "w") as f:
+                f.write("- [ ] [1,00:00] x\n")
+
+
+class FakeMerger:
+    def __init__(self, md_fn):
+        self.args = TestArgs()
+        self.args.inputs = [md_fn]
+
+    def write_md(self, media_files):
+        pass
+
+    def run(self):
+        pass
+
+
+class FakeWatcher:
+    def wake(self):
+        pass
+
+
+class TestDaemon(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        FakeTranscribe.runs = []
+        FakeTranscribe.error = None
+        FakeTranscribe.gate = None
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def _write(self, name, mtime):
+        fn = os.path.join(self.folder, name)
+        with open(fn, "w") as f:
+            f.write(name)
+        os.utime(fn, (mtime, mtime))
+        return fn
+
+    def _daemon(self):
+        args = TestArgs()
+        args.inputs = [self.folder]
+        args.stable_seconds = 0
+        d = daemon.Daemon(args)
+        d.jobs = jobs.JobStore(":memory:", d.retry_interval)
+        d.transcribe_pool = ThreadPoolExecutor(1)
+        d.cut_pool = ThreadPoolExecutor(1)
+        d.merger = FakeMerger(os.path.join(self.folder, "autocut.md"))
+        d.watcher = FakeWatcher()
+        return d
+
+    def _iter(self):
+        d = self._daemon()
+        with mock.patch.object(transcribe, "Transcribe", FakeTranscribe):
+            d._iter(set(watcher.scan(self.folder)))
+            d.transcribe_pool.shutdown(wait=True)
+            d.cut_pool.shutdown(wait=True)
+        return d
+
+    def test_restart(self):
+        now = time.time()
+        # Transcribed before the restart
+        done = self._write("done.mp4", now - 100)
+        self._write("done.srt", now - 50)
+        self._write("done.md", now - 50)
+        # Transcribed live, and the recording finished after it
+        live = self._write("live.mp4", now - 10)
+        self._write("live.srt", now - 50)
+        self._write("live.md", now - 50)
+
+        d = self._iter()
+        # The partial transcription is overwritten
+        self.assertEqual(FakeTranscribe.runs, [(live, True)])
+        self.assertEqual(d.jobs.get(done)["stage"], jobs.TRANSCRIBED)
+        with open(os.path.join(self.folder, "live.md")) as f:
+            self.assertIn("[1,00:00]", f.read())
+
+    def test_retry_running(self):
+        fn = self._write("retry.mp4", time.time() - 100)
+        d = self._daemon()
+        with mock.patch.object(transcribe, "Transcribe", FakeTranscribe):
+            FakeTranscribe.error = RuntimeError("still recording")
+            d._iter(set(watcher.scan(self.folder)))
+            d.transcribe_pool.shutdown(wait=True)
+            d.transcribe_pool = ThreadPoolExecutor(1)
+            d._iter(set())
+            self.assertEqual(d.jobs.get(fn)["stage"], jobs.FAILED)
+
+            # Retried now, and the loop waits while the retry is running
+            d.jobs._set(fn, next_attempt=0)
+            FakeTranscribe.error = None
+            FakeTranscribe.gate = threading.Event()
+            try:
+                d._iter(set())
+                self.assertIn(fn, d.running)
+                self.assertEqual(d.jobs.due(self.folder), [])
+                self.assertEqual(d._timeout(), d.idle_interval)
+            finally:
+                FakeTranscribe.gate.set()
+            d.transcribe_pool.shutdown(wait=True)
+            d._iter(set())
+            d.cut_pool.shutdown(wait=True)
+        self.assertEqual(len(FakeTranscribe.runs), 2)
+        self.assertEqual(d.jobs.get(fn)["stage"], jobs.TRANSCRIBED)
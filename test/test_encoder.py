@@ -0,0 +1,35 @@
+import unittest
+
+from autocut.encoder import Encoder, hw_available
+from config import TestArgs
+
+
+class TestEncoder(unittest.TestCase):
+    def test_profiles(self):
+        args = TestArgs()
+        encoder = Encoder.from_args(args)
+        self.assertEqual(encoder.codec, "libx264")
+        self.assertEqual(encoder.options(), {"preset": "medium", "b:v": "10m"})
+
+        args.export_profile = "archive"
+        args.encoder_threads = 4
+        encoder = Encoder.from_args(args)
+        self.assertEqual(encoder.codec, "libx265")
+        self.assertEqual(encoder.options(), {"preset": "slow", "crf": 20, "threads": 4})
+        kwargs = encoder.moviepy_kwargs()
+        self.assertIsNone(kwargs["bitrate"])
+        self.assertEqual(kwargs["threads"], 4)
+        self.assertEqual(kwargs["ffmpeg_params"][-2:], ["-crf", "20"])
+
+    def test_hwaccel(self):
+        encoder = Encoder("h264_vaapi", crf=28, bitrate=None, hwaccel="vaapi")
+        self.assertEqual(encoder.options(), {"qp": 28})
+        self.assertEqual(encoder.filters(), ["format=nv12", "hwupload"])
+
+        args = TestArgs()
+        args.export_profile = "fast-preview"
+        args.hwaccel = "qsv"
+        encoder = Encoder.from_args(args)
+        # Fall back to the software encoder without the hardware
+        expected = "h264_qsv" if hw_available("qsv", "libx264") else "libx264"
+        self.assertEqual(encoder.codec, expected)
@@ -0,0 +1,47 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from autocut import jobs
+
+
+class TestJobStore(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.db_fn = os.path.join(self.folder, "jobs.db")
+        self.store = jobs.JobStore(self.db_fn, retry_interval=0.1)
+        self.fn = os.path.join(self.folder, "a.mp4")
+
+    def tearDown(self):
+        self.store.close()
+        shutil.rmtree(self.folder)
+
+    def test_resume(self):
+        self.assertEqual(self.store.add(self.fn, 1, 10)["stage"], jobs.NEW)
+        self.store.transcribed(self.fn, 1.5)
+        self.store.close()
+        # Reopened after a restart
+        self.store = jobs.JobStore(self.db_fn)
+        job = self.store.add(self.fn, 1, 10)
+        self.assertEqual(job["stage"], jobs.TRANSCRIBED)
+        self.assertEqual(job["transcribe_seconds"], 1.5)
+        # Restart the job if the file changed
+        self.assertEqual(self.store.add(self.fn, 2, 10)["stage"], jobs.NEW)
+        self.assertEqual(self.store.counts(self.folder), {jobs.NEW: 1})
+
+    def test_retry(self):
+        self.store.add(self.fn, 1, 10)
+        self.store.failed(self.fn, "still on recording")
+        self.assertEqual(self.store.due(self.folder), [])
+        self.assertGreater(self.store.next_retry(self.folder), 0)
+        time.sleep(0.15)
+        self.assertEqual(self.store.due(self.folder), [self.fn])
+        # Back off longer after another failure, even if the file grows
+        self.store.failed(self.fn, "still on recording")
+        job = self.store.add(self.fn, 2, 20)
+        self.assertEqual((job["stage"], job["attempts"]), (jobs.FAILED, 2))
+        self.assertGreater(self.store.next_retry(self.folder), 0.15)
+        self.store.remove(self.fn)
+        self.assertIsNone(self.store.next_retry(self.folder))
@@ -0,0 +1,113 @@
+import asyncio
+import threading
+import time
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+from autocut.openai_client import APIError, OpenAIClient, TokenBucket
+
+
+# A stub of the transcription API, it fails the first attempts of every file
+# and returns the file name as the subtitle
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        filename = body.split(b'filename="')[1].split(b'"')[0].decode()
+        server = self.server
+        with server.lock:
+            server.requests.append((filename, time.monotonic()))
+            server.connections.add(self.client_address)
+            attempts = server.attempts[filename] = server.attempts.get(filename, 0) + 1
+        if filename.startswith("ok"):
+            self._reply(200, f"1\n00:00:00,000 --> 00:00:01,000\n{filename}\n")
+        elif filename.startswith("bad"):
+            self._reply(400, "bad request")
+        elif attempts == 1:
+            self._reply(429, "rate limited", {"Retry-After": "0"})
+        elif attempts == 2 and filename.endswith("1.flac"):
+            self._reply(503, "unavailable")
+        else:
+            self._reply(200, f"1\n00:00:00,000 --> 00:00:01,000\n{filename}\n")
+
+    def _reply(self, status, text, headers={}):
+        data = text.encode()
+        self.send_response(status)
+        for k, v in headers.items():
+            self.send_header(k, v)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+class TestOpenAIClient(unittest.TestCase):
+    def setUp(self):
+        try:
+            import httpx
+        except ImportError:
+            self.skipTest("httpx is not installed")
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), StubHandler)
+        self.server.lock = threading.Lock()
+        self.server.requests = []
+        self.server.attempts = {}
+        self.server.connections = set()
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.client = OpenAIClient(
+            "test",
+            rpm=600,
+            base_url=f"http://127.0.0.1:{self.server.server_port}",
+            max_connections=2,
+            backoff=0.01,
+        )
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_transcribe_all(self):
+        files = [(f"{i}.flac", b"x" * 100) for i in range(6)]
+        done = []
+        texts = self.client.transcribe_all(files, "", "zh", lambda: done.append(1))
+        # In order, after retrying the 429 and 503 responses
+        self.assertEqual([t.split("\n")[2] for t in texts], [f for f, _ in files])
+        self.assertEqual(len(done), 6)
+        self.assertEqual(self.server.attempts["1.flac"], 3)
+        self.assertEqual(self.server.attempts["2.flac"], 2)
+        # Kept-alive connections are reused
+        self.assertLessEqual(len(self.server.connections), 2)
+        # 6 rate limited, 1 unavailable and 6 succeeded
+        self.assertEqual(len(self.server.requests), 13)
+
+    def test_rate_across_calls(self):
+        # One request every 0.1 sec, the second call doesn't start with a burst
+        for i in range(2):
+            files = [(f"ok{i}{j}.flac", b"x") for j in range(3)]
+            self.client.transcribe_all(files, "", "zh")
+        times = sorted(t for _, t in self.server.requests)
+        self.assertEqual(len(times), 6)
+        self.assertGreaterEqual(times[-1] - times[0], 0.45)
+        self.assertGreaterEqual(min(np.diff(times)), 0.05)
+
+    def test_client_error(self):
+        with self.assertRaises(APIError):
+            self.client.transcribe_all([("bad.flac", b"x")], "", "zh")
+        self.assertEqual(self.server.attempts["bad.flac"], 1)
+
+
+class TestTokenBucket(unittest.TestCase):
+    def test_rate(self):
+        async def acquire_all(bucket, n):
+            for _ in range(n):
+                await bucket.acquire()
+
+        # A burst of 2, then 20 per second
+        bucket = TokenBucket(20, period=1, capacity=2)
+        tic = time.monotonic()
+        asyncio.run(acquire_all(bucket, 12))
+        self.assertAlmostEqual(time.monotonic() - tic, 0.5, delta=0.1)
@@ -0,0 +1,101 @@
+import threading
+import time
+import unittest
+
+import numpy as np
+
+from autocut import registry
+from autocut.registry import ModelRegistry, model_lock, whisper_model_key
+from autocut.transcribe import Transcribe
+from config import TestArgs
+
+
+# A model whose transcribe is broken by concurrent calls, like the kv-cache
+# hooks of whisper
+class StatefulModel:
+    def __init__(self):
+        self.running = 0
+        self.max_running = 0
+
+    def transcribe(self, audio, speech_array_indices, lang, prompt):
+        self.running += 1
+        self.max_running = max(self.max_running, self.running)
+        time.sleep(0.01)
+        self.running -= 1
+        return [{"origin_timestamp": s} for s in speech_array_indices]
+
+
+class TestModelRegistry(unittest.TestCase):
+    def test_load_once(self):
+        registry = ModelRegistry(capacity=2)
+        loads = []
+        factory = lambda: loads.append(1) or object()
+        model = registry.get(("whisper", "small", "cpu", "default"), factory)
+        self.assertIs(
+            registry.get(("whisper", "small", "cpu", "default"), factory), model
+        )
+        self.assertEqual(len(loads), 1)
+
+    def test_lru_eviction(self):
+        registry = ModelRegistry(capacity=2)
+        registry.get("a", object)
+        registry.get("b", object)
+        # Touch a, so b is the least recently used one
+        registry.get("a", object)
+        registry.get("c", object)
+        self.assertEqual(registry.keys(), ["a", "c"])
+
+    def test_openai_key(self):
+        self.assertEqual(
+            whisper_model_key("openai", "small", "cuda", "int8"),
+            whisper_model_key("openai", "large", None, "default"),
+        )
+        self.assertNotEqual(
+            whisper_model_key("faster", "small", "cpu", "int8"),
+            whisper_model_key("faster", "small", "cpu", "float32"),
+        )
+
+
+class TestModelLock(unittest.TestCase):
+    def tearDown(self):
+        registry.registry.clear()
+
+    def test_lock(self):
+        model = StatefulModel()
+        self.assertIs(model_lock(model), model_lock(model))
+        self.assertIsNot(model_lock(model), model_lock(StatefulModel()))
+        model.thread_safe = True
+        with model_lock(model):
+            pass
+
+    def test_shared_model(self):
+        # The transcriptions of the daemon workers share the model
+        args = TestArgs()
+        args.whisper_mode = "whisper"
+        model = StatefulModel()
+        registry.registry.get(
+            whisper_model_key(
+                "whisper",
+                args.whisper_model,
+                args.device,
+                args.compute_type,
+                args.cpu_threads,
+                args.num_workers,
+            ),
+            lambda: model,
+        )
+        audio = np.zeros(16000, np.float32)
+        segments = [{"start": 0, "end": 16000}]
+
+        def work():
+            t = Transcribe(args)
+            self.assertIs(t.whisper_model, model)
+            for _ in range(5):
+                t._transcribe_cached(audio, segments)
+
+        threads = [threading.Thread(target=work) for _ in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(model.max_running, 1)
@@ -0,0 +1,87 @@
+import datetime
+import random
+import unittest
+
+import numpy as np
+import srt
+from parameterized import parameterized, param
+
+from autocut.subtitle import Subtitles, format_timestamp, parse_timestamp
+
+
+def random_subs(n, seed=0):
+    rng = random.Random(seed)
+    subs = []
+    t = 0
+    for i in range(n):
+        start = t + rng.randint(0, 2000)
+        # Some are empty or end before start, which are skipped when composed
+        end = start + rng.randint(-10, 3000)
+        t = end
+        content = rng.choice(["你好", "多行\n第二行", "", " ", "a\n\nb", "x --> y"])
+        subs.append(
+            srt.Subtitle(
+                i + 1,
+                datetime.timedelta(milliseconds=start),
+                datetime.timedelta(milliseconds=end),
+                content,
+            )
+        )
+    rng.shuffle(subs)
+    return subs
+
+
+class TestSubtitles(unittest.TestCase):
+    def test_compose(self):
+        subs = random_subs(1000)
+        self.assertEqual(Subtitles.from_srt(subs).compose(), srt.compose(subs))
+
+    @parameterized.expand(
+        [
+            param(srt.compose(random_subs(1000))),
+            param(srt.compose(random_subs(10)).replace("\n", "\r\n")),
+            # Not well-formed, parsed by srt instead
+            param("00:00:01,000 --> 00:00:02,000\nA\n\n"),
+            param(
+                "1\n00:00:01.5 --> 00:00:02,000\nA\n\n\n\n2\n00:00:03,000 --> 00:00:04,000\nB"
+            ),
+            param(
+                "1\n00:00:01,000 --> 00:00:02,000\nA\n\nB\n\n2\n00:00:03,000 --> 00:00:04,000\nC"
+            ),
+            # Empty contents, and the next cue without a blank line
+            param(
+                "1\n00:00:00,000 --> 00:00:01,000\n\n2\n00:00:01,000 --> 00:00:02,000\nB\n"
+            ),
+            param(
+                "1\n00:00:00,000 --> 00:00:01,000\nA\n2\n00:00:01,000 --> 00:00:02,000\n"
+            ),
+            param(
+                "1\n00:00:00,000 --> 00:00:01,000\nA\n\n2\n00:00:01,000 --> 00:00:02,000\n"
+            ),
+            param(""),
+        ]
+    )
+    def test_parse(self, text):
+        subs = Subtitles.parse(text)
+        expected = Subtitles.from_srt(srt.parse(text))
+        self.assertTrue(np.array_equal(subs.indices, expected.indices))
+        self.assertTrue(np.array_equal(subs.starts, expected.starts))
+        self.assertTrue(np.array_equal(subs.ends, expected.ends))
+        self.assertEqual(subs.contents, expected.contents)
+        self.assertEqual(subs.compose(), srt.compose(srt.parse(text)))
+
+    def test_segments(self):
+        subs = Subtitles(
+            [1, 2, 3, 4], [5000, 0, 1600, 3000], [6000, 1000, 2600, 4000], "abcd"
+        )
+        self.assertEqual(
+            subs.segments(500).tolist(), [[0, 1000], [1600, 4000], [5000, 6000]]
+        )
+        selected = subs.select(np.isin(subs.indices, [1, 4]))
+        self.assertEqual(selected.segments(500).tolist(), [[3000, 4000], [5000, 6000]])
+        self.assertEqual([c.content for c in selected], ["a", "d"])
+
+    def test_timestamp(self):
+        self.assertEqual(parse_timestamp("01:23:04,005"), 4984005)
+        self.assertEqual(format_timestamp(4984005), "01:23:04,005")
+        self.assertEqual(parse_timestamp("00:00:01.250\n"), 1250)
@@ -1,10 +1,14 @@
 import logging
 import os
 import unittest
+from unittest import mock
 
+import numpy as np
 from parameterized import parameterized, param
 
+from autocut import registry, utils
 from autocut.utils import MD
+from autocut.whisper_model import OpenAIModel
 from config import (
     TEST_MEDIA_FILE,
     TestArgs,
@@ -132,3 +136,157 @@ class TestTranscribe(unittest.TestCase):
         self.assertTrue(
             os.path.exists(TEST_MEDIA_PATH + file_name.split(".")[0] + ".md")
         )
+
+
+class FakeOpenAIClient:
+    rpm = 3
+
+    def __init__(self):
+        self.num_requests = 0
+
+    def transcribe_all(self, files, prompt, lang, callback=None):
+        # Check the uploads and return subtitles at 0 and 3.5 sec of them
+        for filename, data in files:
+            assert filename.endswith(".flac") and data[:4] == b"fLaC"
+        self.num_requests += len(files)
+        return [
+            "1\n00:00:00,000 --> 00:00:00,500\nhello\n\n"
+            "2\n00:00:03,500 --> 00:00:04,000\nworld\n"
+        ] * len(files)
+
+
+class TestOpenAIModel(unittest.TestCase):
+    @mock.patch.dict(os.environ, {"OPENAI_API_KEY": "test"})
+    def test_upload_in_memory(self):
+        model = OpenAIModel(rpm=2)
+        model.whisper_model = FakeOpenAIClient()
+        fn = os.path.join(TEST_MEDIA_PATH, "test001.mp4")
+        audio = utils.load_audio(fn)
+        speeches = [
+            {"start": 0, "end": 3 * 16000},
+            {"start": 5 * 16000, "end": 9 * 16000},
+        ]
+        files = sorted(os.listdir(TEST_MEDIA_PATH))
+        # Packed into a single upload, the time in it is mapped back
+        res = model.transcribe(fn, audio, speeches, "zh", "")
+        self.assertEqual(model.whisper_model.num_requests, 1)
+        self.assertEqual([s.start.total_seconds() for s in res], [0, 5.5])
+
+        # Split within the size limit
+        model.whisper_model = FakeOpenAIClient()
+        model.split_audio_bytes = 2**14
+        res = model.transcribe(fn, audio, speeches, "zh", "")
+        starts = [s.start.total_seconds() for s in res]
+        self.assertGreater(model.whisper_model.num_requests, 2)
+        self.assertEqual(starts, sorted(starts))
+        self.assertEqual(starts[0], 0)
+        self.assertLessEqual(starts[-1], 9)
+        # No temporary files beside the input
+        self.assertEqual(sorted(os.listdir(TEST_MEDIA_PATH)), files)
+
+
+# Record the windows it transcribes
+class RecordingModel:
+    def __init__(self):
+        self.windows = []
+        self.device = "cpu"
+
+    def transcribe(self, audio, speech_array_indices, lang, prompt):
+        self.windows += speech_array_indices
+        return [{"origin_timestamp": s} for s in speech_array_indices]
+
+
+# The ready queue of the speeches, each is taken right after decoded as if
+# the model is faster than decoding
+class Decoded:
+    def __init__(self):
+        self.items = []
+
+    def get(self):
+        return self.items.pop(0)
+
+    def empty(self):
+        return True
+
+
+class TestTranscribeReady(unittest.TestCase):
+    def tearDown(self):
+        registry.registry.clear()
+
+    def test_same_windows(self):
+        args = TestArgs()
+        args.whisper_mode = "whisper"
+        model = RecordingModel()
+        registry.registry.get(
+            registry.whisper_model_key(
+                "whisper",
+                args.whisper_model,
+                args.device,
+                args.compute_type,
+                args.cpu_threads,
+                args.num_workers,
+            ),
+            lambda: model,
+        )
+        t = Transcribe(args)
+        t.pack_seconds = 3
+        audio = np.zeros(60 * 16000, np.float32)
+        speeches = [
+            {"start": s * 16000, "end": (s + 1) * 16000} for s in range(0, 40, 2)
+        ]
+        windows = []
+        # All at once, one by one, and in uneven groups as decoded
+        for groups in ([20], [1] * 20, [3, 7, 1, 9]):
+            ready = Decoded()
+            offset = 0
+            for i, n in enumerate(groups):
+                done = i == len(groups) - 1
+                ready.items.append((audio, speeches[offset : offset + n], done))
+                offset += n
+            model.windows = []
+            res = t._transcribe_ready("test.mp4", ready)
+            self.assertEqual(len(res), len(model.windows))
+            windows.append(model.windows)
+        self.assertEqual(len(windows[0]), 7)
+        self.assertEqual(windows[0], windows[1])
+        self.assertEqual(windows[0], windows[2])
+
+    def test_cache_settings(self):
+        args = TestArgs()
+        args.whisper_mode = "whisper"
+        args.transcribe_cache = ":memory:"
+        args.transcribe_cache_size = 100
+        model = RecordingModel()
+        registry.registry.get(
+            registry.whisper_model_key(
+                "whisper",
+                args.whisper_model,
+                args.device,
+                args.compute_type,
+                args.cpu_threads,
+                args.num_workers,
+            ),
+            lambda: model,
+        )
+        t = Transcribe(args)
+        audio = np.random.rand(10 * 16000).astype(np.float32)
+        seg = {"start": 0, "end": 4 * 16000}
+        window = utils.pack_segments(
+            [{"start": 0, "end": 16000}, {"start": 16000, "end": 4 * 16000}], 30
+        )[0]
+
+        def transcribed(segments):
+            model.windows = []
+            t._transcribe_cached(audio, segments)
+            return len(model.windows)
+
+        self.assertEqual(transcribed([seg]), 1)
+        self.assertEqual(transcribed([seg]), 0)
+        # The same audio in another window layout
+        self.assertEqual(transcribed([window]), 1)
+        self.assertEqual(transcribed([window]), 0)
+        args.batch_size = 8
+        self.assertEqual(transcribed([seg]), 1)
+        model.device = "cuda"
+        self.assertEqual(transcribed([seg]), 1)
+        t.cache.close()
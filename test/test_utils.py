@@ -0,0 +1,287 @@
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+import ffmpeg
+import numpy as np
+from parameterized import parameterized, param
+
+from autocut import utils, whisper_model
+from autocut.subtitle import Subtitles
+from config import TEST_MEDIA_PATH, TEST_MEDIA_FILE_SIMPLE
+
+
+class TestLoadAudio(unittest.TestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    @parameterized.expand([param(file) for file in TEST_MEDIA_FILE_SIMPLE])
+    def test_iter_audio(self, file_name):
+        fn = os.path.join(TEST_MEDIA_PATH, file_name)
+        audio = utils.load_audio(fn)
+        blocks = list(utils.iter_audio(fn, block_size=16000))
+        self.assertTrue(all(len(b) == 16000 for b in blocks[:-1]))
+        self.assertTrue(np.array_equal(np.concatenate(blocks), audio))
+
+    @parameterized.expand([param(file) for file in TEST_MEDIA_FILE_SIMPLE])
+    def test_audio_cache(self, file_name):
+        fn = os.path.join(TEST_MEDIA_PATH, file_name)
+        audio = utils.load_audio(fn)
+        cached = utils.load_audio(fn, cache_dir=self.cache_dir)
+        self.assertIsInstance(cached, np.memmap)
+        self.assertTrue(np.array_equal(cached, audio))
+        self.assertEqual(len(os.listdir(self.cache_dir)), 1)
+        # Served from the cache without decoding again
+        self.assertTrue(
+            np.array_equal(utils.load_audio(fn, cache_dir=self.cache_dir), audio)
+        )
+
+    @parameterized.expand([param(file) for file in TEST_MEDIA_FILE_SIMPLE])
+    def test_stream_audio(self, file_name):
+        fn = os.path.join(TEST_MEDIA_PATH, file_name)
+        audio = utils.load_audio(fn)
+        for cache_dir in [None, self.cache_dir, self.cache_dir]:
+            blocks = []
+            for decoded, block in utils.stream_audio(fn, 16000, 16000, cache_dir):
+                blocks.append(block.copy())
+                self.assertEqual(len(decoded), sum(len(b) for b in blocks))
+            self.assertTrue(np.array_equal(decoded, audio))
+            self.assertTrue(np.array_equal(np.concatenate(blocks), audio))
+        self.assertEqual(len(os.listdir(self.cache_dir)), 1)
+
+    def test_stream_audio_cache_stopped(self):
+        fn = os.path.join(TEST_MEDIA_PATH, TEST_MEDIA_FILE_SIMPLE[0])
+        stream = utils.stream_audio(fn, 16000, 16000, self.cache_dir)
+        decoded, _ = next(stream)
+        # Mapped from the file being written, not held in memory
+        self.assertIsInstance(decoded, np.memmap)
+        stream.close()
+        self.assertEqual(os.listdir(self.cache_dir), [])
+        # Failed to decode
+        bad_fn = os.path.join(self.cache_dir, "bad.mp4")
+        with open(bad_fn, "wb") as f:
+            f.write(b"not a video")
+        with self.assertRaises(RuntimeError):
+            utils.load_audio(bad_fn, cache_dir=self.cache_dir)
+        self.assertEqual(os.listdir(self.cache_dir), ["bad.mp4"])
+
+    def test_stream_audio_cache_workers(self):
+        # The worker processes reopen the memmap by its filename
+        fn = os.path.join(TEST_MEDIA_PATH, TEST_MEDIA_FILE_SIMPLE[0])
+        try:
+            for decoded, block in utils.stream_audio(fn, 16000, 16000, self.cache_dir):
+                self.assertIsInstance(decoded, np.memmap)
+                audio = whisper_model._attach_audio(
+                    ("memmap", decoded.filename, len(decoded))
+                )
+                self.assertTrue(np.array_equal(audio, decoded))
+        finally:
+            whisper_model._worker.clear()
+        self.assertEqual(
+            os.listdir(self.cache_dir), [os.path.basename(decoded.filename)]
+        )
+
+    def test_iter_audio_errors(self):
+        # A corrupted file which ffmpeg reports much more errors than a pipe
+        # buffer holds, while it keeps decoding the rest
+        fn = os.path.join(self.cache_dir, "corrupted.mp3")
+        ffmpeg.input("sine=d=180", f="lavfi").output(fn, ac=1, audio_bitrate="32k").run(
+            cmd=["ffmpeg", "-nostdin", "-loglevel", "error"]
+        )
+        with open(fn, "r+b") as f:
+            data = bytearray(f.read())
+            for i in range(4000, len(data) - 8, 200):
+                data[i : i + 8] = b"\xff\xfb\x00\x00\xff\xff\xff\xff"
+            f.seek(0)
+            f.write(data)
+        blocks = []
+        thread = threading.Thread(
+            target=lambda: blocks.extend(utils.iter_audio(fn)), daemon=True
+        )
+        thread.start()
+        thread.join(60)
+        self.assertFalse(thread.is_alive())
+        self.assertGreater(sum(len(b) for b in blocks), 100 * 16000)
+
+    def test_load_missing_file(self):
+        with self.assertRaises(RuntimeError):
+            utils.load_audio(os.path.join(TEST_MEDIA_PATH, "missing.mp4"))
+
+    def test_encode_audio(self):
+        audio = utils.load_audio(os.path.join(TEST_MEDIA_PATH, "test001.mp4"))
+        data = utils.encode_audio(audio)
+        self.assertEqual(data[:4], b"fLaC")
+        # Lossless, and smaller than the 16 bits PCM
+        self.assertLess(len(data), len(audio) * 2)
+        fn = os.path.join(self.cache_dir, "audio.flac")
+        with open(fn, "wb") as f:
+            f.write(data)
+        decoded = utils.load_audio(fn)
+        np.testing.assert_allclose(decoded, audio, atol=1 / 16384)
+
+
+class TestCpuParallelism(unittest.TestCase):
+    def test_fill_cores(self):
+        cores = os.cpu_count() or 1
+        threads, workers = utils.cpu_parallelism(0, 0)
+        self.assertLessEqual(threads * workers, max(cores, threads))
+        self.assertEqual(utils.cpu_parallelism(2, 3), (2, 3))
+        self.assertEqual(utils.cpu_parallelism(1, 0), (1, cores))
+        self.assertEqual(utils.cpu_parallelism(0, cores), (1, cores))
+
+
+class TestPackSegments(unittest.TestCase):
+    def test_pack(self):
+        segments = [
+            {"start": 0, "end": 5},
+            {"start": 10, "end": 20},
+            {"start": 25, "end": 45},
+            {"start": 50, "end": 90},
+        ]
+        windows = utils.pack_segments(segments, 30)
+        self.assertEqual(
+            [w["pieces"] for w in windows],
+            [[(0, 5), (10, 20)], [(25, 45)], [(50, 90)]],
+        )
+        self.assertEqual([(w["start"], w["end"]) for w in windows][0], (0, 20))
+
+    def test_segment_audio(self):
+        audio = np.arange(100, dtype=np.float32)
+        window = utils.pack_segments(
+            [{"start": 0, "end": 5}, {"start": 10, "end": 12}], 30
+        )[0]
+        self.assertEqual(
+            utils.segment_audio(audio, window).tolist(), [0, 1, 2, 3, 4, 10, 11]
+        )
+        self.assertEqual(
+            utils.segment_audio(audio, {"start": 3, "end": 5}).tolist(), [3, 4]
+        )
+
+    def test_split_at_silence(self):
+        audio = np.ones(10000, np.float32)
+        audio[6000:6400] = 0
+        parts = utils.split_at_silence(
+            audio, {"start": 1000, "end": 10000}, 6000, frame=200
+        )
+        self.assertEqual(len(parts), 2)
+        self.assertTrue(6000 <= parts[0]["end"] <= 6400)
+        self.assertEqual(parts[0]["end"], parts[1]["start"])
+        self.assertEqual(
+            utils.split_at_silence(audio, {"start": 0, "end": 100}, 6000),
+            [{"start": 0, "end": 100}],
+        )
+
+    def test_shift_segment(self):
+        window = utils.pack_segments(
+            [{"start": 0, "end": 5}, {"start": 10, "end": 12}], 30
+        )[0]
+        self.assertEqual(
+            utils.shift_segment(window, 100),
+            {"start": 100, "end": 112, "pieces": [(100, 105), (110, 112)]},
+        )
+        self.assertEqual(
+            utils.shift_segment({"start": 3, "end": 5}, 10), {"start": 13, "end": 15}
+        )
+
+
+class TestSegments(unittest.TestCase):
+    def setUp(self):
+        self.segments = [
+            {"start": 0, "end": 5},
+            {"start": 6, "end": 20},
+            {"start": 21, "end": 22},
+            {"start": 40, "end": 60},
+        ]
+
+    def test_remove_short(self):
+        self.assertEqual(
+            utils.Segments.from_dicts(self.segments).remove_short(2).to_dicts(),
+            [self.segments[0], self.segments[1], self.segments[3]],
+        )
+
+    def test_expand(self):
+        self.assertEqual(
+            utils.Segments.from_dicts(self.segments).expand(3, 2, 61).to_dicts(),
+            [
+                {"start": 0, "end": 6},
+                {"start": 5, "end": 21},
+                {"start": 20, "end": 24},
+                {"start": 37, "end": 61},
+            ],
+        )
+
+    def test_merge_adjacent(self):
+        segments = utils.Segments.from_dicts(self.segments)
+        self.assertEqual(
+            segments.merge_adjacent(2).to_dicts(),
+            [{"start": 0, "end": 22}, {"start": 40, "end": 60}],
+        )
+        # The input is not modified
+        self.assertEqual(segments.to_dicts(), self.segments)
+        self.assertEqual(
+            utils.merge_adjacent_segments(self.segments, 2),
+            segments.merge_adjacent(2).to_dicts(),
+        )
+
+    def test_seconds(self):
+        segments = utils.Segments.from_dicts([{"start": 0.5, "end": 1.25}])
+        self.assertEqual(segments[0], {"start": 0.5, "end": 1.25})
+        self.assertEqual(len(utils.Segments()), 0)
+
+
+class TestSaveMD(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.md_fn = os.path.join(self.temp_dir, "test.md")
+        self.srt_fn = os.path.join(self.temp_dir, "test.srt")
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def _subs(self, texts):
+        starts, ends, contents = zip(*texts)
+        return Subtitles(
+            range(1, len(texts) + 1),
+            np.array(starts) * 1000,
+            np.array(ends) * 1000,
+            contents,
+        )
+
+    def _marked(self):
+        md = utils.MD(self.md_fn, "utf-8")
+        return [t.split("] ")[1].strip() for m, t in md.tasks() if m and "[" in t]
+
+    def test_carry_marks(self):
+        old_subs = self._subs([(0, 2, "a"), (3, 5, "b"), (6, 8, "c"), (9, 11, "d")])
+        self.assertTrue(utils.save_md(self.md_fn, self.srt_fn, old_subs, "utf-8"))
+        md = utils.MD(self.md_fn, "utf-8")
+        md.lines = [
+            (
+                l.rstrip("\n").replace("[ ]", "[x]")
+                if " b" in l or " d" in l
+                else l.rstrip("\n")
+            )
+            for l in md.lines
+        ]
+        md.lines[0] = md.lines[0].replace("[ ]", "[x]")
+        md.write()
+        mtime = os.stat(self.md_fn).st_mtime_ns
+        # Not written again if nothing changed, and still done editing
+        self.assertFalse(utils.save_md(self.md_fn, self.srt_fn, old_subs, "utf-8"))
+        self.assertEqual(os.stat(self.md_fn).st_mtime_ns, mtime)
+        self.assertTrue(utils.MD(self.md_fn, "utf-8").done_editing())
+
+        # A sentence inserted before, b is kept by its text, d by its time
+        subs = self._subs(
+            [(0, 2, "a"), (2.5, 3, "new"), (3, 5, "b"), (6, 8, "c"), (9, 11.5, "D")]
+        )
+        self.assertTrue(
+            utils.save_md(self.md_fn, self.srt_fn, subs, "utf-8", old_subs=old_subs)
+        )
+        self.assertEqual(self._marked(), ["b", "D"])
+        self.assertFalse(utils.MD(self.md_fn, "utf-8").done_editing())
@@ -0,0 +1,72 @@
+import unittest
+
+import numpy as np
+from parameterized import parameterized, param
+
+from autocut import utils
+from autocut.vad import StreamingVAD
+
+
+class FakeDetector:
+    # Return the given speeches of each block, as VAD of the whole audio
+    def __init__(self, speeches):
+        self.speeches = speeches
+        self.offset = 0
+
+    def __call__(self, block):
+        start, end = self.offset, self.offset + len(block)
+        self.offset = end
+        return [
+            {"start": max(s, start) - start, "end": min(e, end) - start}
+            for s, e in self.speeches
+            if s < end and e > start
+        ]
+
+
+class TestStreamingVAD(unittest.TestCase):
+    sr = 100
+
+    def detect(self, speeches, total, block_size):
+        vad = StreamingVAD(FakeDetector(speeches), self.sr)
+        emitted = []
+        for i in range(0, total, block_size):
+            emitted.append(vad.feed(np.zeros(min(block_size, total - i))))
+        emitted.append(vad.flush())
+        return emitted
+
+    def expected(self, speeches, total):
+        segments = (
+            utils.Segments(speeches)
+            .remove_short(1.0 * self.sr)
+            .expand(0.2 * self.sr, 0, total)
+            .merge_adjacent(0.5 * self.sr)
+        )
+        if len(segments) <= 1:
+            return [{"start": 0, "end": total}]
+        return segments.to_dicts()
+
+    @parameterized.expand([param(37), param(100), param(1000), param(10000)])
+    def test_same_as_whole_audio(self, block_size):
+        rng = np.random.default_rng(block_size)
+        for _ in range(100):
+            # Keep gaps larger than the tolerance to join speeches across blocks
+            lengths = rng.integers(1, 400, 20)
+            gaps = rng.integers(21, 200, 20)
+            starts = np.cumsum(gaps + np.concatenate([[0], lengths[:-1]]))
+            speeches = np.stack([starts, starts + lengths], axis=1).tolist()
+            total = speeches[-1][1] + 100
+            emitted = self.detect(speeches, total, block_size)
+            self.assertEqual(sum(emitted, []), self.expected(speeches, total))
+
+    def test_emit_while_decoding(self):
+        speeches = [[i * 300, i * 300 + 200] for i in range(10)]
+        emitted = self.detect(speeches, 3000, 500)
+        # Segments are emitted before the last block is decoded
+        self.assertTrue(any(emitted[:3]))
+        self.assertEqual(len(sum(emitted, [])), 10)
+
+    def test_no_speech(self):
+        self.assertEqual(self.detect([], 1000, 300)[-1], [{"start": 0, "end": 1000}])
+        self.assertEqual(
+            self.detect([[100, 500]], 1000, 300)[-1], [{"start": 0, "end": 1000}]
+        )
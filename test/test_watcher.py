@@ -0,0 +1,44 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from autocut import watcher
+
+
+class TestWatcher(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.fn = os.path.join(self.folder, "a.mp4")
+        with open(self.fn, "w") as f:
+            f.write("a")
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def check_changes(self, folder_watcher):
+        try:
+            self.assertEqual(folder_watcher.wait(0.2), set())
+            with open(self.fn, "a") as f:
+                f.write("b")
+            new_fn = os.path.join(self.folder, "b.md")
+            with open(new_fn, "w") as f:
+                f.write("b")
+            self.assertEqual(folder_watcher.wait(5), {self.fn, new_fn})
+            os.remove(new_fn)
+            self.assertEqual(folder_watcher.wait(5), {new_fn})
+        finally:
+            folder_watcher.close()
+
+    def test_scan(self):
+        self.assertEqual(list(watcher.scan(self.folder)), [self.fn])
+
+    def test_polling(self):
+        self.check_changes(watcher.PollingWatcher(self.folder, 0.1))
+
+    def test_events(self):
+        try:
+            folder_watcher = watcher.EventWatcher(self.folder, 0.2)
+        except ImportError:
+            self.skipTest("watchdog is not installed")
+        self.check_changes(folder_watcher)